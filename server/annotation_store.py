@@ -0,0 +1,540 @@
+import abc
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from absl import logging
+
+COMPARISONS = ['pd_vs_gt', 'an_vs_gt', 'an_vs_pd']
+METRICS = [
+    'bb_iou',
+    'bb_percentage_area_change',
+    'bb_number_of_changes',
+    'p_iou',
+    'p_percentage_area_change',
+    'p_number_of_changes'
+]
+POLYGONS = ['predicted_polygon', 'annotated_polygon', 'ground_truth_polygon']
+BOUNDING_BOXES = ['predicted_bounding_box', 'annotated_bounding_box', 'ground_truth_bounding_box']
+
+
+class AnnotationStore(abc.ABC):
+    """Persists annotation records keyed by (class id, image file name).
+
+    Records are the per-image dicts built by submit_result_helper:
+    image_id, submitted_at, the predicted/annotated/ground truth boxes and
+    polygons, metrics ({comparison: {metric: value}}) and metrics_version.
+    Class ids are stored as strings, the same way they come back from JSON.
+    All methods are safe to call from concurrent request threads. Backends
+    implement the abstract methods; the rest are built on them.
+    """
+    @abc.abstractmethod
+    def get(self, class_id, image_file_name):
+        """Returns one record, or None."""
+
+    @abc.abstractmethod
+    def upsert(self, class_id, image_file_name, record):
+        """Inserts or replaces one record."""
+
+    @abc.abstractmethod
+    def records(self):
+        """Yields (class_id, image_file_name, record) for every record."""
+
+    def records_needing_recalculation(self, metrics_version):
+        """Yields records whose metrics are missing or older than metrics_version."""
+        for class_id, image_file_name, record in self.records():
+            if (record.get('metrics_version') or 0) < metrics_version:
+                yield class_id, image_file_name, record
+
+    def count_needing_recalculation(self, metrics_version):
+        return sum(1 for _ in self.records_needing_recalculation(metrics_version))
+
+    @abc.abstractmethod
+    def mark_dirty(self):
+        """Resets every record's metrics_version, so all of them get recalculated."""
+
+    @abc.abstractmethod
+    def update_metrics(self, class_id, image_file_name, metrics, metrics_version, submitted_at=None):
+        """Replaces the metrics of one record, leaving its geometry untouched.
+
+        The update only applies while the record still has the given
+        submitted_at, so metrics computed from a record that was resubmitted
+        in the meantime are dropped instead of overwriting newer ones.
+        Returns True when the record was updated.
+        """
+
+    def metric_table(self):
+        """The metrics of every record as a metrics_table.MetricsTable."""
+        from metrics_table import MetricsTable
+
+        return MetricsTable.from_rows(self.metric_rows())
+
+    def metric_rows(self):
+        """Yields (class_id, image_file_name, comparison, {metric: value}) for every record and comparison."""
+        for class_id, image_file_name, record in self.records():
+            metrics = record.get('metrics') or {}
+            for comparison in COMPARISONS:
+                yield class_id, image_file_name, comparison, metrics.get(comparison) or {}
+
+    def compact(self):
+        pass
+
+
+class JsonFileStore(AnnotationStore):
+    """Legacy backend: rewrites one JSON file with every record on each write.
+
+    Records are held in memory as {class_id: {image_file_name: record}}.
+    Writers lock only the stripe their class hashes to, so submits for
+    different classes do not wait for each other, and readers copy one
+    class at a time under its stripe, so a statistics scan never holds up
+    writers for more than a single class copy. Records are never mutated
+    in place; an update stores a new dict.
+    """
+    def __init__(self, path='./data.json', stripes=16):
+        self.path = path
+        self._data = None
+        # guards loading and adding classes to the outer dict
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        # serializes file writes
+        self._io_lock = threading.Lock()
+
+    def load(self):
+        """Returns all records as {class_id: {image_file_name: record}}."""
+        with self._lock:
+            if self._data is None:
+                self._data = self._read()
+            return self._data
+
+    def _read(self):
+        if os.path.exists(self.path):
+            with open(self.path) as json_file:
+                return json.load(json_file)
+        return {}
+
+    def _stripe(self, class_id):
+        return self._stripes[hash(class_id) % len(self._stripes)]
+
+    def _class_data(self, class_id):
+        data = self.load()
+        class_data = data.get(class_id)
+        if class_data is None:
+            with self._lock:
+                class_data = data.setdefault(class_id, {})
+        return class_data
+
+    def get(self, class_id, image_file_name):
+        class_id = str(class_id)
+        with self._stripe(class_id):
+            return self.load().get(class_id, {}).get(image_file_name)
+
+    def records(self):
+        data = self.load()
+        with self._lock:
+            class_ids = list(data)
+        for class_id in class_ids:
+            with self._stripe(class_id):
+                items = list(data[class_id].items())
+            for image_file_name, record in items:
+                yield class_id, image_file_name, record
+
+    @contextlib.contextmanager
+    def _all_stripes(self):
+        # always taken in the same order, so two holders cannot deadlock
+        for stripe in self._stripes:
+            stripe.acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(self._stripes):
+                stripe.release()
+
+    def _copy(self):
+        # dict() of a dict is a single step under the GIL, so each class is
+        # copied consistently even without its stripe
+        with self._lock:
+            return {class_id: dict(class_data) for class_id, class_data in self._data.items()}
+
+    def upsert(self, class_id, image_file_name, record):
+        class_id = str(class_id)
+        class_data = self._class_data(class_id)
+        with self._stripe(class_id):
+            class_data[image_file_name] = record
+            self._persist(class_id, image_file_name, record)
+
+    def update_metrics(self, class_id, image_file_name, metrics, metrics_version, submitted_at=None):
+        class_id = str(class_id)
+        class_data = self._class_data(class_id)
+        with self._stripe(class_id):
+            current = class_data.get(image_file_name)
+            if current is None or current.get('submitted_at') != submitted_at:
+                return False
+            record = dict(current, metrics=metrics, metrics_version=metrics_version)
+            class_data[image_file_name] = record
+            self._persist(class_id, image_file_name, record)
+            return True
+
+    def mark_dirty(self):
+        data = self.load()
+        with self._all_stripes():
+            for class_data in list(data.values()):
+                for image_file_name, record in list(class_data.items()):
+                    class_data[image_file_name] = dict(record, metrics_version=0)
+            with self._io_lock:
+                self._persist_all()
+
+    def _persist(self, class_id, image_file_name, record):
+        # called with the class stripe held
+        with self._io_lock:
+            self._persist_all()
+
+    def _persist_all(self):
+        # called with the io lock held
+        write_json_atomic(self.path, self._copy())
+
+
+class JsonlAnnotationStore(JsonFileStore):
+    """Append-only backend: a JSON snapshot plus a JSONL log of upserts.
+
+    Each upsert appends one line to the log, so a submit costs O(1) writes
+    regardless of how many annotations exist. Loading replays the log over
+    the snapshot (later lines win). Every `compact_every` appends the
+    snapshot is rewritten atomically and the log truncated; a crash between
+    the two only replays upserts that are already in the snapshot.
+    """
+    def __init__(self,
+                log_path='./data.jsonl',
+                snapshot_path='./data.json',
+                compact_every=1000,
+                stripes=16):
+        super().__init__(snapshot_path, stripes)
+        self.log_path = log_path
+        self.compact_every = compact_every
+
+        self._log_file = None
+        self._appends = 0
+        self._compaction_pending = False
+
+    def _read(self):
+        data = super()._read()
+
+        self._appends = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path) as log_file:
+                for line in log_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line from a crash mid-append
+                        logging.warning('{}: skipping unreadable log line'.format(self.log_path))
+                        continue
+                    data.setdefault(entry['class_id'], {})[entry['image_file_name']] = entry['record']
+                    self._appends += 1
+
+        return data
+
+    def _persist(self, class_id, image_file_name, record):
+        # called with the class stripe held, so lines for one key are appended in order
+        line = json.dumps({
+            'class_id': class_id,
+            'image_file_name': image_file_name,
+            'record': record
+        })
+        with self._io_lock:
+            if self._log_file is None:
+                self._log_file = open(self.log_path, 'a')
+            self._log_file.write(line + '\n')
+            self._log_file.flush()
+            self._appends += 1
+            needs_compaction = self._appends >= self.compact_every and not self._compaction_pending
+            if needs_compaction:
+                self._compaction_pending = True
+
+        if needs_compaction:
+            # compaction takes every stripe; hand it to a thread so this
+            # writer, which holds one of them, does not deadlock
+            threading.Thread(target=self.compact, name='annotation-store-compact', daemon=True).start()
+
+    def compact(self):
+        self.load()
+        # every stripe plus the io lock: no append can land between the
+        # snapshot and the log truncation
+        with self._all_stripes(), self._io_lock:
+            self._compaction_pending = False
+            if self._appends == 0:
+                return
+            self._persist_all()
+        logging.info('{}: compacted into {}'.format(self.log_path, self.path))
+
+    def _persist_all(self):
+        # called with the io lock and every stripe held
+        write_json_atomic(self.path, self._copy())
+        if self._log_file is not None:
+            self._log_file.close()
+        self._log_file = open(self.log_path, 'w')
+        self._appends = 0
+
+
+class SqliteAnnotationStore(AnnotationStore):
+    """SQLite backend; nothing is held in memory between calls.
+
+    Tables: images, annotations (boxes, submit time, metrics version),
+    polygons (int32 points packed into blobs) and metrics (one row per
+    record and comparison). The records needing recalculation are an
+    indexed query, and scans read polygons and metrics one page of records
+    at a time. The database runs in WAL mode so
+    readers do not block the writer; each thread gets its own connection.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS images (
+            image_file_name TEXT PRIMARY KEY,
+            image_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS annotations (
+            class_id TEXT NOT NULL,
+            image_file_name TEXT NOT NULL,
+            predicted_bounding_box TEXT,
+            annotated_bounding_box TEXT,
+            ground_truth_bounding_box TEXT,
+            submitted_at REAL NOT NULL,
+            metrics_version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (class_id, image_file_name)
+        );
+        CREATE INDEX IF NOT EXISTS idx_annotations_image ON annotations (image_file_name);
+        CREATE INDEX IF NOT EXISTS idx_annotations_submitted_at ON annotations (submitted_at);
+        CREATE INDEX IF NOT EXISTS idx_annotations_metrics_version ON annotations (metrics_version);
+        CREATE TABLE IF NOT EXISTS polygons (
+            class_id TEXT NOT NULL,
+            image_file_name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            points BLOB NOT NULL,
+            PRIMARY KEY (class_id, image_file_name, kind)
+        );
+        CREATE TABLE IF NOT EXISTS metrics (
+            class_id TEXT NOT NULL,
+            image_file_name TEXT NOT NULL,
+            comparison TEXT NOT NULL,
+            bb_iou REAL,
+            bb_percentage_area_change REAL,
+            bb_number_of_changes INTEGER,
+            p_iou REAL,
+            p_percentage_area_change REAL,
+            p_number_of_changes INTEGER,
+            PRIMARY KEY (class_id, image_file_name, comparison)
+        );
+        CREATE INDEX IF NOT EXISTS idx_metrics_class_comparison ON metrics (class_id, comparison);
+    '''
+
+    # records per polygons / metrics query of a scan; two parameters each,
+    # within the 999 variables older SQLite builds allow
+    PAGE_SIZE = 400
+
+    def __init__(self, path='./annotations.db', import_path=None):
+        self.path = path
+        self._local = threading.local()
+
+        is_new = not os.path.exists(path)
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+        if is_new and import_path is not None and os.path.exists(import_path):
+            self.import_json(import_path)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def import_json(self, path):
+        with open(path) as json_file:
+            data = json.load(json_file)
+        conn = self._connection()
+        with conn:
+            for class_id, class_data in data.items():
+                for image_file_name, record in class_data.items():
+                    self._write(conn, class_id, image_file_name, record)
+        logging.info('{}: imported {}'.format(self.path, path))
+
+    def get(self, class_id, image_file_name):
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT a.class_id, a.image_file_name, i.image_id, a.predicted_bounding_box, '
+            'a.annotated_bounding_box, a.ground_truth_bounding_box, a.metrics_version, a.submitted_at '
+            'FROM annotations a LEFT JOIN images i ON i.image_file_name = a.image_file_name '
+            'WHERE a.class_id = ? AND a.image_file_name = ?',
+            (str(class_id), image_file_name)).fetchone()
+        if row is None:
+            return None
+
+        polygons, metrics = self._details(conn, [row])
+        return self._record(row, polygons, metrics)
+
+    def records(self):
+        return self._select_records()
+
+    def records_needing_recalculation(self, metrics_version):
+        return self._select_records('a.metrics_version < ?', (metrics_version,))
+
+    def count_needing_recalculation(self, metrics_version):
+        conn = self._connection()
+        return conn.execute('SELECT COUNT(*) FROM annotations WHERE metrics_version < ?',
+                            (metrics_version,)).fetchone()[0]
+
+    def mark_dirty(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE annotations SET metrics_version = 0')
+
+    def _select_records(self, condition='1', params=()):
+        # keyset pages, each read in full: a cursor left open would hold a read
+        # snapshot that makes the caller's own writes (update_metrics) fail as busy
+        conn = self._connection()
+        after = ('', '')
+        while True:
+            rows = conn.execute(
+                'SELECT a.class_id, a.image_file_name, i.image_id, a.predicted_bounding_box, '
+                'a.annotated_bounding_box, a.ground_truth_bounding_box, a.metrics_version, a.submitted_at '
+                'FROM annotations a LEFT JOIN images i ON i.image_file_name = a.image_file_name '
+                'WHERE ({}) AND (a.class_id, a.image_file_name) > (?, ?) '
+                'ORDER BY a.class_id, a.image_file_name LIMIT ?'.format(condition),
+                (*params, *after, self.PAGE_SIZE)).fetchall()
+            if not rows:
+                break
+            polygons, metrics = self._details(conn, rows)
+            for row in rows:
+                yield row[0], row[1], self._record(row, polygons, metrics)
+            after = rows[-1][:2]
+
+    def _details(self, conn, rows):
+        """Polygons and metrics of a page of annotation rows, one query each, keyed by (class_id, image_file_name)."""
+        keys = [value for row in rows for value in row[:2]]
+        in_keys = '(class_id, image_file_name) IN (VALUES {})'.format(', '.join(['(?, ?)'] * len(rows)))
+        polygons = {}
+        for class_id, image_file_name, kind, points in conn.execute(
+                'SELECT class_id, image_file_name, kind, points FROM polygons WHERE ' + in_keys, keys):
+            polygons.setdefault((class_id, image_file_name), {})[kind] = unpack_points(points)
+        metrics = {}
+        for class_id, image_file_name, comparison, *values in conn.execute(
+                'SELECT class_id, image_file_name, comparison, {} FROM metrics WHERE '.format(', '.join(METRICS))
+                + in_keys, keys):
+            metrics.setdefault((class_id, image_file_name), {})[comparison] = {
+                m: v for m, v in zip(METRICS, values) if v is not None}
+
+        return polygons, metrics
+
+    def _record(self, row, polygons, metrics):
+        key, image_id = (row[0], row[1]), row[2]
+        record = {'image_id': image_id}
+        for name, value in zip(BOUNDING_BOXES, row[3:6]):
+            record[name] = json.loads(value) if value is not None else None
+        for name in POLYGONS:
+            record[name] = None
+        record.update(polygons.get(key, {}))
+
+        record['metrics'] = {comparison: {} for comparison in COMPARISONS}
+        record['metrics'].update(metrics.get(key, {}))
+        record['metrics_version'] = row[6]
+        record['submitted_at'] = row[7]
+
+        return record
+
+    def upsert(self, class_id, image_file_name, record):
+        conn = self._connection()
+        with conn:
+            self._write(conn, str(class_id), image_file_name, record)
+
+    def _write(self, conn, class_id, image_file_name, record):
+        conn.execute('INSERT OR REPLACE INTO images (image_file_name, image_id) VALUES (?, ?)',
+                     (image_file_name, record.get('image_id')))
+        conn.execute(
+            'INSERT OR REPLACE INTO annotations (class_id, image_file_name, predicted_bounding_box, '
+            'annotated_bounding_box, ground_truth_bounding_box, submitted_at, metrics_version) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (class_id, image_file_name,
+             *[json.dumps(record.get(name)) if record.get(name) is not None else None for name in BOUNDING_BOXES],
+             record.get('submitted_at') or time.time(), record.get('metrics_version') or 0))
+
+        conn.execute('DELETE FROM polygons WHERE class_id = ? AND image_file_name = ?', (class_id, image_file_name))
+        conn.executemany(
+            'INSERT INTO polygons (class_id, image_file_name, kind, points) VALUES (?, ?, ?, ?)',
+            [(class_id, image_file_name, kind, pack_points(record.get(kind)))
+             for kind in POLYGONS if record.get(kind) is not None])
+
+        self._write_metrics(conn, class_id, image_file_name, record.get('metrics') or {})
+
+    def _write_metrics(self, conn, class_id, image_file_name, metrics):
+        conn.execute('DELETE FROM metrics WHERE class_id = ? AND image_file_name = ?', (class_id, image_file_name))
+        conn.executemany(
+            'INSERT INTO metrics (class_id, image_file_name, comparison, {}) VALUES (?, ?, ?, {})'.format(
+                ', '.join(METRICS), ', '.join('?' * len(METRICS))),
+            [(class_id, image_file_name, comparison, *[metrics[comparison].get(m) for m in METRICS])
+             for comparison in COMPARISONS if comparison in metrics])
+
+    def update_metrics(self, class_id, image_file_name, metrics, metrics_version, submitted_at=None):
+        conn = self._connection()
+        with conn:
+            # compare-and-set on submitted_at; the metrics rows are only
+            # replaced when the version update matched
+            updated = conn.execute(
+                'UPDATE annotations SET metrics_version = ? '
+                'WHERE class_id = ? AND image_file_name = ? AND submitted_at IS ?',
+                (metrics_version, str(class_id), image_file_name, submitted_at)).rowcount
+            if updated:
+                self._write_metrics(conn, str(class_id), image_file_name, metrics)
+        return bool(updated)
+
+    def metric_table(self):
+        # metric columns read straight into arrays, without a dict per record
+        from metrics_table import MetricsTable
+
+        conn = self._connection()
+        rows = conn.execute('SELECT class_id, image_file_name, comparison, {} FROM metrics'.format(
+            ', '.join(METRICS))).fetchall()
+
+        return MetricsTable.from_columns([row[0] for row in rows], [row[1] for row in rows],
+                                         [row[2] for row in rows], [row[3:] for row in rows])
+
+    def metric_rows(self):
+        conn = self._connection()
+        for row in conn.execute('SELECT class_id, image_file_name, comparison, {} FROM metrics'.format(', '.join(METRICS))):
+            yield row[0], row[1], row[2], {m: v for m, v in zip(METRICS, row[3:]) if v is not None}
+
+
+def pack_points(points):
+    # one type byte, then int32 points (the usual case) or float64 ones
+    points = np.asarray(points).reshape(-1, 2)
+    if np.issubdtype(points.dtype, np.integer) or np.array_equal(points, np.round(points)):
+        return b'i' + points.astype(np.int32).tobytes()
+    return b'f' + points.astype(np.float64).tobytes()
+
+
+def unpack_points(blob):
+    dtype = np.int32 if blob[:1] == b'i' else np.float64
+    return np.frombuffer(blob[1:], dtype=dtype).reshape(-1, 2).tolist()
+
+
+def write_json_atomic(path, data):
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def create_annotation_store(backend='sqlite'):
+    if backend == 'json':
+        return JsonFileStore('./data.json')
+    if backend == 'jsonl':
+        return JsonlAnnotationStore('./data.jsonl', './data.json')
+    if backend == 'sqlite':
+        # first start imports the existing data.json
+        return SqliteAnnotationStore('./annotations.db', import_path='./data.json')
+    raise ValueError('unknown annotation store backend: {}'.format(backend))
@@ -0,0 +1,77 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from absl import logging
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-item calls into batched calls.
+
+    Callers submit one item at a time from any thread. A single worker
+    thread waits up to `max_wait_ms` after the first queued item for more
+    items to arrive (or until `max_batch_size` items are queued), runs
+    `process_batch` once on the whole list, and hands result `i` back to
+    the caller of item `i`.
+    """
+    def __init__(self,
+                process_batch,
+                max_batch_size=8,
+                max_wait_ms=10,
+                name='micro-batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms / 1000.0)
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                logging.exception('{}: batch of {} failed'.format(self.name, len(items)))
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,96 @@
+"""Closed-form metrics of axis-aligned bounding boxes.
+
+Boxes are corners [x1, y1, x2, y2], in any order: a box covers the
+rectangle between its corners, as the four-point Shapely polygon the
+metrics used to build does. Each metric has a scalar form on two boxes and a
+pairwise form on [N, 4] and [M, 4] arrays returning [N, M].
+"""
+from collections import Counter
+
+import numpy as np
+
+
+def _extent(box):
+    x1, y1, x2, y2 = box[0], box[1], box[2], box[3]
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def area(box):
+    x1, y1, x2, y2 = _extent(box)
+    return (x2 - x1) * (y2 - y1)
+
+
+def iou(box, other_box):
+    """intersection / (union + 0.001)"""
+    ax1, ay1, ax2, ay2 = _extent(box)
+    bx1, by1, bx2, by2 = _extent(other_box)
+    width = max(0, min(ax2, bx2) - max(ax1, bx1))
+    height = max(0, min(ay2, by2) - max(ay1, by1))
+    intersection = width * height
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - intersection
+
+    return intersection / (union + 0.001)
+
+
+def percentage_area_change(box, ground_truth_box):
+    """abs(ground truth area - area) * 100 / ground truth area; ZeroDivisionError for an empty ground truth."""
+    ground_truth_area = area(ground_truth_box)
+    return abs(ground_truth_area - area(box)) * 100 / ground_truth_area
+
+
+def corners(box):
+    x1, y1, x2, y2 = box[0], box[1], box[2], box[3]
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+
+
+def number_of_changes(box, other_box):
+    """Corners of one box that have no equal corner in the other, counted as multisets."""
+    common = Counter(corners(box)) & Counter(corners(other_box))
+    return 4 - sum(common.values())
+
+
+def _extents(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return (np.minimum(boxes[:, 0], boxes[:, 2]), np.minimum(boxes[:, 1], boxes[:, 3]),
+            np.maximum(boxes[:, 0], boxes[:, 2]), np.maximum(boxes[:, 1], boxes[:, 3]))
+
+
+def areas(boxes):
+    x1, y1, x2, y2 = _extents(boxes)
+    return (x2 - x1) * (y2 - y1)
+
+
+def pairwise_iou(boxes, other_boxes):
+    ax1, ay1, ax2, ay2 = (v[:, None] for v in _extents(boxes))
+    bx1, by1, bx2, by2 = _extents(other_boxes)
+    width = np.clip(np.minimum(ax2, bx2) - np.maximum(ax1, bx1), 0, None)
+    height = np.clip(np.minimum(ay2, by2) - np.maximum(ay1, by1), 0, None)
+    intersection = width * height
+    union = ((ax2 - ax1) * (ay2 - ay1)) + ((bx2 - bx1) * (by2 - by1)) - intersection
+
+    return intersection / (union + 0.001)
+
+
+def pairwise_percentage_area_change(boxes, ground_truth_boxes):
+    """inf (or NaN) where the ground truth box is empty."""
+    ground_truth_areas = areas(ground_truth_boxes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs(ground_truth_areas - areas(boxes)[:, None]) * 100 / ground_truth_areas
+
+
+def _corner_arrays(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    # [N, 4 corners, 2]
+    return boxes[:, [[0, 1], [2, 1], [2, 3], [0, 3]]]
+
+
+def pairwise_number_of_changes(boxes, other_boxes):
+    a = _corner_arrays(boxes)
+    b = _corner_arrays(other_boxes)
+    # a corner value shared by k corners of a box and l of the other matches min(k, l) times;
+    # summing min(k, l) / k over the k corners of a that carry it counts it once
+    same_a = (a[:, :, None, :] == a[:, None, :, :]).all(axis=-1).sum(axis=2)
+    same_b = (a[:, None, :, None, :] == b[None, :, None, :, :]).all(axis=-1).sum(axis=3)
+    common = (np.minimum(same_a[:, None, :], same_b) / same_a[:, None, :]).sum(axis=2)
+
+    return 4 - np.rint(common).astype(np.int64)
@@ -0,0 +1,22 @@
+"""Builds the ground-truth index read by CocoUtils. Run from the server directory:
+    python -m coco.build_gt_index
+"""
+from absl import app, flags
+from absl.flags import FLAGS
+
+from coco.gt_index import build_index
+
+flags.DEFINE_string('annotations', './coco/annotations_trainval2017/annotations/instances_val2017.json',
+                    'COCO instances json to index')
+flags.DEFINE_string('output', './coco/annotations_trainval2017/index_val2017', 'index directory to write')
+
+
+def main(_argv):
+    build_index(FLAGS.annotations, FLAGS.output)
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
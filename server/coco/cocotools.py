@@ -1,19 +1,71 @@
-from pycocotools.coco import COCO
+import os
+
+from absl import logging
+import numpy as np
+
+from coco.gt_index import GroundTruthIndex
+
 
 class CocoUtils:
+    """Ground-truth annotations of COCO images.
+
+    Served from the prebuilt index at index_dir (by default
+    {data_dir}/index_{data_type}, overridable with COCO_GT_INDEX) when it
+    exists, see coco.build_gt_index. Otherwise the instances json is loaded
+    with pycocotools on the first lookup instead of at startup.
+    """
     def __init__(self,
                 data_dir = './coco/annotations_trainval2017',
                 data_type = 'val2017',
-                class_names='./yolov3_tf2/data/coco.names'):
-        ann_file = '{}/annotations/instances_{}.json'.format(data_dir, data_type)
-        self.coco = COCO(ann_file)
+                class_names='./yolov3_tf2/data/coco.names',
+                index_dir=None):
+        self.ann_file = '{}/annotations/instances_{}.json'.format(data_dir, data_type)
+        self.index_dir = index_dir or os.getenv('COCO_GT_INDEX', '{}/index_{}'.format(data_dir, data_type))
+        self.class_names_file = class_names
+
+        self._coco = None
+        self._index = None
+        self._class_names = None
+        if GroundTruthIndex.exists(self.index_dir):
+            self._index = GroundTruthIndex(self.index_dir)
+        else:
+            logging.info('no ground-truth index at {}, falling back to {}'.format(self.index_dir, self.ann_file))
 
-        self.class_names = [c.strip() for c in open(class_names).readlines()]
+    @property
+    def coco(self):
+        if self._coco is None:
+            from pycocotools.coco import COCO
+            self._coco = COCO(self.ann_file)
+        return self._coco
+
+    @property
+    def class_names(self):
+        if self._class_names is None:
+            self._class_names = [c.strip() for c in open(self.class_names_file).readlines()]
+        return self._class_names
 
     def load_annotations(self, image_id, class_name):
+        if self._index is not None:
+            # an unknown class matches every category, like getCatIds/getAnnIds below
+            return self._index.annotations(image_id, self._index.category_id(class_name))
+
         catIds = self.coco.getCatIds(catNms=[class_name]);
         ann_ids = self.coco.getAnnIds(
             imgIds=[image_id],
             catIds=catIds)
         anns = self.coco.loadAnns(ann_ids)
         return anns
+
+    def load_ground_truth(self, image_id, class_name):
+        """COCO [x, y, w, h] boxes of the annotations load_annotations would return, as an
+        [N, 4] array, and a function returning the segmentation of the i-th one.
+
+        Segmentations are only decoded when asked for.
+        """
+        if self._index is not None:
+            rows = self._index.rows(image_id, self._index.category_id(class_name))
+            return self._index.bboxes(rows), lambda i: self._index.segmentation(rows[i])
+
+        anns = self.load_annotations(image_id, class_name)
+        bboxes = np.array([a.get("bbox") for a in anns], dtype=np.float64).reshape(-1, 4)
+        return bboxes, lambda i: anns[i].get("segmentation")
@@ -0,0 +1,184 @@
+"""Compact, memory-mapped index of COCO ground-truth annotations.
+
+Built once from an instances_*.json file:
+    python -m coco.build_gt_index \
+        --annotations ./coco/annotations_trainval2017/annotations/instances_val2017.json \
+        --output ./coco/annotations_trainval2017/index_val2017
+
+The output directory holds flat .npy arrays: annotations sorted by the key
+(image_id << 32 | category_id), with one offset range per key, their boxes
+and the polygon points of all segments in a single float array. Crowd (RLE)
+segments are kept as JSON in one blob. GroundTruthIndex maps the arrays
+lazily, so loading it costs neither the JSON parse nor the memory of
+pycocotools.COCO.
+"""
+import json
+import os
+
+import numpy as np
+from absl import logging
+
+INDEX_VERSION = 1
+
+ARRAYS = [
+    'keys',             # uint64 [keys], sorted
+    'key_offsets',      # int64 [keys + 1], annotation rows of each key
+    'ann_ids',          # int64 [annotations]
+    'category_ids',     # int64 [annotations]
+    'positions',        # int64 [annotations], order in the source file
+    'bboxes',           # float64 [annotations, 4], COCO [x, y, w, h]
+    'areas',            # float64 [annotations]
+    'iscrowd',          # uint8 [annotations]
+    'segment_offsets',  # int64 [annotations + 1], polygons of each annotation
+    'point_offsets',    # int64 [polygons + 1], coordinates of each polygon
+    'points',           # float64 [coordinates], x0, y0, x1, y1, ...
+    'rle_offsets',      # int64 [annotations + 1], bytes of each crowd segment in rle.json
+]
+
+
+def make_key(image_id, category_id):
+    return (int(image_id) << 32) | int(category_id)
+
+
+def build_index(ann_file, output_dir):
+    with open(ann_file) as f:
+        dataset = json.load(f)
+    annotations = dataset['annotations']
+
+    keys = np.array([make_key(a['image_id'], a['category_id']) for a in annotations], dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    annotations = [annotations[i] for i in order]
+    sorted_keys = keys[order]
+    unique_keys, key_starts = np.unique(sorted_keys, return_index=True)
+
+    segment_offsets = [0]
+    point_offsets = [0]
+    points = []
+    rle_offsets = [0]
+    rle = bytearray()
+    for a in annotations:
+        segmentation = a.get('segmentation')
+        if isinstance(segmentation, list):
+            for polygon in segmentation:
+                points.extend(polygon)
+                point_offsets.append(len(points))
+            segment_offsets.append(segment_offsets[-1] + len(segmentation))
+        else:
+            segment_offsets.append(segment_offsets[-1])
+            if segmentation is not None:
+                rle.extend(json.dumps(segmentation).encode('utf-8'))
+        rle_offsets.append(len(rle))
+
+    arrays = {
+        'keys': unique_keys,
+        'key_offsets': np.append(key_starts, len(annotations)).astype(np.int64),
+        'ann_ids': np.array([a['id'] for a in annotations], dtype=np.int64),
+        'category_ids': np.array([a['category_id'] for a in annotations], dtype=np.int64),
+        'positions': order.astype(np.int64),
+        'bboxes': np.array([a['bbox'] for a in annotations], dtype=np.float64).reshape(-1, 4),
+        'areas': np.array([a.get('area', 0) for a in annotations], dtype=np.float64),
+        'iscrowd': np.array([a.get('iscrowd', 0) for a in annotations], dtype=np.uint8),
+        'segment_offsets': np.array(segment_offsets, dtype=np.int64),
+        'point_offsets': np.array(point_offsets, dtype=np.int64),
+        'points': np.array(points, dtype=np.float64),
+        'rle_offsets': np.array(rle_offsets, dtype=np.int64),
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(output_dir, name + '.npy'), array)
+    with open(os.path.join(output_dir, 'rle.json'), 'wb') as f:
+        f.write(bytes(rle))
+    # written last: an index without meta.json is incomplete
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'source': os.path.abspath(ann_file),
+            'categories': {c['name']: c['id'] for c in dataset.get('categories', [])}
+        }, f)
+
+    logging.info('indexed {} annotations under {} keys into {}'.format(
+        len(annotations), len(unique_keys), output_dir))
+
+
+class GroundTruthIndex:
+    """Ground-truth lookups over an index written by build_index.
+
+    Arrays are memory-mapped on first use. annotations() returns the same
+    dicts as pycocotools' loadAnns, in source file order.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._arrays = None
+        self._categories = None
+        self._rle = None
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, 'meta.json'))
+
+    def _load(self):
+        if self._arrays is None:
+            with open(os.path.join(self.index_dir, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError('{}: index version {}, expected {}; rebuild it with coco.build_gt_index'.format(
+                    self.index_dir, meta.get('version'), INDEX_VERSION))
+            self._categories = meta['categories']
+            self._rle = np.memmap(os.path.join(self.index_dir, 'rle.json'), dtype=np.uint8, mode='r') \
+                if os.path.getsize(os.path.join(self.index_dir, 'rle.json')) else np.zeros(0, dtype=np.uint8)
+            self._arrays = {name: np.load(os.path.join(self.index_dir, name + '.npy'), mmap_mode='r')
+                            for name in ARRAYS}
+
+        return self._arrays
+
+    def category_id(self, class_name):
+        self._load()
+        return self._categories.get(class_name)
+
+    def rows(self, image_id, category_id=None):
+        """Annotation rows of one image, of one category or of all of them."""
+        arrays = self._load()
+        keys, key_offsets = arrays['keys'], arrays['key_offsets']
+        if category_id is not None:
+            key = np.uint64(make_key(image_id, category_id))
+            i = np.searchsorted(keys, key)
+            if i == len(keys) or keys[i] != key:
+                return np.zeros(0, dtype=np.int64)
+            return np.arange(key_offsets[i], key_offsets[i + 1])
+
+        # every category: the image's keys are one contiguous range
+        start = np.searchsorted(keys, np.uint64(make_key(image_id, 0)))
+        end = np.searchsorted(keys, np.uint64(make_key(int(image_id) + 1, 0)))
+        rows = np.arange(key_offsets[start], key_offsets[end])
+        return rows[np.argsort(arrays['positions'][rows], kind='stable')]
+
+    def bboxes(self, rows):
+        return np.asarray(self._load()['bboxes'][rows])
+
+    def segmentation(self, row):
+        arrays = self._load()
+        if arrays['iscrowd'][row]:
+            start, end = arrays['rle_offsets'][row], arrays['rle_offsets'][row + 1]
+            return json.loads(bytes(self._rle[start:end]).decode('utf-8'))
+        polygons = []
+        for p in range(arrays['segment_offsets'][row], arrays['segment_offsets'][row + 1]):
+            start, end = arrays['point_offsets'][p], arrays['point_offsets'][p + 1]
+            polygons.append(arrays['points'][start:end].tolist())
+
+        return polygons
+
+    def annotation(self, row, image_id):
+        arrays = self._load()
+        return {
+            'id': int(arrays['ann_ids'][row]),
+            'image_id': int(image_id),
+            'category_id': int(arrays['category_ids'][row]),
+            'bbox': arrays['bboxes'][row].tolist(),
+            'area': float(arrays['areas'][row]),
+            'iscrowd': int(arrays['iscrowd'][row]),
+            'segmentation': self.segmentation(row),
+        }
+
+    def annotations(self, image_id, category_id=None):
+        return [self.annotation(row, image_id) for row in self.rows(image_id, category_id)]
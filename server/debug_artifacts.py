@@ -0,0 +1,74 @@
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from absl import logging
+
+
+class DebugArtifacts:
+    """Renders debug images (drawn boxes, masks, contours) off the request path.
+
+    Disabled by default. When enabled, a sampled fraction of requests hand a
+    render callable to a single background worker, which writes to a unique
+    path under `output_dir` so concurrent requests never overwrite each
+    other. Renders are dropped rather than queued once `max_pending` are
+    waiting.
+    """
+    def __init__(self,
+                enabled=False,
+                sample_rate=1.0,
+                output_dir='./data/debug',
+                max_pending=16):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.max_pending = max_pending
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get('DEBUG_ARTIFACTS', '0') == '1',
+            sample_rate=float(os.environ.get('DEBUG_ARTIFACTS_SAMPLE_RATE', 1.0)),
+            output_dir=os.environ.get('DEBUG_ARTIFACTS_DIR', './data/debug')
+        )
+
+    def sample(self):
+        """Returns True when the current request should produce artifacts."""
+        return self.enabled and random.random() < self.sample_rate
+
+    def submit(self, prefix, render, *args):
+        """Schedules render(path, *args) and returns the path it will write to.
+
+        Arguments should already be plain NumPy data; they are used from
+        another thread after the request has returned.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                logging.warning('debug artifacts: dropping {}, {} renders pending'.format(prefix, self._pending))
+                return None
+            self._pending += 1
+            if self._executor is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='debug-artifacts')
+
+        path = os.path.join(self.output_dir, '{}_{}_{}.jpg'.format(prefix, time.time_ns(), uuid.uuid4().hex[:8]))
+        self._executor.submit(self._render, render, path, *args)
+
+        return path
+
+    def _render(self, render, path, *args):
+        try:
+            render(path, *args)
+            logging.info('debug artifact saved to: {}'.format(path))
+        except Exception:
+            logging.exception('debug artifact {} failed'.format(path))
+        finally:
+            with self._lock:
+                self._pending -= 1
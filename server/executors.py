@@ -0,0 +1,62 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when a BoundedExecutor has no free worker or queue slot."""
+    def __init__(self, name, retry_after):
+        super().__init__(f'{name} executor queue is full')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """Thread pool with admission control.
+
+    At most `max_workers` calls run at once and at most `max_queue` more wait
+    for a worker. Anything beyond that is rejected immediately with
+    QueueFullError instead of piling up behind the model.
+    """
+    def __init__(self,
+                max_workers=2,
+                max_queue=16,
+                retry_after=1,
+                name='executor'):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._depth = 0
+
+    @property
+    def depth(self):
+        """Number of calls currently running or waiting."""
+        return self._depth
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(self.name, self.retry_after)
+
+        with self._lock:
+            self._depth += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _release(self):
+        with self._lock:
+            self._depth -= 1
+        self._slots.release()
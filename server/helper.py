@@ -1,28 +1,106 @@
 import os
-import copy
-import json
-from shapely.geometry import Polygon
+import time
 from pydantic import BaseModel
 
+import matching
+import metrics
+import preannotate
+from annotation_store import COMPARISONS, METRICS, create_annotation_store
 from coco.cocotools import CocoUtils
+from debug_artifacts import DebugArtifacts
+from absl import logging
+
+from executors import BoundedExecutor, QueueFullError
+from image_loader import ImageLoader
+from jobs import JobRunner
+from metrics import METRICS_VERSION, compute_metrics
+from recalculation import recalculate_metrics
+from result_cache import ResultCache
+from running_stats import MetricsStatistics
+from uploads import UploadStore
 from yolov3_tf2 import yolov3_model
 from mask_rcnn import maskrcnn_model
 
-data = {}
+# annotation records; SQLite by default (ANNOTATION_STORE=jsonl for the append-only log,
+# ANNOTATION_STORE=json for the legacy single file)
+annotation_store = create_annotation_store(os.environ.get('ANNOTATION_STORE', 'sqlite'))
+# per-class and overall metric aggregates, updated on every submit
+metrics_statistics = MetricsStatistics(annotation_store)
+
+# drawn boxes, masks and contours; off unless DEBUG_ARTIFACTS=1
+debug_artifacts = DebugArtifacts.from_env()
 
 yolo = yolov3_model.YoloV3Model(
     i_classes='./config/coco.names',
-    i_yolo_max_boxes=100
+    i_yolo_max_boxes=100,
+    i_batch_size=8,
+    i_batch_wait_ms=10,
+    i_debug_artifacts=debug_artifacts
 )
 
 mask_rcnn = maskrcnn_model.MaskRCNNModel(
     i_classes='./config/coco.names',
     i_weights='./mask_rcnn/model/mask_rcnn_coco.h5',
-    i_logs='./mask_rcnn/logs/'
+    i_logs='./mask_rcnn/logs/',
+    i_batch_size=4,
+    i_batch_wait_ms=20,
+    i_cache_dir=os.environ.get('MASK_RCNN_CACHE_DIR') or None,
+    i_whole_image=os.environ.get('MASK_RCNN_WHOLE_IMAGE', '0') == '1',
+    i_debug_artifacts=debug_artifacts
 )
 
 coco_utils = CocoUtils()
 
+# uploaded images, streamed to ./data and deduplicated by content
+upload_store = UploadStore(
+    max_bytes=int(os.environ.get('UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+)
+# run YOLO on every new upload so /get_bounding_boxes finds it cached
+UPLOAD_WARM_UP = os.environ.get('UPLOAD_WARM_UP', '0') == '1'
+
+# each uploaded image is read and decoded once for both models
+image_loader = ImageLoader(max_entries=int(os.environ.get('IMAGE_CACHE_SIZE', 32)))
+
+# detections keyed by image content and model parameters
+bounding_boxes_cache = ResultCache(
+    max_entries=int(os.environ.get('BOUNDING_BOXES_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('BOUNDING_BOXES_CACHE_TTL', 24 * 3600)),
+    disk_dir=os.environ.get('BOUNDING_BOXES_CACHE_DIR') or None,
+    name='bounding-boxes-cache'
+)
+yolo.add_weights_listener(bounding_boxes_cache.invalidate)
+
+# one bounded pool per model so TensorFlow calls cannot oversubscribe the cores;
+# workers should cover the model's batch size so requests can coalesce
+yolo_executor = BoundedExecutor(
+    max_workers=int(os.environ.get('YOLO_WORKERS', 8)),
+    max_queue=int(os.environ.get('YOLO_QUEUE_SIZE', 32)),
+    retry_after=int(os.environ.get('YOLO_RETRY_AFTER', 1)),
+    name='yolo'
+)
+
+mask_rcnn_executor = BoundedExecutor(
+    max_workers=int(os.environ.get('MASK_RCNN_WORKERS', 4)),
+    max_queue=int(os.environ.get('MASK_RCNN_QUEUE_SIZE', 16)),
+    retry_after=int(os.environ.get('MASK_RCNN_RETRY_AFTER', 2)),
+    name='mask-rcnn'
+)
+
+# long admin operations (recalculation, statistics, pre-annotation) run here and are polled by job id
+jobs = JobRunner(
+    max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_queue=int(os.environ.get('JOB_QUEUE_SIZE', 8)),
+    name='jobs'
+)
+# processes and records per chunk for metrics recalculation
+RECALCULATE_WORKERS = int(os.environ.get('RECALCULATE_WORKERS', os.cpu_count() or 1))
+RECALCULATE_CHUNK_SIZE = int(os.environ.get('RECALCULATE_CHUNK_SIZE', 256))
+PREANNOTATE_BATCH_SIZE = int(os.environ.get('PREANNOTATE_BATCH_SIZE', 8))
+
+class PreannotateRequest(BaseModel):
+    images: list = ['./data/*']
+    masks: bool = True
+
 class GetBoundingBoxesRequest(BaseModel):
     image_id: str
     image_file_name: str
@@ -59,24 +137,36 @@ class GetBoundingBoxMetricsRequest(BaseModel):
 
 def get_bounding_boxes_helper(req: GetBoundingBoxesRequest):
     image_path = "./data/" + req.image_file_name
-    # img_shape: (height, width, channels), box point: (width, height), box: [top_left_box_point bottom_right_box_point]
-    boxes, _, classes, _, img_shape = yolo.process(req.image_id, image_path)
-
-    npboxes = boxes.numpy()
-    npboxes = npboxes.reshape((npboxes.shape[1], npboxes.shape[2]))
-    for i in range(npboxes.shape[0]):
-        npboxes[i][0] = max(0, int(npboxes[i][0]*img_shape[1]))
-        npboxes[i][1] = max(0, int(npboxes[i][1]*img_shape[0]))
-        npboxes[i][2] = max(0, int(npboxes[i][2]*img_shape[1]))
-        npboxes[i][3] = max(0, int(npboxes[i][3]*img_shape[0]))
+    image = image_loader.load(image_path)
+    cache_key = yolo.cache_key(image.content_hash)
+    cached = bounding_boxes_cache.get(cache_key)
+    if cached is not None:
+        npboxes, classes = cached
+        return image_path, npboxes, classes
 
-    npboxes, classes = yolo.non_maximum_suppression(npboxes, classes.numpy().flatten())
+    # img_shape: (height, width, channels), box point: (width, height), box: [top_left_box_point bottom_right_box_point]
+    boxes, scores, classes, nums, img_shape = yolo.process(req.image_id, image_path, image.pixels)
+    npboxes, classes = yolo.postprocess(boxes, scores, classes, nums, img_shape)
+    bounding_boxes_cache.put(cache_key, (npboxes, classes))
 
     return image_path, npboxes, classes
 
+def warm_up_upload_helper(image_file_name):
+    """Queues YOLO detection of a new upload; skipped when the pool is busy."""
+    req = GetBoundingBoxesRequest(image_id=image_file_name, image_file_name=image_file_name)
+    try:
+        future = yolo_executor.submit(get_bounding_boxes_helper, req)
+    except QueueFullError:
+        logging.info('yolo pool busy, not warming up {}'.format(image_file_name))
+        return
+    future.add_done_callback(
+        lambda f: f.exception() is not None and logging.warning(
+            'warm-up of {} failed: {}'.format(image_file_name, f.exception())))
+
 def get_object_boundary_helper(req: GetObjectBoundaryRequest):
     image_path = "./data/" + req.image_file_name
-    full_mask, simple_mask_polygon = mask_rcnn.predict(image_path, req.bounding_box, req.class_of_interest)
+    full_mask, simple_mask_polygon = mask_rcnn.predict(image_path, req.bounding_box, req.class_of_interest,
+                                                       image_loader.load(image_path))
 
     return image_path, full_mask, simple_mask_polygon
 
@@ -88,49 +178,23 @@ def get_points(segmentation):
 
     return points
 
-def find_best_ground_truth(gts, ann_bbox):
-    first = True
-    ground_truth_bounding_box = None
-    ground_truth_polygon = None
-    mx = 0
-    for g in gts:
-        if first:
-            first = False
-            ground_truth_bounding_box = [int(x) for x in g.get("bbox")]
-            ground_truth_polygon = get_points(g.get("segmentation"))
-            mx = get_bounding_box_iou_helper(GetBoundingBoxMetricsRequest(image_id="", \
-                                                                            predicted_bounding_box=ann_bbox, \
-                                                                            ground_truth_bounding_box=ground_truth_bounding_box))
-        else:
-            bbox = [int(x) for x in g.get("bbox")]
-            m = get_bounding_box_iou_helper(GetBoundingBoxMetricsRequest(image_id="", \
-                                                                            predicted_bounding_box=ann_bbox, \
-                                                                            ground_truth_bounding_box=bbox))
-            if (m > mx):
-                mx = m
-                ground_truth_bounding_box = bbox
-                ground_truth_polygon = get_points(g.get("segmentation"))
-
-
-    return ground_truth_bounding_box, ground_truth_polygon
+def find_best_ground_truth(gt_bboxes, gt_segmentation, ann_bbox):
+    """Ground truth box and polygon overlapping ann_bbox the most; only the winner's segmentation is decoded."""
+    ground_truth_bounding_boxes = matching.ground_truth_boxes(gt_bboxes)
+    best = matching.best_match(ann_bbox, ground_truth_bounding_boxes)
+    if best is None:
+        return None, None
+
+    return ground_truth_bounding_boxes[best].tolist(), get_points(gt_segmentation(best))
 
 def submit_result_helper(req: SubmitResultRequest):
-    global data
-    load_state_helper()
     if req.result is not None:
-        if req.result.object_class in data:
-            class_data = data.get(req.result.object_class)
-        else:
-            class_data = {}
-            data[req.result.object_class] = class_data
-
-        if req.image_file_name in class_data:
-            image_data = class_data.get(req.image_file_name)
-        else:
-            image_data = {}
-            class_data[req.image_file_name] = image_data
+        # class ids are kept as strings, the way they come back from the store
+        class_id = str(req.result.object_class)
+        image_data = {}
 
         image_data["image_id"] = req.image_id
+        image_data["submitted_at"] = time.time()
         image_data["predicted_bounding_box"] = req.result.predicted_bounding_box
         image_data["predicted_polygon"] = req.result.predicted_polygon
         image_data["annotated_bounding_box"] = req.result.annotated_bounding_box
@@ -142,511 +206,88 @@ def submit_result_helper(req: SubmitResultRequest):
         file_name = os.path.splitext(req.image_file_name)[0]
         # coco image id is a number
         if file_name.isnumeric():
-            gts = coco_utils.load_annotations(int(file_name), yolo.get_class_name(req.result.object_class))
-            ground_truth_bounding_box, ground_truth_polygon = find_best_ground_truth(gts, req.result.annotated_bounding_box)
+            gt_bboxes, gt_segmentation = coco_utils.load_ground_truth(int(file_name), yolo.get_class_name(req.result.object_class))
+            ground_truth_bounding_box, ground_truth_polygon = find_best_ground_truth(gt_bboxes, gt_segmentation,
+                                                                                     req.result.annotated_bounding_box)
             if ground_truth_bounding_box is not None:
                 image_data["ground_truth_bounding_box"] = ground_truth_bounding_box
                 image_data["ground_truth_polygon"] = ground_truth_polygon
 
-        image_data["metrics"] = {"an_vs_gt": {}, "pd_vs_gt": {}, "an_vs_pd": {}}
-        image_metrics = image_data.get("metrics")
-
-        # pd_vs_gt
-        if image_data.get("predicted_bounding_box") is not None and image_data.get("ground_truth_bounding_box") is not None:
-            pd_vs_gt = image_metrics.get("pd_vs_gt")
-            r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_bounding_box=image_data.get("predicted_bounding_box"), \
-                ground_truth_bounding_box=image_data.get("ground_truth_bounding_box"))
-            pd_vs_gt["bb_iou"] = get_bounding_box_iou_helper(r)
-            pd_vs_gt["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-            pd_vs_gt["bb_number_of_changes"] = get_bounding_box_number_of_changes_helper(r)
-
-        if image_data.get("predicted_polygon") is not None and image_data.get("ground_truth_polygon") is not None:
-            pd_vs_gt = image_metrics.get("pd_vs_gt")
-            r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_polygon=image_data.get("predicted_polygon"), \
-                ground_truth_polygon=image_data.get("ground_truth_polygon"))
-            pd_vs_gt["p_iou"] = get_polygon_iou_helper(r)
-            pd_vs_gt["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-            pd_vs_gt["p_number_of_changes"] = get_polygon_number_of_changes_helper(r)
-
-        # an_vs_gt
-        if image_data.get("annotated_bounding_box") is not None and image_data.get("ground_truth_bounding_box") is not None:
-            an_vs_gt = image_metrics.get("an_vs_gt")
-            r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_bounding_box=image_data.get("annotated_bounding_box"), \
-                ground_truth_bounding_box=image_data.get("ground_truth_bounding_box"))
-            an_vs_gt["bb_iou"] = get_bounding_box_iou_helper(r)
-            an_vs_gt["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-            an_vs_gt["bb_number_of_changes"] = get_bounding_box_number_of_changes_helper(r)
-
-        if image_data.get("annotated_polygon") is not None and image_data.get("ground_truth_polygon") is not None:
-            an_vs_gt = image_metrics.get("an_vs_gt")
-            r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_polygon=image_data.get("annotated_polygon"), \
-                ground_truth_polygon=image_data.get("ground_truth_polygon"))
-            an_vs_gt["p_iou"] = get_polygon_iou_helper(r)
-            an_vs_gt["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-            an_vs_gt["p_number_of_changes"] = get_polygon_number_of_changes_helper(r)
-
-        # an_vs_pd
-        if image_data.get("annotated_bounding_box") is not None and image_data.get("predicted_bounding_box") is not None:
-            an_vs_pd = image_metrics.get("an_vs_pd")
-            r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_bounding_box=image_data.get("predicted_bounding_box"), \
-                ground_truth_bounding_box=image_data.get("annotated_bounding_box"))
-            an_vs_pd["bb_iou"] = get_bounding_box_iou_helper(r)
-            an_vs_pd["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-            an_vs_pd["bb_number_of_changes"] = req.result.bounding_box_changes
-
-        if image_data.get("annotated_polygon") is not None and image_data.get("predicted_polygon") is not None:
-            an_vs_pd = image_metrics.get("an_vs_pd")
-            r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                predicted_polygon=image_data.get("predicted_polygon"), \
-                ground_truth_polygon=image_data.get("annotated_polygon"))
-            an_vs_pd["p_iou"] = get_polygon_iou_helper(r)
-            an_vs_pd["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-            an_vs_pd["p_number_of_changes"] = req.result.polygon_changes
-
-    save_state_helper()
-
-def recalculate_metrics_helper():
-    global data
-    load_state_helper()
-
-    for _, class_data in data.items():
-        for _, image_data in class_data.items():
-            image_metrics = image_data.get("metrics")
-
-            # pd_vs_gt
-            if image_data.get("predicted_bounding_box") is not None and image_data.get("ground_truth_bounding_box") is not None:
-                pd_vs_gt = image_metrics.get("pd_vs_gt")
-                r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_bounding_box=image_data.get("predicted_bounding_box"), \
-                    ground_truth_bounding_box=image_data.get("ground_truth_bounding_box"))
-                pd_vs_gt["bb_iou"] = get_bounding_box_iou_helper(r)
-                pd_vs_gt["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-                pd_vs_gt["bb_number_of_changes"] = get_bounding_box_number_of_changes_helper(r)
-
-            if image_data.get("predicted_polygon") is not None and image_data.get("ground_truth_polygon") is not None:
-                pd_vs_gt = image_metrics.get("pd_vs_gt")
-                r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_polygon=image_data.get("predicted_polygon"), \
-                    ground_truth_polygon=image_data.get("ground_truth_polygon"))
-                pd_vs_gt["p_iou"] = get_polygon_iou_helper(r)
-                pd_vs_gt["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-                pd_vs_gt["p_number_of_changes"] = get_polygon_number_of_changes_helper(r)
-
-            # an_vs_gt
-            if image_data.get("annotated_bounding_box") is not None and image_data.get("ground_truth_bounding_box") is not None:
-                an_vs_gt = image_metrics.get("an_vs_gt")
-                r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_bounding_box=image_data.get("annotated_bounding_box"), \
-                    ground_truth_bounding_box=image_data.get("ground_truth_bounding_box"))
-                an_vs_gt["bb_iou"] = get_bounding_box_iou_helper(r)
-                an_vs_gt["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-                an_vs_gt["bb_number_of_changes"] = get_bounding_box_number_of_changes_helper(r)
-
-            if image_data.get("annotated_polygon") is not None and image_data.get("ground_truth_polygon") is not None:
-                an_vs_gt = image_metrics.get("an_vs_gt")
-                r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_polygon=image_data.get("annotated_polygon"), \
-                    ground_truth_polygon=image_data.get("ground_truth_polygon"))
-                an_vs_gt["p_iou"] = get_polygon_iou_helper(r)
-                an_vs_gt["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-                an_vs_gt["p_number_of_changes"] = get_polygon_number_of_changes_helper(r)
-
-            # an_vs_pd
-            if image_data.get("annotated_bounding_box") is not None and image_data.get("predicted_bounding_box") is not None:
-                an_vs_pd = image_metrics.get("an_vs_pd")
-                r = GetBoundingBoxMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_bounding_box=image_data.get("predicted_bounding_box"), \
-                    ground_truth_bounding_box=image_data.get("annotated_bounding_box"))
-                an_vs_pd["bb_iou"] = get_bounding_box_iou_helper(r)
-                an_vs_pd["bb_percentage_area_change"] = get_bounding_box_percentage_area_change_helper(r)
-
-            if image_data.get("annotated_polygon") is not None and image_data.get("predicted_polygon") is not None:
-                an_vs_pd = image_metrics.get("an_vs_pd")
-                r = GetPolygonMetricsRequest(image_id=image_data.get("image_id"), \
-                    predicted_polygon=image_data.get("predicted_polygon"), \
-                    ground_truth_polygon=image_data.get("annotated_polygon"))
-                an_vs_pd["p_iou"] = get_polygon_iou_helper(r)
-                an_vs_pd["p_percentage_area_change"] = get_polygon_percentage_area_change_helper(r)
-
-    save_state_helper()
-
-def compute_statistics_helper():
-    global data
-    load_state_helper()
-
-    overall_pd_vs_gt_bb_min_iou = 2
-    overall_pd_vs_gt_bb_max_iou = -1
-    overall_pd_vs_gt_bb_sum_iou = 0
-    overall_pd_vs_gt_bb_min_percentage_area_change = 200
-    overall_pd_vs_gt_bb_max_percentage_area_change = -1
-    overall_pd_vs_gt_bb_sum_percentage_area_change = 0
-    overall_pd_vs_gt_bb_min_number_of_changes = 10000
-    overall_pd_vs_gt_bb_max_number_of_changes = -1
-    overall_pd_vs_gt_bb_sum_number_of_changes = 0
-    overall_pd_vs_gt_p_min_iou = 2
-    overall_pd_vs_gt_p_max_iou = -1
-    overall_pd_vs_gt_p_sum_iou = 0
-    overall_pd_vs_gt_p_min_percentage_area_change = 200
-    overall_pd_vs_gt_p_max_percentage_area_change = -1
-    overall_pd_vs_gt_p_sum_percentage_area_change = 0
-    overall_pd_vs_gt_p_min_number_of_changes = 10000
-    overall_pd_vs_gt_p_max_number_of_changes = -1
-    overall_pd_vs_gt_p_sum_number_of_changes = 0
-
-    overall_an_vs_gt_bb_min_iou = 2
-    overall_an_vs_gt_bb_max_iou = -1
-    overall_an_vs_gt_bb_sum_iou = 0
-    overall_an_vs_gt_bb_min_percentage_area_change = 200
-    overall_an_vs_gt_bb_max_percentage_area_change = -1
-    overall_an_vs_gt_bb_sum_percentage_area_change = 0
-    overall_an_vs_gt_bb_min_number_of_changes = 10000
-    overall_an_vs_gt_bb_max_number_of_changes = -1
-    overall_an_vs_gt_bb_sum_number_of_changes = 0
-    overall_an_vs_gt_p_min_iou = 2
-    overall_an_vs_gt_p_max_iou = -1
-    overall_an_vs_gt_p_sum_iou = 0
-    overall_an_vs_gt_p_min_percentage_area_change = 200
-    overall_an_vs_gt_p_max_percentage_area_change = -1
-    overall_an_vs_gt_p_sum_percentage_area_change = 0
-    overall_an_vs_gt_p_min_number_of_changes = 10000
-    overall_an_vs_gt_p_max_number_of_changes = -1
-    overall_an_vs_gt_p_sum_number_of_changes = 0
-
-    overall_an_vs_pd_bb_min_iou = 2
-    overall_an_vs_pd_bb_max_iou = -1
-    overall_an_vs_pd_bb_sum_iou = 0
-    overall_an_vs_pd_bb_min_percentage_area_change = 200
-    overall_an_vs_pd_bb_max_percentage_area_change = -1
-    overall_an_vs_pd_bb_sum_percentage_area_change = 0
-    overall_an_vs_pd_bb_min_number_of_changes = 10000
-    overall_an_vs_pd_bb_max_number_of_changes = -1
-    overall_an_vs_pd_bb_sum_number_of_changes = 0
-    overall_an_vs_pd_p_min_iou = 2
-    overall_an_vs_pd_p_max_iou = -1
-    overall_an_vs_pd_p_sum_iou = 0
-    overall_an_vs_pd_p_min_percentage_area_change = 200
-    overall_an_vs_pd_p_max_percentage_area_change = -1
-    overall_an_vs_pd_p_sum_percentage_area_change = 0
-    overall_an_vs_pd_p_min_number_of_changes = 10000
-    overall_an_vs_pd_p_max_number_of_changes = -1
-    overall_an_vs_pd_p_sum_number_of_changes = 0
-    overall_count = 0
-
-    for class_id, class_data in data.items():
-        pd_vs_gt_bb_min_iou = 2
-        pd_vs_gt_bb_max_iou = -1
-        pd_vs_gt_bb_sum_iou = 0
-        pd_vs_gt_bb_min_percentage_area_change = 200
-        pd_vs_gt_bb_max_percentage_area_change = -1
-        pd_vs_gt_bb_sum_percentage_area_change = 0
-        pd_vs_gt_bb_min_number_of_changes = 10000
-        pd_vs_gt_bb_max_number_of_changes = -1
-        pd_vs_gt_bb_sum_number_of_changes = 0
-        pd_vs_gt_p_min_iou = 2
-        pd_vs_gt_p_max_iou = -1
-        pd_vs_gt_p_sum_iou = 0
-        pd_vs_gt_p_min_percentage_area_change = 200
-        pd_vs_gt_p_max_percentage_area_change = -1
-        pd_vs_gt_p_sum_percentage_area_change = 0
-        pd_vs_gt_p_min_number_of_changes = 10000
-        pd_vs_gt_p_max_number_of_changes = -1
-        pd_vs_gt_p_sum_number_of_changes = 0
-
-        an_vs_gt_bb_min_iou = 2
-        an_vs_gt_bb_max_iou = -1
-        an_vs_gt_bb_sum_iou = 0
-        an_vs_gt_bb_min_percentage_area_change = 200
-        an_vs_gt_bb_max_percentage_area_change = -1
-        an_vs_gt_bb_sum_percentage_area_change = 0
-        an_vs_gt_bb_min_number_of_changes = 10000
-        an_vs_gt_bb_max_number_of_changes = -1
-        an_vs_gt_bb_sum_number_of_changes = 0
-        an_vs_gt_p_min_iou = 2
-        an_vs_gt_p_max_iou = -1
-        an_vs_gt_p_sum_iou = 0
-        an_vs_gt_p_min_percentage_area_change = 200
-        an_vs_gt_p_max_percentage_area_change = -1
-        an_vs_gt_p_sum_percentage_area_change = 0
-        an_vs_gt_p_min_number_of_changes = 10000
-        an_vs_gt_p_max_number_of_changes = -1
-        an_vs_gt_p_sum_number_of_changes = 0
-
-        an_vs_pd_bb_min_iou = 2
-        an_vs_pd_bb_max_iou = -1
-        an_vs_pd_bb_sum_iou = 0
-        an_vs_pd_bb_min_percentage_area_change = 200
-        an_vs_pd_bb_max_percentage_area_change = -1
-        an_vs_pd_bb_sum_percentage_area_change = 0
-        an_vs_pd_bb_min_number_of_changes = 10000
-        an_vs_pd_bb_max_number_of_changes = -1
-        an_vs_pd_bb_sum_number_of_changes = 0
-        an_vs_pd_p_min_iou = 2
-        an_vs_pd_p_max_iou = -1
-        an_vs_pd_p_sum_iou = 0
-        an_vs_pd_p_min_percentage_area_change = 200
-        an_vs_pd_p_max_percentage_area_change = -1
-        an_vs_pd_p_sum_percentage_area_change = 0
-        an_vs_pd_p_min_number_of_changes = 10000
-        an_vs_pd_p_max_number_of_changes = -1
-        an_vs_pd_p_sum_number_of_changes = 0
-        count = 0
-
-        for _, image_data in class_data.items():
-            count += 1
-            overall_count += 1
-            metrics = image_data.get("metrics")
-            pd_vs_gt = metrics.get("pd_vs_gt")
-            pd_vs_gt_bb_min_iou = min(pd_vs_gt.get("bb_iou"), pd_vs_gt_bb_min_iou)
-            pd_vs_gt_bb_max_iou = max(pd_vs_gt.get("bb_iou"), pd_vs_gt_bb_max_iou)
-            pd_vs_gt_bb_sum_iou += pd_vs_gt.get("bb_iou")
-            pd_vs_gt_bb_min_percentage_area_change = min(pd_vs_gt.get("bb_percentage_area_change"), pd_vs_gt_bb_min_percentage_area_change)
-            pd_vs_gt_bb_max_percentage_area_change = max(pd_vs_gt.get("bb_percentage_area_change"), pd_vs_gt_bb_max_percentage_area_change)
-            pd_vs_gt_bb_sum_percentage_area_change += pd_vs_gt.get("bb_percentage_area_change")
-            pd_vs_gt_bb_min_number_of_changes = min(pd_vs_gt.get("bb_number_of_changes"), pd_vs_gt_bb_min_number_of_changes)
-            pd_vs_gt_bb_max_number_of_changes = max(pd_vs_gt.get("bb_number_of_changes"), pd_vs_gt_bb_max_number_of_changes)
-            pd_vs_gt_bb_sum_number_of_changes += pd_vs_gt.get("bb_number_of_changes")
-            pd_vs_gt_p_min_iou = min(pd_vs_gt.get("p_iou"), pd_vs_gt_p_min_iou)
-            pd_vs_gt_p_max_iou = max(pd_vs_gt.get("p_iou"), pd_vs_gt_p_max_iou)
-            pd_vs_gt_p_sum_iou += pd_vs_gt.get("p_iou")
-            pd_vs_gt_p_min_percentage_area_change = min(pd_vs_gt.get("p_percentage_area_change"), pd_vs_gt_p_min_percentage_area_change)
-            pd_vs_gt_p_max_percentage_area_change = max(pd_vs_gt.get("p_percentage_area_change"), pd_vs_gt_p_max_percentage_area_change)
-            pd_vs_gt_p_sum_percentage_area_change += pd_vs_gt.get("p_percentage_area_change")
-            pd_vs_gt_p_min_number_of_changes = min(pd_vs_gt.get("p_number_of_changes"), pd_vs_gt_p_min_number_of_changes)
-            pd_vs_gt_p_max_number_of_changes = max(pd_vs_gt.get("p_number_of_changes"), pd_vs_gt_p_max_number_of_changes)
-            pd_vs_gt_p_sum_number_of_changes += pd_vs_gt.get("p_number_of_changes")
-
-            overall_pd_vs_gt_bb_min_iou = min(pd_vs_gt.get("bb_iou"), overall_pd_vs_gt_bb_min_iou)
-            overall_pd_vs_gt_bb_max_iou = max(pd_vs_gt.get("bb_iou"), overall_pd_vs_gt_bb_max_iou)
-            overall_pd_vs_gt_bb_sum_iou += pd_vs_gt.get("bb_iou")
-            overall_pd_vs_gt_bb_min_percentage_area_change = min(pd_vs_gt.get("bb_percentage_area_change"), overall_pd_vs_gt_bb_min_percentage_area_change)
-            overall_pd_vs_gt_bb_max_percentage_area_change = max(pd_vs_gt.get("bb_percentage_area_change"), overall_pd_vs_gt_bb_max_percentage_area_change)
-            overall_pd_vs_gt_bb_sum_percentage_area_change += pd_vs_gt.get("bb_percentage_area_change")
-            overall_pd_vs_gt_bb_min_number_of_changes = min(pd_vs_gt.get("bb_number_of_changes"), overall_pd_vs_gt_bb_min_number_of_changes)
-            overall_pd_vs_gt_bb_max_number_of_changes = max(pd_vs_gt.get("bb_number_of_changes"), overall_pd_vs_gt_bb_max_number_of_changes)
-            overall_pd_vs_gt_bb_sum_number_of_changes += pd_vs_gt.get("bb_number_of_changes")
-            overall_pd_vs_gt_p_min_iou = min(pd_vs_gt.get("p_iou"), overall_pd_vs_gt_p_min_iou)
-            overall_pd_vs_gt_p_max_iou = max(pd_vs_gt.get("p_iou"), overall_pd_vs_gt_p_max_iou)
-            overall_pd_vs_gt_p_sum_iou += pd_vs_gt.get("p_iou")
-            overall_pd_vs_gt_p_min_percentage_area_change = min(pd_vs_gt.get("p_percentage_area_change"), overall_pd_vs_gt_p_min_percentage_area_change)
-            overall_pd_vs_gt_p_max_percentage_area_change = max(pd_vs_gt.get("p_percentage_area_change"), overall_pd_vs_gt_p_max_percentage_area_change)
-            overall_pd_vs_gt_p_sum_percentage_area_change += pd_vs_gt.get("p_percentage_area_change")
-            overall_pd_vs_gt_p_min_number_of_changes = min(pd_vs_gt.get("p_number_of_changes"), overall_pd_vs_gt_p_min_number_of_changes)
-            overall_pd_vs_gt_p_max_number_of_changes = max(pd_vs_gt.get("p_number_of_changes"), overall_pd_vs_gt_p_max_number_of_changes)
-            overall_pd_vs_gt_p_sum_number_of_changes += pd_vs_gt.get("p_number_of_changes")
-
-            an_vs_gt = metrics.get("an_vs_gt")
-            an_vs_gt_bb_min_iou = min(an_vs_gt.get("bb_iou"), an_vs_gt_bb_min_iou)
-            an_vs_gt_bb_max_iou = max(an_vs_gt.get("bb_iou"), an_vs_gt_bb_max_iou)
-            an_vs_gt_bb_sum_iou += an_vs_gt.get("bb_iou")
-            an_vs_gt_bb_min_percentage_area_change = min(an_vs_gt.get("bb_percentage_area_change"), an_vs_gt_bb_min_percentage_area_change)
-            an_vs_gt_bb_max_percentage_area_change = max(an_vs_gt.get("bb_percentage_area_change"), an_vs_gt_bb_max_percentage_area_change)
-            an_vs_gt_bb_sum_percentage_area_change += an_vs_gt.get("bb_percentage_area_change")
-            an_vs_gt_bb_min_number_of_changes = min(an_vs_gt.get("bb_number_of_changes"), an_vs_gt_bb_min_number_of_changes)
-            an_vs_gt_bb_max_number_of_changes = max(an_vs_gt.get("bb_number_of_changes"), an_vs_gt_bb_max_number_of_changes)
-            an_vs_gt_bb_sum_number_of_changes += an_vs_gt.get("bb_number_of_changes")
-            an_vs_gt_p_min_iou = min(an_vs_gt.get("p_iou"), an_vs_gt_p_min_iou)
-            an_vs_gt_p_max_iou = max(an_vs_gt.get("p_iou"), an_vs_gt_p_max_iou)
-            an_vs_gt_p_sum_iou += an_vs_gt.get("p_iou")
-            an_vs_gt_p_min_percentage_area_change = min(an_vs_gt.get("p_percentage_area_change"), an_vs_gt_p_min_percentage_area_change)
-            an_vs_gt_p_max_percentage_area_change = max(an_vs_gt.get("p_percentage_area_change"), an_vs_gt_p_max_percentage_area_change)
-            an_vs_gt_p_sum_percentage_area_change += an_vs_gt.get("p_percentage_area_change")
-            an_vs_gt_p_min_number_of_changes = min(an_vs_gt.get("p_number_of_changes"), an_vs_gt_p_min_number_of_changes)
-            an_vs_gt_p_max_number_of_changes = max(an_vs_gt.get("p_number_of_changes"), an_vs_gt_p_max_number_of_changes)
-            an_vs_gt_p_sum_number_of_changes += an_vs_gt.get("p_number_of_changes")
-
-            overall_an_vs_gt_bb_min_iou = min(an_vs_gt.get("bb_iou"), overall_an_vs_gt_bb_min_iou)
-            overall_an_vs_gt_bb_max_iou = max(an_vs_gt.get("bb_iou"), overall_an_vs_gt_bb_max_iou)
-            overall_an_vs_gt_bb_sum_iou += an_vs_gt.get("bb_iou")
-            overall_an_vs_gt_bb_min_percentage_area_change = min(an_vs_gt.get("bb_percentage_area_change"), overall_an_vs_gt_bb_min_percentage_area_change)
-            overall_an_vs_gt_bb_max_percentage_area_change = max(an_vs_gt.get("bb_percentage_area_change"), overall_an_vs_gt_bb_max_percentage_area_change)
-            overall_an_vs_gt_bb_sum_percentage_area_change += an_vs_gt.get("bb_percentage_area_change")
-            overall_an_vs_gt_bb_min_number_of_changes = min(an_vs_gt.get("bb_number_of_changes"), overall_an_vs_gt_bb_min_number_of_changes)
-            overall_an_vs_gt_bb_max_number_of_changes = max(an_vs_gt.get("bb_number_of_changes"), overall_an_vs_gt_bb_max_number_of_changes)
-            overall_an_vs_gt_bb_sum_number_of_changes += an_vs_gt.get("bb_number_of_changes")
-            overall_an_vs_gt_p_min_iou = min(an_vs_gt.get("p_iou"), overall_an_vs_gt_p_min_iou)
-            overall_an_vs_gt_p_max_iou = max(an_vs_gt.get("p_iou"), overall_an_vs_gt_p_max_iou)
-            overall_an_vs_gt_p_sum_iou += an_vs_gt.get("p_iou")
-            overall_an_vs_gt_p_min_percentage_area_change = min(an_vs_gt.get("p_percentage_area_change"), overall_an_vs_gt_p_min_percentage_area_change)
-            overall_an_vs_gt_p_max_percentage_area_change = max(an_vs_gt.get("p_percentage_area_change"), overall_an_vs_gt_p_max_percentage_area_change)
-            overall_an_vs_gt_p_sum_percentage_area_change += an_vs_gt.get("p_percentage_area_change")
-            overall_an_vs_gt_p_min_number_of_changes = min(an_vs_gt.get("p_number_of_changes"), overall_an_vs_gt_p_min_number_of_changes)
-            overall_an_vs_gt_p_max_number_of_changes = max(an_vs_gt.get("p_number_of_changes"), overall_an_vs_gt_p_max_number_of_changes)
-            overall_an_vs_gt_p_sum_number_of_changes += an_vs_gt.get("p_number_of_changes")
-
-            an_vs_pd = metrics.get("an_vs_pd")
-            an_vs_pd_bb_min_iou = min(an_vs_pd.get("bb_iou"), an_vs_pd_bb_min_iou)
-            an_vs_pd_bb_max_iou = max(an_vs_pd.get("bb_iou"), an_vs_pd_bb_max_iou)
-            an_vs_pd_bb_sum_iou += an_vs_pd.get("bb_iou")
-            an_vs_pd_bb_min_percentage_area_change = min(an_vs_pd.get("bb_percentage_area_change"), an_vs_pd_bb_min_percentage_area_change)
-            an_vs_pd_bb_max_percentage_area_change = max(an_vs_pd.get("bb_percentage_area_change"), an_vs_pd_bb_max_percentage_area_change)
-            an_vs_pd_bb_sum_percentage_area_change += an_vs_pd.get("bb_percentage_area_change")
-            an_vs_pd_bb_min_number_of_changes = min(an_vs_pd.get("bb_number_of_changes"), an_vs_pd_bb_min_number_of_changes)
-            an_vs_pd_bb_max_number_of_changes = max(an_vs_pd.get("bb_number_of_changes"), an_vs_pd_bb_max_number_of_changes)
-            an_vs_pd_bb_sum_number_of_changes += an_vs_pd.get("bb_number_of_changes")
-            an_vs_pd_p_min_iou = min(an_vs_pd.get("p_iou"), an_vs_pd_p_min_iou)
-            an_vs_pd_p_max_iou = max(an_vs_pd.get("p_iou"), an_vs_pd_p_max_iou)
-            an_vs_pd_p_sum_iou += an_vs_pd.get("p_iou")
-            an_vs_pd_p_min_percentage_area_change = min(an_vs_pd.get("p_percentage_area_change"), an_vs_pd_p_min_percentage_area_change)
-            an_vs_pd_p_max_percentage_area_change = max(an_vs_pd.get("p_percentage_area_change"), an_vs_pd_p_max_percentage_area_change)
-            an_vs_pd_p_sum_percentage_area_change += an_vs_pd.get("p_percentage_area_change")
-            an_vs_pd_p_min_number_of_changes = min(an_vs_pd.get("p_number_of_changes"), an_vs_pd_p_min_number_of_changes)
-            an_vs_pd_p_max_number_of_changes = max(an_vs_pd.get("p_number_of_changes"), an_vs_pd_p_max_number_of_changes)
-            an_vs_pd_p_sum_number_of_changes += an_vs_pd.get("p_number_of_changes")
-
-            overall_an_vs_pd_bb_min_iou = min(an_vs_pd.get("bb_iou"), overall_an_vs_pd_bb_min_iou)
-            overall_an_vs_pd_bb_max_iou = max(an_vs_pd.get("bb_iou"), overall_an_vs_pd_bb_max_iou)
-            overall_an_vs_pd_bb_sum_iou += an_vs_pd.get("bb_iou")
-            overall_an_vs_pd_bb_min_percentage_area_change = min(an_vs_pd.get("bb_percentage_area_change"), overall_an_vs_pd_bb_min_percentage_area_change)
-            overall_an_vs_pd_bb_max_percentage_area_change = max(an_vs_pd.get("bb_percentage_area_change"), overall_an_vs_pd_bb_max_percentage_area_change)
-            overall_an_vs_pd_bb_sum_percentage_area_change += an_vs_pd.get("bb_percentage_area_change")
-            overall_an_vs_pd_bb_min_number_of_changes = min(an_vs_pd.get("bb_number_of_changes"), overall_an_vs_pd_bb_min_number_of_changes)
-            overall_an_vs_pd_bb_max_number_of_changes = max(an_vs_pd.get("bb_number_of_changes"), overall_an_vs_pd_bb_max_number_of_changes)
-            overall_an_vs_pd_bb_sum_number_of_changes += an_vs_pd.get("bb_number_of_changes")
-            overall_an_vs_pd_p_min_iou = min(an_vs_pd.get("p_iou"), overall_an_vs_pd_p_min_iou)
-            overall_an_vs_pd_p_max_iou = max(an_vs_pd.get("p_iou"), overall_an_vs_pd_p_max_iou)
-            overall_an_vs_pd_p_sum_iou += an_vs_pd.get("p_iou")
-            overall_an_vs_pd_p_min_percentage_area_change = min(an_vs_pd.get("p_percentage_area_change"), overall_an_vs_pd_p_min_percentage_area_change)
-            overall_an_vs_pd_p_max_percentage_area_change = max(an_vs_pd.get("p_percentage_area_change"), overall_an_vs_pd_p_max_percentage_area_change)
-            overall_an_vs_pd_p_sum_percentage_area_change += an_vs_pd.get("p_percentage_area_change")
-            overall_an_vs_pd_p_min_number_of_changes = min(an_vs_pd.get("p_number_of_changes"), overall_an_vs_pd_p_min_number_of_changes)
-            overall_an_vs_pd_p_max_number_of_changes = max(an_vs_pd.get("p_number_of_changes"), overall_an_vs_pd_p_max_number_of_changes)
-            overall_an_vs_pd_p_sum_number_of_changes += an_vs_pd.get("p_number_of_changes")
-
-        if count > 0:
-            print(f"Statistics for class id: {class_id}")
-            print(f"pd_vs_gt bounding box iou, min = {pd_vs_gt_bb_min_iou}, max = {pd_vs_gt_bb_max_iou}, avg = {pd_vs_gt_bb_sum_iou/count}")
-            print(f"pd_vs_gt bounding box percentage area change, min = {pd_vs_gt_bb_min_percentage_area_change}, max = {pd_vs_gt_bb_max_percentage_area_change}, avg = {pd_vs_gt_bb_sum_percentage_area_change/count}")
-            print(f"pd_vs_gt bounding box number of changes, min = {pd_vs_gt_bb_min_number_of_changes}, max = {pd_vs_gt_bb_max_number_of_changes}, avg = {pd_vs_gt_bb_sum_number_of_changes/count}")
-            print(f"pd_vs_gt polygon iou, min = {pd_vs_gt_p_min_iou}, max = {pd_vs_gt_p_max_iou}, avg = {pd_vs_gt_p_sum_iou/count}")
-            print(f"pd_vs_gt polygon percentage area change, min = {pd_vs_gt_p_min_percentage_area_change}, max = {pd_vs_gt_p_max_percentage_area_change}, avg = {pd_vs_gt_p_sum_percentage_area_change/count}")
-            print(f"pd_vs_gt polygon number of changes, min = {pd_vs_gt_p_min_number_of_changes}, max = {pd_vs_gt_p_max_number_of_changes}, avg = {pd_vs_gt_p_sum_number_of_changes/count}")
-
-            print(f"an_vs_gt bounding box iou, min = {an_vs_gt_bb_min_iou}, max = {an_vs_gt_bb_max_iou}, avg = {an_vs_gt_bb_sum_iou/count}")
-            print(f"an_vs_gt bounding box percentage area change, min = {an_vs_gt_bb_min_percentage_area_change}, max = {an_vs_gt_bb_max_percentage_area_change}, avg = {an_vs_gt_bb_sum_percentage_area_change/count}")
-            print(f"an_vs_gt bounding box number of changes, min = {an_vs_gt_bb_min_number_of_changes}, max = {an_vs_gt_bb_max_number_of_changes}, avg = {an_vs_gt_bb_sum_number_of_changes/count}")
-            print(f"an_vs_gt polygon iou, min = {an_vs_gt_p_min_iou}, max = {an_vs_gt_p_max_iou}, avg = {an_vs_gt_p_sum_iou/count}")
-            print(f"an_vs_gt polygon percentage area change, min = {an_vs_gt_p_min_percentage_area_change}, max = {an_vs_gt_p_max_percentage_area_change}, avg = {an_vs_gt_p_sum_percentage_area_change/count}")
-            print(f"an_vs_gt polygon number of changes, min = {an_vs_gt_p_min_number_of_changes}, max = {an_vs_gt_p_max_number_of_changes}, avg = {an_vs_gt_p_sum_number_of_changes/count}")
-
-            print(f"an_vs_pd bounding box iou, min = {an_vs_pd_bb_min_iou}, max = {an_vs_pd_bb_max_iou}, avg = {an_vs_pd_bb_sum_iou/count}")
-            print(f"an_vs_pd bounding box percentage area change, min = {an_vs_pd_bb_min_percentage_area_change}, max = {an_vs_pd_bb_max_percentage_area_change}, avg = {an_vs_pd_bb_sum_percentage_area_change/count}")
-            print(f"an_vs_pd bounding box number of changes, min = {an_vs_pd_bb_min_number_of_changes}, max = {an_vs_pd_bb_max_number_of_changes}, avg = {an_vs_pd_bb_sum_number_of_changes/count}")
-            print(f"an_vs_pd polygon iou, min = {an_vs_pd_p_min_iou}, max = {an_vs_pd_p_max_iou}, avg = {an_vs_pd_p_sum_iou/count}")
-            print(f"an_vs_pd polygon percentage area change, min = {an_vs_pd_p_min_percentage_area_change}, max = {an_vs_pd_p_max_percentage_area_change}, avg = {an_vs_pd_p_sum_percentage_area_change/count}")
-            print(f"an_vs_pd polygon number of changes, min = {an_vs_pd_p_min_number_of_changes}, max = {an_vs_pd_p_max_number_of_changes}, avg = {an_vs_pd_p_sum_number_of_changes/count}")
-
-    if overall_count > 0:
+        image_data["metrics"] = compute_metrics(image_data, an_vs_pd_changes=(req.result.bounding_box_changes, req.result.polygon_changes))
+        image_data["metrics_version"] = METRICS_VERSION
+        annotation_store.upsert(class_id, req.image_file_name, image_data)
+        metrics_statistics.observe(class_id, req.image_file_name, image_data["metrics"])
+
+def preannotate_helper(job, req: PreannotateRequest):
+    """Fills the detection caches for every image matching req.images."""
+    paths = preannotate.list_images(req.images)
+    processed = preannotate.preannotate(paths, yolo, bounding_boxes_cache,
+                                        mask_rcnn if req.masks else None,
+                                        batch_size=PREANNOTATE_BATCH_SIZE,
+                                        progress=job.report)
+
+    return {"images": len(paths), "processed": processed}
+
+def recalculate_metrics_helper(job=None, full=False):
+    """Recomputes the metrics of dirty records (all records when full) in worker processes."""
+    progress = job.report if job is not None else None
+    # a cancelled or failed run may already have written some chunks
+    updated = True
+    try:
+        summary = recalculate_metrics(annotation_store, METRICS_VERSION, full=full,
+                                      workers=RECALCULATE_WORKERS, chunk_size=RECALCULATE_CHUNK_SIZE,
+                                      progress=progress)
+        updated = summary["updated"] > 0
+    finally:
+        if updated:
+            metrics_statistics.invalidate()
+
+    return summary
+
+METRIC_LABELS = {
+    "bb_iou": "bounding box iou",
+    "bb_percentage_area_change": "bounding box percentage area change",
+    "bb_number_of_changes": "bounding box number of changes",
+    "p_iou": "polygon iou",
+    "p_percentage_area_change": "polygon percentage area change",
+    "p_number_of_changes": "polygon number of changes",
+}
+
+def print_statistics(stats, prefix=""):
+    for comparison in COMPARISONS:
+        for metric in METRICS:
+            m = stats.get(comparison, {}).get(metric)
+            if m is not None:
+                print(f"{prefix}{comparison} {METRIC_LABELS[metric]}, min = {m['min']}, max = {m['max']}, avg = {m['avg']}")
+
+def compute_statistics_helper(job=None):
+    statistics = metrics_statistics.snapshot()
+
+    for class_id, class_stats in statistics["classes"].items():
+        print(f"Statistics for class id: {class_id}")
+        print_statistics(class_stats)
+
+    if statistics["overall"]:
         print(f"Statistics for overall:")
-        print(f"overall pd_vs_gt bounding box iou, min = {overall_pd_vs_gt_bb_min_iou}, max = {overall_pd_vs_gt_bb_max_iou}, avg = {overall_pd_vs_gt_bb_sum_iou/overall_count}")
-        print(f"overall pd_vs_gt bounding box percentage area change, min = {overall_pd_vs_gt_bb_min_percentage_area_change}, max = {overall_pd_vs_gt_bb_max_percentage_area_change}, avg = {overall_pd_vs_gt_bb_sum_percentage_area_change/overall_count}")
-        print(f"overall pd_vs_gt bounding box number of changes, min = {overall_pd_vs_gt_bb_min_number_of_changes}, max = {overall_pd_vs_gt_bb_max_number_of_changes}, avg = {overall_pd_vs_gt_bb_sum_number_of_changes/overall_count}")
-        print(f"overall pd_vs_gt polygon iou, min = {overall_pd_vs_gt_p_min_iou}, max = {overall_pd_vs_gt_p_max_iou}, avg = {overall_pd_vs_gt_p_sum_iou/overall_count}")
-        print(f"overall pd_vs_gt polygon percentage area change, min = {overall_pd_vs_gt_p_min_percentage_area_change}, max = {overall_pd_vs_gt_p_max_percentage_area_change}, avg = {overall_pd_vs_gt_p_sum_percentage_area_change/overall_count}")
-        print(f"overall pd_vs_gt polygon number of changes, min = {overall_pd_vs_gt_p_min_number_of_changes}, max = {overall_pd_vs_gt_p_max_number_of_changes}, avg = {overall_pd_vs_gt_p_sum_number_of_changes/overall_count}")
-
-        print(f"overall an_vs_gt bounding box iou, min = {overall_an_vs_gt_bb_min_iou}, max = {overall_an_vs_gt_bb_max_iou}, avg = {overall_an_vs_gt_bb_sum_iou/overall_count}")
-        print(f"overall an_vs_gt bounding box percentage area change, min = {overall_an_vs_gt_bb_min_percentage_area_change}, max = {overall_an_vs_gt_bb_max_percentage_area_change}, avg = {overall_an_vs_gt_bb_sum_percentage_area_change/overall_count}")
-        print(f"overall an_vs_gt bounding box number of changes, min = {overall_an_vs_gt_bb_min_number_of_changes}, max = {overall_an_vs_gt_bb_max_number_of_changes}, avg = {overall_an_vs_gt_bb_sum_number_of_changes/overall_count}")
-        print(f"overall an_vs_gt polygon iou, min = {overall_an_vs_gt_p_min_iou}, max = {overall_an_vs_gt_p_max_iou}, avg = {overall_an_vs_gt_p_sum_iou/overall_count}")
-        print(f"overall an_vs_gt polygon percentage area change, min = {overall_an_vs_gt_p_min_percentage_area_change}, max = {overall_an_vs_gt_p_max_percentage_area_change}, avg = {overall_an_vs_gt_p_sum_percentage_area_change/overall_count}")
-        print(f"overall an_vs_gt polygon number of changes, min = {overall_an_vs_gt_p_min_number_of_changes}, max = {overall_an_vs_gt_p_max_number_of_changes}, avg = {overall_an_vs_gt_p_sum_number_of_changes/overall_count}")
-
-        print(f"overall an_vs_pd bounding box iou, min = {overall_an_vs_pd_bb_min_iou}, max = {overall_an_vs_pd_bb_max_iou}, avg = {overall_an_vs_pd_bb_sum_iou/overall_count}")
-        print(f"overall an_vs_pd bounding box percentage area change, min = {overall_an_vs_pd_bb_min_percentage_area_change}, max = {overall_an_vs_pd_bb_max_percentage_area_change}, avg = {overall_an_vs_pd_bb_sum_percentage_area_change/overall_count}")
-        print(f"overall an_vs_pd bounding box number of changes, min = {overall_an_vs_pd_bb_min_number_of_changes}, max = {overall_an_vs_pd_bb_max_number_of_changes}, avg = {overall_an_vs_pd_bb_sum_number_of_changes/overall_count}")
-        print(f"overall an_vs_pd polygon iou, min = {overall_an_vs_pd_p_min_iou}, max = {overall_an_vs_pd_p_max_iou}, avg = {overall_an_vs_pd_p_sum_iou/overall_count}")
-        print(f"overall an_vs_pd polygon percentage area change, min = {overall_an_vs_pd_p_min_percentage_area_change}, max = {overall_an_vs_pd_p_max_percentage_area_change}, avg = {overall_an_vs_pd_p_sum_percentage_area_change/overall_count}")
-        print(f"overall an_vs_pd polygon number of changes, min = {overall_an_vs_pd_p_min_number_of_changes}, max = {overall_an_vs_pd_p_max_number_of_changes}, avg = {overall_an_vs_pd_p_sum_number_of_changes/overall_count}")
+        print_statistics(statistics["overall"], prefix="overall ")
 
-def get_polygon_iou_helper(req: GetPolygonMetricsRequest):
-    ground_truth_points = [tuple(x) for x in req.ground_truth_polygon]
-    predicted_points = [tuple(x) for x in req.predicted_polygon]
-    ground_truth_polygon = Polygon(ground_truth_points)
-    predicted_polygon = Polygon(predicted_points)
-    iou = ground_truth_polygon.intersection(predicted_polygon).area / (ground_truth_polygon.union(predicted_polygon).area + 0.001)
+    return statistics
 
-    return iou
+def get_polygon_iou_helper(req: GetPolygonMetricsRequest):
+    return metrics.polygon_iou(req.predicted_polygon, req.ground_truth_polygon)
 
 def get_bounding_box_iou_helper(req: GetBoundingBoxMetricsRequest):
-    gt_tl = [req.ground_truth_bounding_box[0], req.ground_truth_bounding_box[1]]
-    gt_br = [req.ground_truth_bounding_box[2], req.ground_truth_bounding_box[3]]
-    ground_truth_points = [(gt_tl[0], gt_tl[1]), (gt_br[0], gt_tl[1]), (gt_br[0], gt_br[1]), (gt_tl[0], gt_br[1])]
-    p_tl = [req.predicted_bounding_box[0], req.predicted_bounding_box[1]]
-    p_br = [req.predicted_bounding_box[2], req.predicted_bounding_box[3]]
-    predicted_points = [(p_tl[0], p_tl[1]), (p_br[0], p_tl[1]), (p_br[0], p_br[1]), (p_tl[0], p_br[1])]
-
-    ground_truth_polygon = Polygon(ground_truth_points)
-    predicted_polygon = Polygon(predicted_points)
-    iou = ground_truth_polygon.intersection(predicted_polygon).area / (ground_truth_polygon.union(predicted_polygon).area + 0.001)
-
-    return iou
+    return metrics.bounding_box_iou(req.predicted_bounding_box, req.ground_truth_bounding_box)
 
 def get_polygon_number_of_changes_helper(req: GetPolygonMetricsRequest):
-    gtp = copy.deepcopy(req.ground_truth_polygon)
-    pp = copy.deepcopy(req.predicted_polygon)
-    count = 0
-    for p in req.predicted_polygon:
-        if p in req.ground_truth_polygon:
-            gtp.remove(p)
-            pp.remove(p)
-
-    count = max(len(gtp), len(pp))
-
-    return count
+    return metrics.polygon_number_of_changes(req.predicted_polygon, req.ground_truth_polygon)
 
 def get_bounding_box_number_of_changes_helper(req: GetPolygonMetricsRequest):
-    gt_tl = [req.ground_truth_bounding_box[0], req.ground_truth_bounding_box[1]]
-    gt_br = [req.ground_truth_bounding_box[2], req.ground_truth_bounding_box[3]]
-    gtp = [[gt_tl[0], gt_tl[1]], [gt_br[0], gt_tl[1]], [gt_br[0], gt_br[1]], [gt_tl[0], gt_br[1]]]
-    p_tl = [req.predicted_bounding_box[0], req.predicted_bounding_box[1]]
-    p_br = [req.predicted_bounding_box[2], req.predicted_bounding_box[3]]
-    pp = [[p_tl[0], p_tl[1]], [p_br[0], p_tl[1]], [p_br[0], p_br[1]], [p_tl[0], p_br[1]]]
-
-    count = 0
-    for p in copy.deepcopy(pp):
-        if p in copy.deepcopy(gtp):
-            gtp.remove(p)
-            pp.remove(p)
-
-    count = max(len(gtp), len(pp))
-
-    return count
+    return metrics.bounding_box_number_of_changes(req.predicted_bounding_box, req.ground_truth_bounding_box)
 
 def get_polygon_percentage_area_change_helper(req: GetPolygonMetricsRequest):
-    ground_truth_points = [tuple(x) for x in req.ground_truth_polygon]
-    predicted_points = [tuple(x) for x in req.predicted_polygon]
-    ground_truth_polygon = Polygon(ground_truth_points)
-    predicted_polygon = Polygon(predicted_points)
-    percentage_area_change = abs(ground_truth_polygon.area - predicted_polygon.area)*100 / ground_truth_polygon.area
-
-    return percentage_area_change
+    return metrics.polygon_percentage_area_change(req.predicted_polygon, req.ground_truth_polygon)
 
 def get_bounding_box_percentage_area_change_helper(req: GetBoundingBoxMetricsRequest):
-    gt_tl = [req.ground_truth_bounding_box[0], req.ground_truth_bounding_box[1]]
-    gt_br = [req.ground_truth_bounding_box[2], req.ground_truth_bounding_box[3]]
-    ground_truth_points = [(gt_tl[0], gt_tl[1]), (gt_br[0], gt_tl[1]), (gt_br[0], gt_br[1]), (gt_tl[0], gt_br[1])]
-    p_tl = [req.predicted_bounding_box[0], req.predicted_bounding_box[1]]
-    p_br = [req.predicted_bounding_box[2], req.predicted_bounding_box[3]]
-    predicted_points = [(p_tl[0], p_tl[1]), (p_br[0], p_tl[1]), (p_br[0], p_br[1]), (p_tl[0], p_br[1])]
-
-    ground_truth_polygon = Polygon(ground_truth_points)
-    predicted_polygon = Polygon(predicted_points)
-    percentage_area_change = abs(ground_truth_polygon.area - predicted_polygon.area)*100 / ground_truth_polygon.area
-
-    return percentage_area_change
-
-def load_state_helper():
-    global data
-    if not data and os.path.exists("./data.json"):
-        with open("./data.json") as json_file:
-            data = json.load(json_file)
-
-def save_state_helper():
-    global data
-    with open("./data.json", "w") as json_file:
-        json.dump(data, json_file)
\ No newline at end of file
+    return metrics.bounding_box_percentage_area_change(req.predicted_bounding_box, req.ground_truth_bounding_box)
+
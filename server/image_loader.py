@@ -0,0 +1,84 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from absl import logging
+
+from result_cache import content_hash
+
+
+class LoadedImage:
+    """One image file: its content hash and, once decoded, its RGB uint8 pixels."""
+    def __init__(self, path, content):
+        self.path = path
+        self.content_hash = content_hash(content)
+        self._content = content
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    @property
+    def pixels(self):
+        """[height, width, 3] RGB array, decoded on first use and shared read-only."""
+        with self._lock:
+            if self._pixels is None:
+                self._pixels = decode_image(self._content)
+                # the encoded bytes are not needed once decoded
+                self._content = None
+            return self._pixels
+
+
+def decode_image(content):
+    # EXIF orientation is ignored, like tf.image.decode_image and skimage.io.imread do
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8),
+                         cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError('cannot decode image')
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    image.flags.writeable = False
+
+    return image
+
+
+class ImageLoader:
+    """Reads and decodes each image file once for both models.
+
+    Entries are kept in an LRU of at most `max_entries` files keyed by path,
+    modification time and size, so a rewritten file is read again. The
+    content hash is computed when the file is read; pixels are decoded the
+    first time they are asked for, so a detection cache hit costs no decode.
+    """
+    def __init__(self, max_entries=32, name='image-loader'):
+        self.max_entries = max_entries
+        self.name = name
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        with open(path, 'rb') as f:
+            image = LoadedImage(path, f.read())
+        with self._lock:
+            self._entries[key] = image
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logging.debug('{}: loaded {}'.format(self.name, path))
+
+        return image
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,147 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from absl import logging
+
+from executors import BoundedExecutor
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's function by report() once cancellation was requested."""
+
+
+class Job:
+    """One background operation; its function reports progress through report()."""
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'queued'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.future = None
+        self._cancel_requested = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_requested.is_set()
+
+    def report(self, done, total=None):
+        """Records progress; raises JobCancelled when the job should stop."""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'progress': {'done': self.done, 'total': self.total},
+            'error': self.error,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobRunner:
+    """Runs long operations in the background so requests can return a job id.
+
+    submit(name, fn, *args) calls fn(job, *args) on a BoundedExecutor, so at
+    most `max_workers` jobs run at once and at most `max_queue` wait; beyond
+    that submit raises QueueFullError. Cancellation is cooperative: queued
+    jobs are dropped, running ones stop at their next report(). The newest
+    `max_finished` finished jobs are kept for status and result queries.
+    """
+    def __init__(self,
+                max_workers=2,
+                max_queue=8,
+                retry_after=5,
+                max_finished=100,
+                name='jobs'):
+        self.name = name
+        self.max_finished = max_finished
+
+        self._executor = BoundedExecutor(max_workers=max_workers,
+                                         max_queue=max_queue,
+                                         retry_after=retry_after,
+                                         name=name)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args):
+        job = Job(name)
+        with self._lock:
+            job.future = self._executor.submit(self._run, job, fn, args)
+            self._jobs[job.id] = job
+            self._prune()
+        logging.info('{}: queued job {} ({})'.format(self.name, job.id, name))
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        """All known jobs, newest first."""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def cancel(self, job_id):
+        """Requests cancellation; returns the job, or None for an unknown id."""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+
+        job._cancel_requested.set()
+        if job.future.cancel():
+            # never started
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+        logging.info('{}: cancel requested for job {} ({})'.format(self.name, job.id, job.name))
+
+        return job
+
+    def _run(self, job, fn, args):
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+            return
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job.result = fn(job, *args)
+            job.status = 'succeeded'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            logging.exception('{}: job {} ({}) failed'.format(self.name, job.id, job.name))
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+        logging.info('{}: job {} ({}) {}'.format(self.name, job.id, job.name, job.status))
+
+    def _prune(self):
+        # called with the lock held; drops the oldest finished jobs
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -1,6 +1,5 @@
-import time
-
-from fastapi import FastAPI, File, UploadFile, Request
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
@@ -8,12 +7,16 @@ from os.path import isfile
 from fastapi import Response
 from mimetypes import guess_type
 
+from executors import QueueFullError
+from mask_rcnn.maskrcnn_model import NoInstanceFound
+from uploads import UploadError, UploadTooLarge
 from helper import (
     GetBoundingBoxesRequest,
     GetObjectBoundaryRequest,
     GetPolygonMetricsRequest,
     GetBoundingBoxMetricsRequest,
     SubmitResultRequest,
+    PreannotateRequest,
     get_bounding_boxes_helper,
     get_bounding_box_iou_helper,
     get_bounding_box_percentage_area_change_helper,
@@ -23,11 +26,34 @@ from helper import (
     get_polygon_percentage_area_change_helper,
     submit_result_helper,
     compute_statistics_helper,
-    recalculate_metrics_helper
+    recalculate_metrics_helper,
+    yolo_executor,
+    mask_rcnn_executor,
+    bounding_boxes_cache,
+    upload_store,
+    UPLOAD_WARM_UP,
+    warm_up_upload_helper,
+    image_loader,
+    mask_rcnn,
+    metrics_statistics,
+    preannotate_helper,
+    jobs
 )
 
 app = FastAPI()
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, e: QueueFullError):
+    return JSONResponse(
+        status_code=503,
+        content={'message': str(e)},
+        headers={'Retry-After': str(e.retry_after)}
+    )
+
+@app.exception_handler(NoInstanceFound)
+async def no_instance_handler(request: Request, e: NoInstanceFound):
+    return JSONResponse(status_code=404, content={'message': str(e)})
+
 app.mount("/css", StaticFiles(directory="static/css"), name="static-css")
 app.mount("/scripts", StaticFiles(directory="static/scripts"), name="static-scripts")
 
@@ -51,8 +77,8 @@ async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post('/get_bounding_boxes')
-def get_bounding_boxes(req: GetBoundingBoxesRequest):
-    image_path, npboxes, classes = get_bounding_boxes_helper(req)
+async def get_bounding_boxes(req: GetBoundingBoxesRequest):
+    image_path, npboxes, classes = await yolo_executor.run(get_bounding_boxes_helper, req)
 
     return {
         'message': f'image id: {req.image_id}, image path: {image_path}',
@@ -60,9 +86,18 @@ def get_bounding_boxes(req: GetBoundingBoxesRequest):
         'classes': classes.tolist()
     }
 
+@app.get('/cache_stats')
+async def cache_stats():
+    return {
+        'bounding_boxes': bounding_boxes_cache.stats(),
+        'object_boundary': mask_rcnn.cache.stats(),
+        'object_detections': mask_rcnn.detections_cache.stats(),
+        'images': image_loader.stats()
+    }
+
 @app.post('/get_object_boundary')
-def get_object_boundary(req: GetObjectBoundaryRequest):
-    image_path, _, simple_mask_polygon = get_object_boundary_helper(req)
+async def get_object_boundary(req: GetObjectBoundaryRequest):
+    image_path, _, simple_mask_polygon = await mask_rcnn_executor.run(get_object_boundary_helper, req)
 
     return {
         'message': f'image id: {req.image_id}, image path: {image_path}',
@@ -78,19 +113,76 @@ def submit_result(req: SubmitResultRequest):
     }
 
 @app.post('/recalculate_metrics')
-def recalculate_metrics():
-    recalculate_metrics_helper()
+def recalculate_metrics(full: bool = False):
+    job = jobs.submit('recalculate_metrics', recalculate_metrics_helper, full)
 
     return {
-        'status': 'Success',
+        'status': 'Accepted',
+        'job_id': job.id
     }
 
+@app.get('/jobs')
+def list_jobs():
+    return [job.to_dict() for job in jobs.list()]
+
+@app.get('/jobs/{job_id}')
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={'message': f'unknown job id: {job_id}'})
+
+    return job.to_dict()
+
+@app.get('/jobs/{job_id}/result')
+def get_job_result(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={'message': f'unknown job id: {job_id}'})
+    if not job.finished:
+        return JSONResponse(status_code=409, content={'message': f'job is {job.status}', 'status': job.status})
+
+    return {
+        'status': job.status,
+        'result': job.result,
+        'error': job.error
+    }
+
+@app.post('/jobs/{job_id}/cancel')
+def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={'message': f'unknown job id: {job_id}'})
+
+    return job.to_dict()
+
 @app.post('/compute_statistics')
 def compute_statistics():
-    compute_statistics_helper()
+    job = jobs.submit('compute_statistics', compute_statistics_helper)
 
     return {
-        'status': 'Success',
+        'status': 'Accepted',
+        'job_id': job.id
+    }
+
+@app.get('/statistics')
+def get_statistics():
+    # current aggregates; only rescans when a resubmit or recalculation made them stale
+    return metrics_statistics.snapshot()
+
+@app.post('/preannotate')
+def preannotate(req: PreannotateRequest):
+    # the in-memory tiers would evict a large run's own results
+    missing = [name for name, cache in [('BOUNDING_BOXES_CACHE_DIR', bounding_boxes_cache),
+                                        ('MASK_RCNN_CACHE_DIR', mask_rcnn.cache if req.masks else None)]
+               if cache is not None and cache.disk_dir is None]
+    if missing:
+        return JSONResponse(status_code=400, content={
+            'message': 'pre-annotation writes to the on-disk caches; set {}'.format(' and '.join(missing))})
+    job = jobs.submit('preannotate', preannotate_helper, req)
+
+    return {
+        'status': 'Accepted',
+        'job_id': job.id
     }
 
 @app.post('/get_polygon_iou')
@@ -148,16 +240,19 @@ def get_bounding_box_percentage_area_change(req: GetBoundingBoxMetricsRequest):
     }
 
 @app.post('/upload_image')
-async def upload_image(file: UploadFile = File(...)):
-    print(file)
-
-    content = file.file.read()
-
-    # save file
-    fn = 'upload_{}_{}'.format(int(time.time()), file.filename)
-    with open(f'./data/{fn}', 'wb') as f:
-        f.write(content)
+async def upload_image(request: Request):
+    # the multipart body is parsed as it streams in, so the size cap holds without a content-length
+    try:
+        fn, duplicate = await upload_store.save(request)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={'message': str(e)})
+    except UploadError as e:
+        return JSONResponse(status_code=400, content={'message': str(e)})
+
+    if UPLOAD_WARM_UP and not duplicate:
+        warm_up_upload_helper(fn)
 
     return {
-        'filename': fn
+        'filename': fn,
+        'duplicate': duplicate
     }
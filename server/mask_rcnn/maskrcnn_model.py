@@ -2,66 +2,235 @@ import os
 import skimage.io
 import numpy as np
 import mask_rcnn.mrcnn.model as modellib
-from matplotlib import pyplot as plt
+from matplotlib import image as mpimg
+from matplotlib.figure import Figure
 from skimage.measure import find_contours, approximate_polygon
 
+from batching import MicroBatcher
+from debug_artifacts import DebugArtifacts
+from result_cache import ResultCache, content_hash, make_key
 from mask_rcnn.coco import coco
 from mask_rcnn.mrcnn import utils
 
+# cached in place of a boundary, so a box without an instance is not run again
+NO_INSTANCE = 'no-instance'
+
+
+class NoInstanceFound(Exception):
+    """Mask R-CNN found no instance of the class in the box."""
+
+
 class InferenceConfig(coco.CocoConfig):
-    # Set batch size to 1 since we'll be running inference on
-    # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
+    # Batch size = GPU_COUNT * IMAGES_PER_GPU. Defaults to one image at a
+    # time; the batcher builds the model for a larger batch and pads
+    # partial batches up to it.
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
 
+    def __init__(self, images_per_gpu=1):
+        self.IMAGES_PER_GPU = images_per_gpu
+        super().__init__()
+
+def pack_mask(mask):
+    # keep only the bounding rectangle of the set pixels, as packed bits
+    rows = np.where(np.any(mask, axis=1))[0]
+    cols = np.where(np.any(mask, axis=0))[0]
+    if len(rows) == 0:
+        return (mask.shape, (0, 0, 0, 0), np.packbits(np.zeros(0, dtype=bool)))
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    return (mask.shape, (y1, x1, y2, x2), np.packbits(mask[y1:y2, x1:x2]))
+
+def unpack_mask(packed_mask):
+    shape, (y1, x1, y2, x2), bits = packed_mask
+    mask = np.zeros(shape, dtype=bool)
+    region_shape = (y2 - y1, x2 - x1)
+    mask[y1:y2, x1:x2] = np.unpackbits(bits, count=region_shape[0] * region_shape[1]).reshape(region_shape)
+
+    return mask
+
 class MaskRCNNModel:
     def __init__(self,
                 i_classes='./config/coco.names',
                 i_weights='./mask_rcnn/model/mask_rcnn_coco.h5',
-                i_logs='./mask_rcnn/logs/'):
+                i_logs='./mask_rcnn/logs/',
+                i_batch_size=1,
+                i_batch_wait_ms=20,
+                i_cache_size=256,
+                i_cache_dir=None,
+                i_whole_image=False,
+                i_match_iou_threshold=0.5,
+                i_debug_artifacts=None):
         self.i_classes = i_classes
         self.i_weights = i_weights
         self.i_logs = i_logs
+        self.i_whole_image = i_whole_image
+        self.i_match_iou_threshold = i_match_iou_threshold
+        self.debug_artifacts = i_debug_artifacts or DebugArtifacts()
 
         # download model weights
         self.download_model(i_weights)
 
         # create model object in inference mode.
-        config = InferenceConfig()
-        self.model = modellib.MaskRCNN(mode='inference', model_dir=self.i_logs, config=config)
+        self.config = InferenceConfig(images_per_gpu=i_batch_size)
+        self.model = modellib.MaskRCNN(mode='inference', model_dir=self.i_logs, config=self.config)
         # load weights trained on MS-COCO
         self.model.load_weights(self.i_weights, by_name=True)
 
+        # coalesce concurrent predict() calls into one detect() call
+        self.batcher = None
+        if i_batch_size > 1:
+            self.batcher = MicroBatcher(self.detect_batch,
+                                        max_batch_size=i_batch_size,
+                                        max_wait_ms=i_batch_wait_ms,
+                                        name='mask-rcnn-batcher')
+
+        # boundaries keyed by (image content, box, class); masks are bit-packed
+        self.cache = ResultCache(max_entries=i_cache_size, disk_dir=i_cache_dir, name='mask-rcnn-cache')
+        # whole-image mode: every instance detected in an image, keyed by image content
+        self.detections_cache = ResultCache(max_entries=i_cache_size, name='mask-rcnn-detections-cache')
+
     def download_model(self, i_weights):
         # Download COCO trained weights from Releases if needed
         if not os.path.exists(i_weights):
             utils.download_trained_weights(i_weights)
 
+    def detect_batch(self, i_images):
+        """Runs detect() on up to BATCH_SIZE images and returns one result dict per image.
+
+        Partial batches are padded with copies of the last image since the model
+        is built for a fixed batch size; results for the padding are dropped.
+        """
+        batch_size = self.config.BATCH_SIZE
+        results = []
+        for i in range(0, len(i_images), batch_size):
+            images = list(i_images[i:i + batch_size])
+            n = len(images)
+            images += [images[-1]] * (batch_size - n)
+            results += self.model.detect(images, verbose=0)[:n]
+
+        return results
+
     def predict(self,
                 i_image_path: str,
                 i_bounding_box: list,
-                i_class_of_interest: int):
+                i_class_of_interest: int,
+                i_image=None):
+        """Boundary of the object in the box; i_image is an image_loader.LoadedImage of
+        i_image_path, otherwise the file is read and decoded here. Raises NoInstanceFound,
+        also for a box already known to have no instance, when Mask R-CNN finds none."""
+        if i_image is not None:
+            image_hash = i_image.content_hash
+        else:
+            # load an image from the images folder
+            with open(i_image_path, 'rb') as f:
+                image_hash = content_hash(f.read())
+        bounding_box = [int(round(x)) for x in i_bounding_box]
+        cache_key = self.cache_key(image_hash, bounding_box, i_class_of_interest)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            if cached == NO_INSTANCE:
+                raise NoInstanceFound('no instance of class {} in box {}'.format(i_class_of_interest, bounding_box))
+            return self.unpack_result(cached)
+
+        image = i_image.pixels if i_image is not None else skimage.io.imread(i_image_path)
+
+        full_mask = None
+        if self.i_whole_image:
+            full_mask = self.match_detection(image_hash, image, bounding_box, i_class_of_interest)
+
+        if full_mask is None:
+            try:
+                bb_mask = self.detect_crop(image, bounding_box, i_class_of_interest)
+            except NoInstanceFound:
+                self.cache.put(cache_key, NO_INSTANCE)
+                raise
+            full_mask = np.zeros((image.shape[0], image.shape[1]), dtype=bool)
+            full_mask[bounding_box[1]:bounding_box[3] + 1, bounding_box[0]:bounding_box[2] + 1] = bb_mask
+
+        simple_mask_polygon = self.generate_contour(full_mask)
+        if self.debug_artifacts.sample():
+            self.debug_artifacts.submit('mask', mpimg.imsave, full_mask)
+            self.debug_artifacts.submit('contour', self.save_contour, full_mask, simple_mask_polygon)
+
+        simple_mask_polygon = simple_mask_polygon.astype(int)
+        self.cache.put(cache_key, (pack_mask(full_mask), simple_mask_polygon))
+
+        return full_mask, simple_mask_polygon
+
+    def cache_key(self, image_hash, bounding_box, class_of_interest):
+        """Key of a cached boundary; bounding_box is rounded to int like predict() does."""
+        bounding_box = [int(round(x)) for x in bounding_box]
+        return make_key(image_hash, self.i_weights, tuple(bounding_box), class_of_interest)
 
-        # load an image from the images folder
-        image = skimage.io.imread(i_image_path)
-        bounding_box_image = image[i_bounding_box[1]:i_bounding_box[3] + 1, i_bounding_box[0]:i_bounding_box[2] + 1, :]
+    def unpack_result(self, packed):
+        packed_mask, simple_mask_polygon = packed
 
-        # run detection
-        results = self.model.detect([bounding_box_image], verbose=1)
-        indexes = np.where(results[0]['class_ids'] == i_class_of_interest)
+        return unpack_mask(packed_mask), simple_mask_polygon.copy()
+
+    def detect_crop(self, image, bounding_box, class_of_interest):
+        # run detection on the box region only, returns the mask of that region
+        bounding_box_image = image[bounding_box[1]:bounding_box[3] + 1, bounding_box[0]:bounding_box[2] + 1, :]
+
+        if self.batcher is not None:
+            results = [self.batcher(bounding_box_image)]
+        else:
+            results = self.detect_batch([bounding_box_image])
+        indexes = np.where(results[0]['class_ids'] == class_of_interest)
+        if len(indexes[0]) == 0:
+            raise NoInstanceFound('no instance of class {} in box {}'.format(class_of_interest, bounding_box))
         # take the first element
         # somehow indexes[0] returns ndarray if there are multiple instances
         mask_id = indexes[0][0]
-        print(mask_id)
-        if len(indexes) > 0:
-            s = results[0]['masks'].shape
-            bb_mask = results[0]['masks'][:, :, mask_id].reshape((s[0], s[1]))
-            full_mask = np.zeros((image.shape[0], image.shape[1]), dtype=bool)
-            full_mask[i_bounding_box[1]:i_bounding_box[3] + 1, i_bounding_box[0]:i_bounding_box[2] + 1] = bb_mask
-            plt.imsave("./data/mask.jpg", full_mask)
-            simple_mask_polygon = self.generate_contour(full_mask)
+        s = results[0]['masks'].shape
+
+        return results[0]['masks'][:, :, mask_id].reshape((s[0], s[1]))
 
-        return full_mask, simple_mask_polygon.astype(int)
+    def detect_image(self, image_hash, image):
+        """Runs detection once on the whole image and caches every instance.
+
+        Returns (rois, class_ids, packed_masks); rois are [N, (y1, x1, y2, x2)].
+        """
+        cache_key = make_key(image_hash, self.i_weights)
+        detections = self.detections_cache.get(cache_key)
+        if detections is not None:
+            return detections
+
+        if self.batcher is not None:
+            result = self.batcher(image)
+        else:
+            result = self.detect_batch([image])[0]
+        masks = result['masks']
+        detections = (result['rois'], result['class_ids'],
+                      [pack_mask(masks[:, :, i]) for i in range(masks.shape[-1])])
+        self.detections_cache.put(cache_key, detections)
+
+        return detections
+
+    def match_detection(self, image_hash, image, bounding_box, class_of_interest):
+        """Returns the full-image mask of the cached instance best matching the box, or None."""
+        rois, class_ids, packed_masks = self.detect_image(image_hash, image)
+        candidates = np.where(class_ids == class_of_interest)[0]
+        if len(candidates) == 0:
+            return None
+
+        # requested box is (x1, y1, x2, y2) with inclusive bottom-right corner
+        box = np.array([bounding_box[1], bounding_box[0], bounding_box[3] + 1, bounding_box[2] + 1])
+        candidate_rois = rois[candidates]
+        y1 = np.maximum(box[0], candidate_rois[:, 0])
+        x1 = np.maximum(box[1], candidate_rois[:, 1])
+        y2 = np.minimum(box[2], candidate_rois[:, 2])
+        x2 = np.minimum(box[3], candidate_rois[:, 3])
+        intersection = np.maximum(0, y2 - y1) * np.maximum(0, x2 - x1)
+        box_area = (box[2] - box[0]) * (box[3] - box[1])
+        roi_areas = (candidate_rois[:, 2] - candidate_rois[:, 0]) * (candidate_rois[:, 3] - candidate_rois[:, 1])
+        iou = intersection / (box_area + roi_areas - intersection + 1e-9)
+
+        best = np.argmax(iou)
+        if iou[best] < self.i_match_iou_threshold:
+            return None
+
+        return unpack_mask(packed_masks[candidates[best]])
 
     def generate_contour(self, full_mask):
         # get target mask
@@ -85,13 +254,13 @@ class MaskRCNNModel:
         # get the new mask polygon
         simple_mask_polygon = np.fliplr(simple_contour) - 1
 
-        # plot the polygon
-        plt.figure(figsize=(12, 12))
-        plt.imshow(full_mask)
-        for vertex in simple_mask_polygon:
-            x, y = vertex[0], vertex[1]
-            plt.scatter(x, y, color='r', s=5)
-
-        plt.savefig("./data/contour.jpg")
+        return simple_mask_polygon
 
-        return simple_mask_polygon
\ No newline at end of file
+    def save_contour(self, i_output, full_mask, simple_mask_polygon):
+        # plot the polygon; Figure is not registered with pyplot, so it is
+        # freed after saving and safe to use outside the main thread
+        fig = Figure(figsize=(12, 12))
+        ax = fig.subplots()
+        ax.imshow(full_mask)
+        ax.scatter(simple_mask_polygon[:, 0], simple_mask_polygon[:, 1], color='r', s=5)
+        fig.savefig(i_output)
\ No newline at end of file
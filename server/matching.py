@@ -0,0 +1,22 @@
+"""Matches annotated boxes to COCO ground-truth boxes.
+
+Boxes are compared the way the metrics compare them: both as corners
+[x1, y1, x2, y2], with IoU = intersection / (union + 0.001). Ground-truth
+boxes are the COCO bbox values truncated to int, as they are stored.
+"""
+import numpy as np
+
+from box_geometry import pairwise_iou
+
+
+def ground_truth_boxes(bboxes):
+    """COCO bboxes as the int [N, 4] array the metrics are computed against."""
+    return np.trunc(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)).astype(np.int64)
+
+
+def best_match(annotated_bounding_box, ground_truth_bounding_boxes):
+    """Index of the ground truth box with the highest IoU, the first one on ties; None without any."""
+    if len(ground_truth_bounding_boxes) == 0:
+        return None
+    return int(np.argmax(pairwise_iou(annotated_bounding_box, ground_truth_bounding_boxes)[0]))
+
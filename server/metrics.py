@@ -0,0 +1,115 @@
+"""Annotation quality metrics on plain lists of points.
+
+Only needs shapely and numpy, so worker processes can import it without
+loading the models. Bounding boxes are [x1, y1, x2, y2], polygons
+[[x, y], ...]; bounding box metrics are closed form, see box_geometry, and
+polygon IoU and area change are computed in batches, see polygon_metrics.
+"""
+import copy
+from collections import Counter
+
+import box_geometry
+import polygon_metrics
+
+# bump when metric definitions change so stored metrics get recalculated
+METRICS_VERSION = 2
+
+
+def polygon_iou(predicted_polygon, ground_truth_polygon, iou_backend=None):
+    return polygon_metrics.polygon_iou(predicted_polygon, ground_truth_polygon, iou_backend)
+
+
+def bounding_box_iou(predicted_bounding_box, ground_truth_bounding_box):
+    return box_geometry.iou(predicted_bounding_box, ground_truth_bounding_box)
+
+
+def polygon_number_of_changes(predicted_polygon, ground_truth_polygon):
+    """Vertices not shared by the two polygons, counted as multisets: max of the unmatched on either side.
+
+    O(n + m) with hashed vertices. A vertex repeated on both sides (closed
+    contours repeat their first one) matches as often as it occurs on both.
+    """
+    predicted = Counter(tuple(p) for p in predicted_polygon)
+    ground_truth = Counter(tuple(p) for p in ground_truth_polygon)
+    matched = sum((predicted & ground_truth).values())
+
+    return max(len(ground_truth_polygon) - matched, len(predicted_polygon) - matched)
+
+
+def bounding_box_number_of_changes(predicted_bounding_box, ground_truth_bounding_box):
+    return box_geometry.number_of_changes(predicted_bounding_box, ground_truth_bounding_box)
+
+
+def polygon_percentage_area_change(predicted_polygon, ground_truth_polygon):
+    return polygon_metrics.polygon_percentage_area_change(predicted_polygon, ground_truth_polygon)
+
+
+def bounding_box_percentage_area_change(predicted_bounding_box, ground_truth_bounding_box):
+    return box_geometry.percentage_area_change(predicted_bounding_box, ground_truth_bounding_box)
+
+
+def compute_metrics(record, metrics=None, an_vs_pd_changes=None, polygon_results=None):
+    """Computes the pd_vs_gt, an_vs_gt and an_vs_pd metrics of one annotation record.
+
+    Values are written over a copy of metrics (fresh dicts by default), so
+    recalculating keeps whatever cannot be derived from the geometry. That
+    is the an_vs_pd number of changes, which counts the edits made in the
+    annotation tool; pass an_vs_pd_changes=(bounding_box_changes,
+    polygon_changes) on submit to set it. polygon_results is this record's
+    entry of polygon_metrics.compute_polygon_metrics, when already computed
+    for a batch.
+    """
+    if polygon_results is None:
+        polygon_results = polygon_metrics.compute_polygon_metrics([record])[0]
+    metrics = {"an_vs_gt": {}, "pd_vs_gt": {}, "an_vs_pd": {}} if metrics is None else copy.deepcopy(metrics)
+    pd_vs_gt = metrics.setdefault("pd_vs_gt", {})
+    an_vs_gt = metrics.setdefault("an_vs_gt", {})
+    an_vs_pd = metrics.setdefault("an_vs_pd", {})
+
+    predicted_bounding_box = record.get("predicted_bounding_box")
+    annotated_bounding_box = record.get("annotated_bounding_box")
+    ground_truth_bounding_box = record.get("ground_truth_bounding_box")
+    predicted_polygon = record.get("predicted_polygon")
+    annotated_polygon = record.get("annotated_polygon")
+    ground_truth_polygon = record.get("ground_truth_polygon")
+
+    # pd_vs_gt
+    if predicted_bounding_box is not None and ground_truth_bounding_box is not None:
+        pd_vs_gt["bb_iou"] = bounding_box_iou(predicted_bounding_box, ground_truth_bounding_box)
+        pd_vs_gt["bb_percentage_area_change"] = bounding_box_percentage_area_change(predicted_bounding_box, ground_truth_bounding_box)
+        pd_vs_gt["bb_number_of_changes"] = bounding_box_number_of_changes(predicted_bounding_box, ground_truth_bounding_box)
+
+    if predicted_polygon is not None and ground_truth_polygon is not None:
+        pd_vs_gt.update(polygon_results["pd_vs_gt"])
+        pd_vs_gt["p_number_of_changes"] = polygon_number_of_changes(predicted_polygon, ground_truth_polygon)
+
+    # an_vs_gt
+    if annotated_bounding_box is not None and ground_truth_bounding_box is not None:
+        an_vs_gt["bb_iou"] = bounding_box_iou(annotated_bounding_box, ground_truth_bounding_box)
+        an_vs_gt["bb_percentage_area_change"] = bounding_box_percentage_area_change(annotated_bounding_box, ground_truth_bounding_box)
+        an_vs_gt["bb_number_of_changes"] = bounding_box_number_of_changes(annotated_bounding_box, ground_truth_bounding_box)
+
+    if annotated_polygon is not None and ground_truth_polygon is not None:
+        an_vs_gt.update(polygon_results["an_vs_gt"])
+        an_vs_gt["p_number_of_changes"] = polygon_number_of_changes(annotated_polygon, ground_truth_polygon)
+
+    # an_vs_pd, relative to the annotation
+    if annotated_bounding_box is not None and predicted_bounding_box is not None:
+        an_vs_pd["bb_iou"] = bounding_box_iou(predicted_bounding_box, annotated_bounding_box)
+        an_vs_pd["bb_percentage_area_change"] = bounding_box_percentage_area_change(predicted_bounding_box, annotated_bounding_box)
+        if an_vs_pd_changes is not None:
+            an_vs_pd["bb_number_of_changes"] = an_vs_pd_changes[0]
+
+    if annotated_polygon is not None and predicted_polygon is not None:
+        an_vs_pd.update(polygon_results["an_vs_pd"])
+        if an_vs_pd_changes is not None:
+            an_vs_pd["p_number_of_changes"] = an_vs_pd_changes[1]
+
+    return metrics
+
+
+def compute_metrics_chunk(records):
+    """Recomputes the metrics of a list of records; runs in recalculation worker processes."""
+    polygon_results = polygon_metrics.compute_polygon_metrics(records)
+    return [compute_metrics(record, record.get("metrics"), polygon_results=results)
+            for record, results in zip(records, polygon_results)]
@@ -0,0 +1,144 @@
+import numpy as np
+
+from annotation_store import COMPARISONS, METRICS
+
+COMPARISON_INDEX = {comparison: i for i, comparison in enumerate(COMPARISONS)}
+
+
+class MetricsTable:
+    """Per-record metrics as one float64 array with the class id as a column.
+
+    values has shape [records, comparisons, metrics] with NaN for metrics
+    that were not computed, in COMPARISONS and METRICS order; class_codes
+    indexes each record's class id in class_labels. Statistics are
+    grouped reductions over the whole table instead of per-record dict
+    lookups: records are ordered by class once and every column is reduced
+    with ufunc.reduceat.
+    """
+    def __init__(self, class_labels, class_codes, image_file_names, values):
+        self.class_labels = list(class_labels)
+        self.class_codes = np.asarray(class_codes, dtype=np.intp)
+        self.image_file_names = list(image_file_names)
+        self.values = np.asarray(values, dtype=np.float64).reshape(-1, len(COMPARISONS), len(METRICS))
+
+    @classmethod
+    def from_columns(cls, class_ids, image_file_names, comparisons, values):
+        """Builds the table from one entry per record and comparison, without a dict per record.
+
+        values is [entries, metrics] in METRICS order, with None or NaN for
+        metrics that were not computed.
+        """
+        count = len(class_ids)
+        values = np.asarray(values, dtype=np.float64).reshape(count, len(METRICS))
+        records = {}
+        record = np.fromiter((records.setdefault(key, len(records)) for key in zip(class_ids, image_file_names)),
+                             dtype=np.intp, count=count)
+        comparison_codes = np.fromiter((COMPARISON_INDEX[name] for name in comparisons), dtype=np.intp, count=count)
+        table = np.full((len(records), len(COMPARISONS), len(METRICS)), np.nan)
+        table[record, comparison_codes] = values
+
+        labels = {}
+        codes = [labels.setdefault(class_id, len(labels)) for class_id, _ in records]
+        return cls(list(labels), codes, [image_file_name for _, image_file_name in records], table)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the table from AnnotationStore.metric_rows()."""
+        labels = {}
+        index = {}
+        class_codes = []
+        image_file_names = []
+        data = []
+        width = len(METRICS)
+        for class_id, image_file_name, comparison, metrics in rows:
+            key = (class_id, image_file_name)
+            row = index.get(key)
+            if row is None:
+                row = index[key] = len(data)
+                class_codes.append(labels.setdefault(class_id, len(labels)))
+                image_file_names.append(image_file_name)
+                data.append([np.nan] * (len(COMPARISONS) * width))
+            offset = COMPARISON_INDEX[comparison] * width
+            data[row][offset:offset + width] = [metrics.get(metric, np.nan) for metric in METRICS]
+
+        values = np.array(data, dtype=np.float64).reshape(-1, len(COMPARISONS), width)
+        # None stored for a metric reads back as NaN, same as a missing one
+        return cls(labels, class_codes, image_file_names, values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return zip((self.class_labels[code] for code in self.class_codes.tolist()), self.image_file_names)
+
+    def reduce(self, codes, num_groups):
+        """Grouped count, min, max, mean and sample variance of every column.
+
+        Returns a dict of [num_groups, comparisons, metrics] arrays; groups
+        with no value in a column, including groups without any record,
+        have count 0 and NaN elsewhere.
+        """
+        shape = (num_groups, len(COMPARISONS), len(METRICS))
+        width = len(COMPARISONS) * len(METRICS)
+        counts = np.zeros((width, num_groups), dtype=np.int64)
+        mins, maxs, means, variances = (np.full((width, num_groups), np.nan) for _ in range(4))
+
+        # reduceat needs a distinct start per group: an empty group would
+        # take the next group's first value, so only groups with records are reduced
+        sizes = np.bincount(codes, minlength=num_groups)
+        present = np.flatnonzero(sizes)
+        if len(present):
+            # one contiguous row per column, records ordered by group
+            order = np.argsort(codes, kind='stable')
+            starts = (np.cumsum(sizes) - sizes)[present]
+            columns = np.ascontiguousarray(self.values.reshape(len(self), -1)[order].T)
+            valid = ~np.isnan(columns)
+
+            present_counts = np.add.reduceat(valid.view(np.uint8), starts, axis=1, dtype=np.int64)
+            sums = np.add.reduceat(np.where(valid, columns, 0.0), starts, axis=1)
+            # fmin/fmax skip NaN
+            mins[:, present] = np.fmin.reduceat(columns, starts, axis=1)
+            maxs[:, present] = np.fmax.reduceat(columns, starts, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                present_means = sums / present_counts
+                # two passes for the variance; sum of squares minus squared sum loses precision
+                group_of_record = np.repeat(np.arange(len(present)), sizes[present])
+                deviations = np.where(valid, columns - present_means[:, group_of_record], 0.0)
+                m2 = np.add.reduceat(deviations * deviations, starts, axis=1)
+                present_variances = np.where(present_counts > 1, m2 / (present_counts - 1), 0.0)
+            counts[:, present] = present_counts
+            means[:, present] = present_means
+            variances[:, present] = present_variances
+
+        empty = counts == 0
+        means[empty] = np.nan
+        variances[empty] = np.nan
+
+        return {
+            'count': counts.T.reshape(shape),
+            'min': mins.T.reshape(shape),
+            'max': maxs.T.reshape(shape),
+            'avg': means.T.reshape(shape),
+            'variance': variances.T.reshape(shape)
+        }
+
+    @staticmethod
+    def combine(reduced):
+        """Merges the groups of a reduce() result into one, as reduce() over all records would."""
+        counts = reduced['count']
+        present = counts > 0
+        total = counts.sum(axis=0, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(present, reduced['avg'] * counts, 0.0).sum(axis=0, keepdims=True) / total
+            # parallel variance: within-group squares plus the spread of the group means
+            m2 = np.where(present, reduced['variance'] * np.maximum(counts - 1, 0) +
+                          counts * (reduced['avg'] - means) ** 2, 0.0).sum(axis=0, keepdims=True)
+            variances = np.where(total > 1, m2 / (total - 1), 0.0)
+            mins = np.fmin.reduce(reduced['min'], axis=0, keepdims=True)
+            maxs = np.fmax.reduce(reduced['max'], axis=0, keepdims=True)
+
+        empty = total == 0
+        means[empty] = np.nan
+        variances[empty] = np.nan
+
+        return {'count': total, 'min': mins, 'max': maxs, 'avg': means, 'variance': variances}
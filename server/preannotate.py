@@ -0,0 +1,171 @@
+"""Pre-computes YOLO boxes and Mask R-CNN polygons for whole image directories.
+
+Results are written to the same on-disk cache tiers the server reads
+(BOUNDING_BOXES_CACHE_DIR, MASK_RCNN_CACHE_DIR), so /get_bounding_boxes and
+/get_object_boundary answer pre-annotated images without running the models.
+The caches are the checkpoint: an image is skipped when its boxes, and the
+boundary of each box when masks are requested, are already cached under the
+current model parameters, so a restarted run picks up where it stopped and
+nothing is skipped that the cache no longer holds.
+
+    python preannotate.py --images './data/*' --images './coco/val2017/*/*'
+"""
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import tensorflow as tf
+
+from image_loader import LoadedImage
+from result_cache import ResultCache, content_hash
+from yolov3_tf2.yolov3_tf2.dataset import transform_images
+
+flags.DEFINE_multi_string('images', ['./data/*'], 'glob pattern(s) of images to pre-annotate')
+flags.DEFINE_integer('batch_size', 8, 'images per YOLO forward pass')
+flags.DEFINE_boolean('masks', True, 'also compute Mask R-CNN polygons for every detected box')
+flags.DEFINE_integer('mask_batch_size', 4, 'crops per Mask R-CNN forward pass')
+flags.DEFINE_string('bounding_boxes_cache_dir',
+                    os.environ.get('BOUNDING_BOXES_CACHE_DIR') or './cache/bounding_boxes',
+                    'on-disk tier of the bounding box cache')
+flags.DEFINE_string('mask_rcnn_cache_dir',
+                    os.environ.get('MASK_RCNN_CACHE_DIR') or './cache/mask_rcnn',
+                    'on-disk tier of the Mask R-CNN boundary cache')
+flags.DEFINE_integer('cache_ttl', 365 * 24 * 3600, 'lifetime of the written results in seconds')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+
+def list_images(patterns):
+    paths = set()
+    for pattern in patterns:
+        paths.update(p for p in glob.glob(pattern) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+    return sorted(paths)
+
+
+def is_cached(path, yolo, bounding_boxes_cache, mask_rcnn=None):
+    """True when the results for the image's current content are in the caches."""
+    with open(path, 'rb') as f:
+        image_hash = content_hash(f.read())
+    cached = bounding_boxes_cache.peek(yolo.cache_key(image_hash))
+    if cached is None:
+        return False
+    if mask_rcnn is None:
+        return True
+
+    # a box without an instance is cached as such; boxes whose boundary
+    # failed otherwise have no entry, so they are retried
+    npboxes, npclasses = cached
+    return all(mask_rcnn.cache.peek(mask_rcnn.cache_key(image_hash, box.tolist(), int(class_id))) is not None
+               for box, class_id in zip(npboxes, npclasses))
+
+
+def make_dataset(paths, size, batch_size):
+    def load(path):
+        raw = tf.io.read_file(path)
+        img = tf.image.decode_image(raw, channels=3, expand_animations=False)
+        return path, raw, transform_images(img, size), tf.shape(img)
+
+    dataset = tf.data.Dataset.from_tensor_slices(paths)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(batch_size)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def preannotate(paths, yolo, bounding_boxes_cache, mask_rcnn=None,
+                batch_size=8, mask_workers=4, progress=None):
+    """Runs YOLO (and Mask R-CNN per box) over paths, filling the result caches.
+
+    Images whose results are already cached are skipped. progress, if given,
+    is called as progress(done, total) after every batch. Returns the number
+    of images processed.
+    """
+    paths = [p for p in paths if not is_cached(p, yolo, bounding_boxes_cache, mask_rcnn)]
+    if not paths:
+        return 0
+
+    mask_pool = None
+    if mask_rcnn is not None:
+        from mask_rcnn.maskrcnn_model import NoInstanceFound
+        mask_pool = ThreadPoolExecutor(max_workers=mask_workers)
+    processed = 0
+    try:
+        for batch_paths, raws, images, shapes in make_dataset(paths, yolo.i_size, batch_size):
+            outputs = yolo.process_batch(list(images))
+            for path, raw, shape, (boxes, scores, classes, nums) in zip(
+                    batch_paths.numpy(), raws.numpy(), shapes.numpy(), outputs):
+                path = path.decode('utf-8')
+                # the bytes tf.data already read, decoded at most once for all boxes
+                image = LoadedImage(path, raw)
+                npboxes, npclasses = yolo.postprocess(boxes, scores, classes + 1, nums, shape)
+                bounding_boxes_cache.put(yolo.cache_key(image.content_hash), (npboxes, npclasses))
+
+                masks = empty = 0
+                if mask_pool is not None:
+                    # concurrent predict() calls are coalesced by the model's batcher
+                    futures = [mask_pool.submit(mask_rcnn.predict, path, box.tolist(), int(class_id), image)
+                               for box, class_id in zip(npboxes, npclasses)]
+                    for future in futures:
+                        try:
+                            future.result()
+                            masks += 1
+                        except NoInstanceFound:
+                            empty += 1
+                        except Exception as e:
+                            logging.warning('{}: no boundary for a box ({})'.format(path, e))
+
+                logging.debug('{}: {} boxes, {} boundaries, {} without an instance'.format(
+                    path, len(npboxes), masks, empty))
+                processed += 1
+
+            logging.info('pre-annotated {}/{} images'.format(processed, len(paths)))
+            if progress is not None:
+                progress(processed, len(paths))
+    finally:
+        if mask_pool is not None:
+            mask_pool.shutdown()
+
+    return processed
+
+
+def main(_argv):
+    from yolov3_tf2 import yolov3_model
+    from mask_rcnn import maskrcnn_model
+
+    # same model parameters as helper.py, so the cache keys match the server's
+    yolo = yolov3_model.YoloV3Model(
+        i_classes='./config/coco.names',
+        i_yolo_max_boxes=100
+    )
+    bounding_boxes_cache = ResultCache(max_entries=FLAGS.batch_size,
+                                       ttl=FLAGS.cache_ttl,
+                                       disk_dir=FLAGS.bounding_boxes_cache_dir,
+                                       name='bounding-boxes-cache')
+
+    mask_rcnn = None
+    if FLAGS.masks:
+        mask_rcnn = maskrcnn_model.MaskRCNNModel(
+            i_classes='./config/coco.names',
+            i_weights='./mask_rcnn/model/mask_rcnn_coco.h5',
+            i_logs='./mask_rcnn/logs/',
+            i_batch_size=FLAGS.mask_batch_size,
+            i_cache_dir=FLAGS.mask_rcnn_cache_dir
+        )
+        mask_rcnn.cache.ttl = FLAGS.cache_ttl
+
+    paths = list_images(FLAGS.images)
+    logging.info('found {} images'.format(len(paths)))
+    processed = preannotate(paths, yolo, bounding_boxes_cache, mask_rcnn,
+                            batch_size=FLAGS.batch_size,
+                            mask_workers=FLAGS.mask_batch_size)
+    logging.info('done, {} images pre-annotated'.format(processed))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
@@ -0,0 +1,71 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from absl import logging
+
+from metrics import compute_metrics_chunk
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def recalculate_metrics(store, metrics_version, full=False, workers=1, chunk_size=256, progress=None):
+    """Recomputes the metrics of the records whose metrics_version is older than metrics_version.
+
+    full=True first marks every record dirty. Each finished chunk is written
+    back with its records stamped with metrics_version, so the store itself
+    is the checkpoint: an interrupted run picks up the remaining dirty
+    records when started again. Chunks are computed in `workers` processes
+    (inline when workers <= 1 or everything fits in one chunk). progress, if
+    given, is called as progress(done, total) after every chunk.
+
+    Returns {'dirty', 'updated', 'stale'}; stale records were resubmitted
+    while their chunk was computed and already carry fresh metrics.
+    """
+    if full:
+        store.mark_dirty()
+    total = store.count_needing_recalculation(metrics_version)
+    summary = {'dirty': total, 'updated': 0, 'stale': 0}
+    if total == 0:
+        return summary
+
+    def write(chunk, results):
+        for (class_id, image_file_name, record), metrics in zip(chunk, results):
+            if store.update_metrics(class_id, image_file_name, metrics, metrics_version,
+                                    submitted_at=record.get('submitted_at')):
+                summary['updated'] += 1
+            else:
+                summary['stale'] += 1
+        done = summary['updated'] + summary['stale']
+        logging.info('recalculated {}/{} records'.format(done, total))
+        if progress is not None:
+            progress(done, total)
+
+    records = store.records_needing_recalculation(metrics_version)
+    if workers <= 1 or total <= chunk_size:
+        for chunk in chunks(records, chunk_size):
+            write(chunk, compute_metrics_chunk([record for _, _, record in chunk]))
+        return summary
+
+    # spawn: the server process holds TensorFlow state that must not be forked
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = {}
+        for chunk in chunks(records, chunk_size):
+            # bounded in flight, so a full recalculation does not hold every record in memory
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(pending.pop(future), future.result())
+            pending[pool.submit(compute_metrics_chunk, [record for _, _, record in chunk])] = chunk
+        for future in list(pending):
+            write(pending.pop(future), future.result())
+
+    return summary
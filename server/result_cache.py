@@ -0,0 +1,143 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from absl import logging
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def make_key(*parts) -> str:
+    """Builds a cache key from a content hash and the parameters that affect the result."""
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """In-memory LRU cache with per-entry TTL and an optional on-disk tier.
+
+    Entries evicted from memory stay on disk (one pickle per key under
+    `disk_dir`) until their TTL runs out, so results survive restarts and
+    can be shared between workers on the same host. The expiry is stored
+    with each disk entry, so entries written by another process (e.g. the
+    pre-annotation CLI) keep the TTL they were written with.
+    """
+    def __init__(self,
+                max_entries=1024,
+                ttl=24 * 3600,
+                disk_dir=None,
+                name='cache'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.name = name
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = self._read_disk(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put_memory(key, value, now)
+
+        return value
+
+    def peek(self, key):
+        """Value of key without counting a hit or miss or promoting a disk entry; None if absent."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+        return self._read_disk(key, now)
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, value, now)
+        self._write_disk(key, value)
+
+    def invalidate(self, key=None):
+        """Drops one key, or every entry (memory and disk) when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+        if self.disk_dir is None:
+            return
+        names = os.listdir(self.disk_dir) if key is None else [key + '.pkl']
+        for name in names:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+        logging.info('{}: invalidated {}'.format(self.name, 'all entries' if key is None else key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+    def _put_memory(self, key, value, now):
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _read_disk(self, key, now):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at, value = pickle.load(f)
+            if expires_at <= now:
+                os.remove(path)
+                return None
+            return value
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((time.time() + self.ttl, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
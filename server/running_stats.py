@@ -0,0 +1,368 @@
+import math
+import threading
+
+import numpy as np
+from absl import logging
+
+from annotation_store import COMPARISONS, METRICS
+from metrics_table import MetricsTable
+
+QUANTILES = (0.5, 0.9)
+
+
+# quantiles are within this relative error of a value at their rank
+RELATIVE_ACCURACY = 0.01
+# magnitudes below this share the bucket of zero
+MIN_MAGNITUDE = 1e-9
+_LOG_GAMMA = math.log((1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY))
+_KEY_OFFSET = math.ceil(math.log(MIN_MAGNITUDE) / _LOG_GAMMA) - 1
+
+
+def bucket_keys(values):
+    """QuantileSketch bucket of every value, ordered like the values; 0 holds the values around zero.
+
+    Every caller goes through this one vectorized function so that a value
+    always lands in the bucket it was added to when it is removed.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    magnitudes = np.clip(np.abs(np.nan_to_num(values)), MIN_MAGNITUDE, np.finfo(np.float64).max)
+    keys = np.ceil(np.log(magnitudes) / _LOG_GAMMA).astype(np.int64) - _KEY_OFFSET
+    keys[np.abs(values) < MIN_MAGNITUDE] = 0
+
+    return np.where(values < 0, -keys, keys)
+
+
+class QuantileSketch:
+    """Quantiles of values that can be added and removed again, in logarithmic buckets (as in DDSketch).
+
+    Each bucket keeps the count and sum of its values; a quantile is the
+    mean of the bucket at its rank, so it is within RELATIVE_ACCURACY of the
+    exact one, and exact when the bucket holds one distinct value (small
+    integer metrics like the number of changes). Memory and reads grow with
+    the number of non-empty buckets, not with the number of values.
+    """
+    def __init__(self, buckets=None):
+        # {bucket key: [count, sum]}
+        self.buckets = buckets or {}
+
+    @classmethod
+    def from_values(cls, values, keys):
+        unique, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        sums = np.bincount(inverse.reshape(-1), weights=values, minlength=len(unique))
+        return cls({key: [count, total] for key, count, total in zip(unique.tolist(), counts.tolist(), sums.tolist())})
+
+    def add(self, value, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [1, value]
+        else:
+            bucket[0] += 1
+            bucket[1] += value
+
+    def remove(self, value, key):
+        bucket = self.buckets[key]
+        if bucket[0] == 1:
+            del self.buckets[key]
+        else:
+            bucket[0] -= 1
+            bucket[1] -= value
+
+    def quantiles(self, ps):
+        """Linearly interpolated between ranks like numpy.percentile; None when empty."""
+        if not self.buckets:
+            return [None] * len(ps)
+        keys = np.fromiter(self.buckets, dtype=np.int64, count=len(self.buckets))
+        buckets = np.array(list(self.buckets.values()), dtype=np.float64)[np.argsort(keys)]
+        cumulative = np.cumsum(buckets[:, 0])
+        means = buckets[:, 1] / buckets[:, 0]
+
+        positions = np.asarray(ps, dtype=np.float64) * (cumulative[-1] - 1)
+        lower = np.floor(positions)
+        below = means[np.searchsorted(cumulative, lower, side='right')]
+        above = means[np.searchsorted(cumulative, np.minimum(lower + 1, cumulative[-1] - 1), side='right')]
+        return (below + (above - below) * (positions - lower)).tolist()
+
+
+class RunningStats:
+    """Count, min, max, mean and variance (Welford) plus sketched quantiles of one metric.
+
+    remove() takes a value back out of everything but min and max, which
+    cannot forget a value: removing the current minimum or maximum flags
+    extremes_stale until set_extremes() is given the new ones.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.sketch = QuantileSketch()
+        self.extremes_stale = False
+
+    @classmethod
+    def from_aggregates(cls, count, minimum, maximum, mean, variance, sketch):
+        stats = cls()
+        stats.count = int(count)
+        stats.set_extremes(minimum, maximum)
+        stats.mean = float(mean)
+        stats._m2 = float(variance) * (stats.count - 1)
+        stats.sketch = sketch
+
+        return stats
+
+    def set_extremes(self, minimum, maximum):
+        self.min = float(minimum)
+        self.max = float(maximum)
+        self.extremes_stale = False
+
+    def add(self, value, key):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if not self.extremes_stale:
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value, key)
+
+    def remove(self, value, key):
+        """Reverse Welford step for a value that was added before."""
+        self.count -= 1
+        if self.count == 0:
+            self.__init__()
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self._m2 = max(self._m2 - delta * (value - self.mean), 0.0)
+        if value <= self.min or value >= self.max:
+            self.extremes_stale = True
+        self.sketch.remove(value, key)
+
+    @property
+    def variance(self):
+        # sample variance
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        stats = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'avg': self.mean,
+            'variance': self.variance,
+            'std': self.variance ** 0.5
+        }
+        for p, value in zip(QUANTILES, self.sketch.quantiles(QUANTILES)):
+            # a bucket mean can lie just outside the values it holds after many removals
+            stats['p{}'.format(int(round(p * 100)))] = min(max(value, self.min), self.max)
+
+        return stats
+
+
+class _Rows:
+    """Metric values of the records of one class, a [comparisons * metrics] row per image, NaN for no value."""
+    def __init__(self, image_file_names=(), values=None):
+        self.index = {image_file_name: i for i, image_file_name in enumerate(image_file_names)}
+        self.data = np.empty((max(len(self.index), 16), len(COMPARISONS) * len(METRICS)))
+        if values is not None:
+            self.data[:len(self.index)] = values
+
+    def get(self, image_file_name):
+        i = self.index.get(image_file_name)
+        return None if i is None else self.data[i].reshape(len(COMPARISONS), len(METRICS)).copy()
+
+    def set(self, image_file_name, values):
+        i = self.index.setdefault(image_file_name, len(self.index))
+        if i == len(self.data):
+            self.data = np.concatenate([self.data, np.empty_like(self.data)])
+        self.data[i] = values.ravel()
+
+    def column(self, k):
+        return self.data[:len(self.index), k]
+
+
+class MetricsStatistics:
+    """Per-class and overall running statistics of the annotation metrics.
+
+    observe() is called after every submit and folds a new record into its
+    class and the overall aggregates; a resubmit of an image first takes the
+    record's previous values back out (reverse Welford, and out of the
+    quantile sketches). Reads only finish the groups that changed since the
+    last one: a class's min or max is recomputed from its values in memory
+    when a resubmit removed it, and the overall ones from the classes. The
+    first read, and the one after invalidate() (metrics recalculated in
+    place), rebuilds everything with one pass over the store, vectorized
+    through MetricsTable, without holding up submits: the ones that arrive
+    meanwhile are replayed on the rebuilt aggregates.
+    """
+    def __init__(self, store):
+        self.store = store
+        # guards the aggregates; never held during a store read
+        self._lock = threading.Lock()
+        # one rebuild at a time
+        self._rebuild_lock = threading.Lock()
+        # {class_id, or None for overall: {comparison: {metric: RunningStats}}}
+        self._aggregates = {}
+        # {class_id: _Rows}
+        self._values = {}
+        # {class_id or None: finished stats}, for the groups not in _changed
+        self._finished = {}
+        self._changed = set()
+        self._stale = True
+        # bumped by invalidate(), so a rebuild that read the store before it stays stale
+        self._generation = 0
+        # submits observed while a rebuild reads the store, None otherwise
+        self._pending = None
+
+    def observe(self, class_id, image_file_name, metrics):
+        """Folds in a record that was just upserted."""
+        class_id = str(class_id)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((class_id, image_file_name, metrics))
+            elif not self._stale:
+                # otherwise the next rebuild reads the record from the store
+                self._apply(class_id, image_file_name, metrics)
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+            self._generation += 1
+
+    def snapshot(self):
+        """Returns {'classes': {class_id: {comparison: {metric: stats}}}, 'overall': {...}}.
+
+        stats is {'count', 'min', 'max', 'avg', 'variance', 'std', 'p50', 'p90'}.
+        """
+        with self._lock:
+            if not self._stale:
+                return self._finish()
+
+        with self._rebuild_lock:
+            with self._lock:
+                if not self._stale:
+                    return self._finish()
+                generation = self._generation
+                self._pending = []
+            try:
+                aggregates, values = self._build()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._aggregates, self._values = aggregates, values
+                self._finished = {}
+                self._changed = set(aggregates)
+                # replaying a submit the store read already saw leaves its record unchanged
+                for class_id, image_file_name, metrics in pending:
+                    self._apply(class_id, image_file_name, metrics)
+                self._stale = self._generation != generation
+                return self._finish()
+
+    def _build(self):
+        # reads the store without the lock and returns new aggregates
+        table = self.store.metric_table()
+
+        aggregates = {}
+        order = np.argsort(table.class_codes, kind='stable')
+        starts = np.searchsorted(table.class_codes[order], np.arange(len(table.class_labels) + 1))
+        values = {}
+        for g, class_id in enumerate(table.class_labels):
+            rows = order[starts[g]:starts[g + 1]]
+            values[class_id] = _Rows([table.image_file_names[i] for i in rows.tolist()],
+                                     table.values[rows].reshape(len(rows), -1))
+        if len(table):
+            columns = table.values.reshape(len(table), -1)
+            keys = bucket_keys(columns)
+            by_class = table.reduce(table.class_codes, len(table.class_labels))
+            for g, class_id in enumerate(table.class_labels):
+                rows = order[starts[g]:starts[g + 1]]
+                aggregates[class_id] = self._seed(columns[rows], keys[rows], by_class, g)
+            # overall count/mean/variance/min/max merged from the classes, no second pass
+            aggregates[None] = self._seed(columns, keys, MetricsTable.combine(by_class), 0)
+        logging.info('statistics rebuilt from {} records'.format(len(table)))
+
+        return aggregates, values
+
+    @staticmethod
+    def _seed(columns, keys, reduced, g):
+        # count/mean/variance/min/max come from reduced, the grouped
+        # reductions, and the quantile sketches from the group's columns
+        by_comparison = {}
+        for c, comparison in enumerate(COMPARISONS):
+            by_metric = by_comparison.setdefault(comparison, {})
+            for m, metric in enumerate(METRICS):
+                if reduced['count'][g, c, m] == 0:
+                    continue
+                k = c * len(METRICS) + m
+                valid = ~np.isnan(columns[:, k])
+                by_metric[metric] = RunningStats.from_aggregates(
+                    *(reduced[name][g, c, m] for name in ('count', 'min', 'max', 'avg', 'variance')),
+                    QuantileSketch.from_values(columns[valid, k], keys[valid, k]))
+
+        return by_comparison
+
+    @staticmethod
+    def _row(metrics):
+        by_comparison = [metrics.get(comparison) or {} for comparison in COMPARISONS]
+        return np.array([[np.nan if m.get(metric) is None else m[metric] for metric in METRICS]
+                         for m in by_comparison], dtype=np.float64)
+
+    def _apply(self, class_id, image_file_name, metrics):
+        # called with the lock held
+        rows = self._values.setdefault(class_id, _Rows())
+        previous = rows.get(image_file_name)
+        if previous is not None:
+            self._update(class_id, previous, RunningStats.remove)
+        values = self._row(metrics)
+        rows.set(image_file_name, values)
+        self._update(class_id, values, RunningStats.add)
+        self._changed.update((class_id, None))
+
+    def _update(self, class_id, values, step):
+        # step is RunningStats.add or RunningStats.remove
+        keys = bucket_keys(values)
+        for c, m in zip(*np.nonzero(~np.isnan(values))):
+            comparison, metric = COMPARISONS[c], METRICS[m]
+            for group in (class_id, None):
+                by_metric = self._aggregates.setdefault(group, {}).setdefault(comparison, {})
+                stats = by_metric.get(metric)
+                if stats is None:
+                    stats = by_metric[metric] = RunningStats()
+                step(stats, float(values[c, m]), int(keys[c, m]))
+
+    def _finish(self):
+        # called with the lock held; only the groups that changed are finished
+        # again, the classes before overall, whose min and max come from theirs
+        for group in sorted(self._changed, key=lambda group: group is None):
+            by_comparison = self._aggregates.get(group, {})
+            for c, comparison in enumerate(COMPARISONS):
+                for m, metric in enumerate(METRICS):
+                    stats = by_comparison.get(comparison, {}).get(metric)
+                    if stats is not None and stats.count and stats.extremes_stale:
+                        self._reset_extremes(group, c, m, stats)
+            # a resubmit can take the last value of a metric back out
+            self._finished[group] = {
+                comparison: {metric: stats.to_dict() for metric, stats in by_metric.items() if stats.count}
+                for comparison, by_metric in by_comparison.items()}
+        self._changed.clear()
+
+        return {
+            'classes': {group: self._finished[group] for group in self._aggregates if group is not None},
+            'overall': self._finished.get(None, {})
+        }
+
+    def _reset_extremes(self, group, c, m, stats):
+        if group is None:
+            comparison, metric = COMPARISONS[c], METRICS[m]
+            by_class = [by_comparison.get(comparison, {}).get(metric)
+                        for class_id, by_comparison in self._aggregates.items() if class_id is not None]
+            by_class = [class_stats for class_stats in by_class if class_stats is not None and class_stats.count]
+            stats.set_extremes(min(s.min for s in by_class), max(s.max for s in by_class))
+        else:
+            column = self._values[group].column(c * len(METRICS) + m)
+            column = column[~np.isnan(column)]
+            stats.set_extremes(column.min(), column.max())
@@ -0,0 +1,107 @@
+"""Benchmarks the closed-form bounding box metrics against the Shapely ones they replace.
+
+The Shapely path builds two four-point polygons per pair and runs general
+intersection and union, as the metrics did before box_geometry. Pairs are
+random boxes on a small integer grid so corners often coincide. The pairwise
+[N, 4] x [M, 4] forms are checked against the scalar ones pair by pair and
+timed on their own. Run from the server directory:
+    python -m tools.benchmark_box_geometry --pairs 100000
+"""
+import copy
+import time
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import numpy as np
+from shapely.geometry import Polygon
+
+import box_geometry
+
+flags.DEFINE_integer('pairs', 100000, 'box pairs compared one by one')
+flags.DEFINE_integer('boxes', 1000, 'boxes per side of the pairwise [N, 4] x [M, 4] comparison')
+flags.DEFINE_integer('checked_boxes', 200, 'boxes per side checked pair by pair against the scalar forms')
+flags.DEFINE_integer('grid', 50, 'corner coordinates are integers in [0, grid)')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+def rectangle(box):
+    return Polygon([(box[0], box[1]), (box[2], box[1]), (box[2], box[3]), (box[0], box[3])])
+
+
+def shapely_iou(box, ground_truth_box):
+    ground_truth_polygon = rectangle(ground_truth_box)
+    polygon = rectangle(box)
+    return ground_truth_polygon.intersection(polygon).area / (ground_truth_polygon.union(polygon).area + 0.001)
+
+
+def shapely_percentage_area_change(box, ground_truth_box):
+    ground_truth_polygon = rectangle(ground_truth_box)
+    return abs(ground_truth_polygon.area - rectangle(box).area) * 100 / ground_truth_polygon.area
+
+
+def deepcopy_number_of_changes(box, ground_truth_box):
+    gtp = [list(c) for c in box_geometry.corners(ground_truth_box)]
+    pp = [list(c) for c in box_geometry.corners(box)]
+    for p in copy.deepcopy(pp):
+        if p in copy.deepcopy(gtp):
+            gtp.remove(p)
+            pp.remove(p)
+    return max(len(gtp), len(pp))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def per_pair(metric, pairs):
+    results = []
+    for box, ground_truth_box in pairs:
+        try:
+            results.append(metric(box, ground_truth_box))
+        except ZeroDivisionError:
+            results.append(np.inf)
+    return np.array(results, dtype=np.float64)
+
+
+def main(_argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    boxes = rng.integers(0, FLAGS.grid, size=(FLAGS.pairs, 2, 4)).tolist()
+
+    for name, legacy_metric, closed_form in [
+            ('iou', shapely_iou, box_geometry.iou),
+            ('percentage_area_change', shapely_percentage_area_change, box_geometry.percentage_area_change),
+            ('number_of_changes', deepcopy_number_of_changes, box_geometry.number_of_changes)]:
+        expected, legacy_time = timed(lambda: per_pair(legacy_metric, boxes))
+        actual, closed_form_time = timed(lambda: per_pair(closed_form, boxes))
+        mismatches = np.count_nonzero(~np.isclose(expected, actual, rtol=1e-9, atol=1e-12) &
+                                      ~(np.isinf(expected) & np.isinf(actual)))
+        logging.info('{}: {} pairs, legacy {:.2f} s, closed form {:.3f} s ({:.0f}x), {} mismatches'.format(
+            name, FLAGS.pairs, legacy_time, closed_form_time, legacy_time / closed_form_time, mismatches))
+
+    a = rng.integers(0, FLAGS.grid, size=(FLAGS.boxes, 4))
+    b = rng.integers(0, FLAGS.grid, size=(FLAGS.boxes, 4))
+    # the pairwise forms must agree with the scalar ones on every pair of a smaller grid
+    checked = min(FLAGS.boxes, FLAGS.checked_boxes)
+    pairs = [[box, other_box] for box in a[:checked].tolist() for other_box in b[:checked].tolist()]
+    for name, scalar, pairwise in [
+            ('iou', box_geometry.iou, box_geometry.pairwise_iou),
+            ('percentage_area_change', box_geometry.percentage_area_change,
+             box_geometry.pairwise_percentage_area_change),
+            ('number_of_changes', box_geometry.number_of_changes, box_geometry.pairwise_number_of_changes)]:
+        expected = per_pair(scalar, pairs)
+        actual = pairwise(a[:checked], b[:checked]).ravel()
+        mismatches = np.count_nonzero(~np.isclose(expected, actual, rtol=1e-9, atol=1e-12) &
+                                      ~(np.isinf(expected) & ~np.isfinite(actual)))
+        _, pairwise_time = timed(lambda: pairwise(a, b))
+        logging.info('pairwise_{}: {} x {} boxes in {:.3f} s ({:.0f} ns per pair), {} mismatches in {} x {}'.format(
+            name, FLAGS.boxes, FLAGS.boxes, pairwise_time, pairwise_time * 1e9 / FLAGS.boxes ** 2,
+            mismatches, checked, checked))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
@@ -0,0 +1,68 @@
+"""Compares the raster polygon IoU backend with the Shapely one.
+
+Takes every predicted / annotated / ground truth polygon pair of the
+records in an annotations json (data.json by default), computes its IoU
+with both backends and reports the time and the difference per raster
+scale. Pairs Shapely gives no IoU for (invalid polygons) are counted and
+left out of the differences. Run from the server directory:
+    python -m tools.benchmark_polygon_iou --scales 1,2,4
+"""
+import json
+import time
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import numpy as np
+
+import polygon_metrics
+
+flags.DEFINE_string('data', './data.json', 'annotations json to take polygons from')
+flags.DEFINE_list('scales', ['1', '2', '4'], 'raster scales to compare')
+flags.DEFINE_integer('repeat', 20, 'times each pair is computed, for timing')
+
+
+def polygon_pairs(data):
+    pairs = []
+    for images in data.values():
+        for record in images.values():
+            for _, predicted_side, ground_truth_side in polygon_metrics.COMPARISONS:
+                if record.get(predicted_side) and record.get(ground_truth_side):
+                    pairs.append((record[predicted_side], record[ground_truth_side]))
+    return pairs
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main(_argv):
+    with open(FLAGS.data) as f:
+        pairs = polygon_pairs(json.load(f))
+
+    def shapely_ious():
+        ious = [polygon_metrics.polygon_iou(predicted, ground_truth, 'shapely') for predicted, ground_truth in pairs]
+        return [np.nan if value is None else value for value in ious]
+
+    expected, shapely_time = timed(lambda: [shapely_ious() for _ in range(FLAGS.repeat)][0])
+    expected = np.array(expected)
+    failed = np.isnan(expected)
+    vertices = np.mean([len(p) + len(g) for p, g in pairs])
+    logging.info('{} polygon pairs, {:.0f} vertices per pair on average, {} invalid for shapely'.format(
+        len(pairs), vertices, np.count_nonzero(failed)))
+    logging.info('shapely: {:.1f} us per pair'.format(shapely_time * 1e6 / (len(pairs) * FLAGS.repeat)))
+
+    for scale in [int(s) for s in FLAGS.scales]:
+        actual, raster_time = timed(lambda: [[polygon_metrics.raster_iou(p, g, scale) for p, g in pairs]
+                                             for _ in range(FLAGS.repeat)][0])
+        difference = np.abs(np.array(actual) - expected)[~failed]
+        logging.info('raster x{}: {:.1f} us per pair, IoU difference mean {:.4f}, max {:.4f}'.format(
+            scale, raster_time * 1e6 / (len(pairs) * FLAGS.repeat), difference.mean(), difference.max()))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
@@ -0,0 +1,130 @@
+"""Benchmarks the statistics rebuild of MetricsStatistics against per-record dict statistics.
+
+Writes a synthetic dataset of annotation metrics (some metrics missing,
+like records without a ground truth polygon) into a SQLite annotation store
+in a temporary directory, then times a plain pass over the metrics dicts of
+metric_rows() with .get(), the way statistics used to be computed, a
+MetricsTable built from those dicts, the same table read column-wise by
+metric_table(), and the MetricsStatistics rebuild the server runs on its
+first read and after recalculation. Then times resubmits, each followed by
+a read. Run from the server directory:
+    python -m tools.benchmark_statistics --records 1000000
+"""
+import os
+import tempfile
+import time
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import numpy as np
+
+from annotation_store import COMPARISONS, METRICS, SqliteAnnotationStore
+from metrics_table import MetricsTable
+from running_stats import MetricsStatistics
+
+flags.DEFINE_integer('records', 1000000, 'synthetic annotation records')
+flags.DEFINE_integer('classes', 80, 'distinct class ids')
+flags.DEFINE_float('missing', 0.2, 'fraction of metrics that are not computed')
+flags.DEFINE_integer('resubmits', 100, 'resubmits timed, each followed by a read')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+def fill_store(store, class_ids, values):
+    """Writes the metrics rows straight into a SqliteAnnotationStore; statistics only read those."""
+    conn = store._connection()
+    with conn:
+        conn.executemany(
+            'INSERT INTO metrics (class_id, image_file_name, comparison, {}) VALUES (?, ?, ?, {})'.format(
+                ', '.join(METRICS), ', '.join('?' * len(METRICS))),
+            ((class_id, 'image_{}.jpg'.format(i), comparison, *[None if v != v else v for v in row])
+             for i, (class_id, record) in enumerate(zip(class_ids, values.tolist()))
+             for comparison, row in zip(COMPARISONS, record)))
+
+
+def dict_statistics(store):
+    """Per-class and overall count/min/max/avg of every metric, one record at a time."""
+    accumulators = {}
+    for class_id, _, comparison, metrics in store.metric_rows():
+        for key in (class_id, None):
+            by_metric = accumulators.setdefault(key, {}).setdefault(comparison, {})
+            for metric in METRICS:
+                value = metrics.get(metric)
+                if value is None:
+                    continue
+                acc = by_metric.setdefault(metric, [0, value, value, 0])
+                acc[0] += 1
+                acc[1] = min(acc[1], value)
+                acc[2] = max(acc[2], value)
+                acc[3] += value
+
+    def finish(by_comparison):
+        return {comparison: {metric: {'count': c, 'min': mn, 'max': mx, 'avg': total / c}
+                             for metric, (c, mn, mx, total) in by_metric.items()}
+                for comparison, by_metric in by_comparison.items()}
+
+    return {
+        'classes': {k: finish(v) for k, v in accumulators.items() if k is not None},
+        'overall': finish(accumulators.get(None, {}))
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main(_argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    class_ids = [str(c) for c in rng.integers(1, FLAGS.classes + 1, FLAGS.records)]
+    values = rng.uniform(0, 100, size=(FLAGS.records, len(COMPARISONS), len(METRICS)))
+    values[rng.uniform(size=values.shape) < FLAGS.missing] = np.nan
+    with tempfile.TemporaryDirectory() as directory:
+        store = SqliteAnnotationStore(os.path.join(directory, 'annotations.db'))
+        fill_store(store, class_ids, values)
+        run(store, class_ids, rng)
+
+
+def run(store, class_ids, rng):
+    expected, dict_time = timed(lambda: dict_statistics(store))
+    _, rows_time = timed(lambda: MetricsTable.from_rows(store.metric_rows()))
+    _, columns_time = timed(store.metric_table)
+    statistics = MetricsStatistics(store)
+    actual, rebuild_time = timed(statistics.snapshot)
+
+    mismatches = 0
+    for groups, actual_groups in [(expected['classes'], actual['classes']),
+                                  ({None: expected['overall']}, {None: actual['overall']})]:
+        for class_id, by_comparison in groups.items():
+            for comparison, by_metric in by_comparison.items():
+                for metric, stats in by_metric.items():
+                    got = actual_groups[class_id][comparison][metric]
+                    if got['count'] != stats['count'] or not np.isclose(got['avg'], stats['avg']) \
+                            or got['min'] != stats['min'] or got['max'] != stats['max']:
+                        mismatches += 1
+
+    # resubmits of existing images, each read back like GET /statistics
+    def resubmit_and_read():
+        for i in rng.integers(0, FLAGS.records, FLAGS.resubmits).tolist():
+            metrics = {comparison: {metric: float(rng.uniform(0, 100)) for metric in METRICS}
+                       for comparison in COMPARISONS}
+            statistics.observe(class_ids[i], 'image_{}.jpg'.format(i), metrics)
+            statistics.snapshot()
+
+    _, resubmit_time = timed(resubmit_and_read)
+
+    logging.info('{} records, {} classes, {} mismatching aggregates'.format(
+        FLAGS.records, len(expected['classes']), mismatches))
+    logging.info('dict statistics: {:.2f} s'.format(dict_time))
+    logging.info('MetricsTable.from_rows(metric_rows()): {:.2f} s, metric_table(): {:.2f} s'.format(
+        rows_time, columns_time))
+    logging.info('full MetricsStatistics rebuild (store read included): {:.2f} s'.format(rebuild_time))
+    logging.info('rebuild speedup: {:.1f}x'.format(dict_time / rebuild_time))
+    logging.info('resubmit + read: {:.1f} ms each'.format(resubmit_time * 1e3 / FLAGS.resubmits))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
@@ -0,0 +1,132 @@
+"""Checks the hashed polygon number of changes against list-based counts.
+
+First a few fixed cases, among them closed contours that repeat their first
+vertex. Then random polygon pairs on a small grid (so vertices repeat and
+coincide often, including ints against equal floats), plus pairs derived
+from one another by moving, dropping and inserting vertices. Every count
+must equal a plain list multiset difference, and the count of metrics
+version 1 wherever that one did not raise on a repeated predicted vertex.
+Also times dense contours. Run from the server directory:
+    python -m tools.check_polygon_changes --cases 100000
+"""
+import copy
+import random
+import time
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+
+from metrics import polygon_number_of_changes
+
+flags.DEFINE_integer('cases', 100000, 'random polygon pairs to compare')
+flags.DEFINE_integer('grid', 6, 'vertex coordinates are in [0, grid)')
+flags.DEFINE_integer('dense_vertices', 2000, 'vertices of the contours used for timing')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+# (predicted, ground truth, expected number of changes)
+CASES = [
+    ([], [], 0),
+    ([[0, 0], [4, 0], [4, 3]], [[0, 0], [4, 0], [4, 3]], 0),
+    ([[0, 0], [4, 0], [4, 3]], [[0, 0], [4, 0], [4, 4]], 1),
+    ([[0, 0], [4, 0]], [[0, 0], [4, 0], [4, 3], [0, 3]], 2),
+    # closed contour against an open ground truth: the repeated vertex is one change
+    ([[0, 0], [4, 0], [4, 3], [0, 0]], [[0, 0], [4, 0], [4, 3]], 1),
+    ([[0, 0], [4, 0], [4, 3], [0, 0]], [[0, 0], [4, 0], [4, 3], [0, 0]], 0),
+    ([[1, 1], [1, 1], [1, 1]], [[1, 1], [2, 2]], 2),
+    ([[1.0, 2], [3, 4]], [[1, 2], [3, 4.0]], 0),
+]
+
+
+def multiset_number_of_changes(predicted_polygon, ground_truth_polygon):
+    unmatched_ground_truth = list(ground_truth_polygon)
+    unmatched_predicted = 0
+    for p in predicted_polygon:
+        if p in unmatched_ground_truth:
+            unmatched_ground_truth.remove(p)
+        else:
+            unmatched_predicted += 1
+
+    return max(len(unmatched_ground_truth), unmatched_predicted)
+
+
+def list_number_of_changes(predicted_polygon, ground_truth_polygon):
+    """Metrics version 1; raises ValueError on a predicted vertex repeated more often than in the ground truth."""
+    gtp = copy.deepcopy(ground_truth_polygon)
+    pp = copy.deepcopy(predicted_polygon)
+    count = 0
+    for p in predicted_polygon:
+        if p in ground_truth_polygon:
+            gtp.remove(p)
+            pp.remove(p)
+
+    count = max(len(gtp), len(pp))
+
+    return count
+
+
+def outcome(fn, predicted_polygon, ground_truth_polygon):
+    try:
+        return fn(predicted_polygon, ground_truth_polygon)
+    except ValueError:
+        return 'ValueError'
+
+
+def random_polygon(rng):
+    return [[rng.randrange(FLAGS.grid) * rng.choice([1, 1.0]), rng.randrange(FLAGS.grid)]
+            for _ in range(rng.randint(0, 12))]
+
+
+def edited(rng, polygon):
+    polygon = [list(p) for p in polygon]
+    for _ in range(rng.randint(0, 3)):
+        action = rng.choice(['move', 'drop', 'insert'])
+        if action == 'insert' or not polygon:
+            polygon.insert(rng.randint(0, len(polygon)), [rng.randrange(FLAGS.grid), rng.randrange(FLAGS.grid)])
+        elif action == 'drop':
+            polygon.pop(rng.randrange(len(polygon)))
+        else:
+            polygon[rng.randrange(len(polygon))] = [rng.randrange(FLAGS.grid), rng.randrange(FLAGS.grid)]
+    return polygon
+
+
+def main(_argv):
+    failed = 0
+    for predicted_polygon, ground_truth_polygon, expected in CASES:
+        actual = outcome(polygon_number_of_changes, predicted_polygon, ground_truth_polygon)
+        if actual != expected:
+            failed += 1
+            logging.error('{} vs {}: expected {}, got {}'.format(predicted_polygon, ground_truth_polygon, expected, actual))
+    logging.info('{} fixed cases, {} failed'.format(len(CASES), failed))
+
+    rng = random.Random(FLAGS.seed)
+    mismatches = raised = 0
+    for case in range(FLAGS.cases):
+        ground_truth_polygon = random_polygon(rng)
+        predicted_polygon = random_polygon(rng) if case % 2 else edited(rng, ground_truth_polygon)
+        expected = multiset_number_of_changes(predicted_polygon, ground_truth_polygon)
+        legacy = outcome(list_number_of_changes, predicted_polygon, ground_truth_polygon)
+        actual = outcome(polygon_number_of_changes, predicted_polygon, ground_truth_polygon)
+        raised += legacy == 'ValueError'
+        if actual != expected or legacy not in ('ValueError', expected):
+            mismatches += 1
+            if mismatches <= 10:
+                logging.error('{} vs {}: expected {}, version 1 {}, got {}'.format(
+                    predicted_polygon, ground_truth_polygon, expected, legacy, actual))
+    logging.info('{} random cases ({} raising in version 1), {} mismatches'.format(FLAGS.cases, raised, mismatches))
+
+    # distinct vertices, so neither count raises
+    ground_truth_polygon = [[i, i * 7 % 1009] for i in range(FLAGS.dense_vertices)]
+    predicted_polygon = [[i, i * 7 % 1009 + (i % 3 == 0)] for i in range(FLAGS.dense_vertices)]
+    for name, fn in [('list', list_number_of_changes), ('hashed', polygon_number_of_changes)]:
+        start = time.perf_counter()
+        count = fn(predicted_polygon, ground_truth_polygon)
+        logging.info('{}: {} changes between {}-vertex contours in {:.4f} s'.format(
+            name, count, FLAGS.dense_vertices, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
@@ -0,0 +1,157 @@
+"""Stress-tests an annotation store with concurrent submits, scans and recalculations.
+
+Many threads upsert records while others scan records(), rebuild the metric
+statistics and run compare-and-set metric updates, the way /submit_result,
+/compute_statistics and /recalculate interleave under load. At the end every submitted record
+must be present with its last submitted version, and no metric update may
+have overwritten a newer submit. Exits with status 1 on any inconsistency
+or reader failure, so it can gate a change. Run from the server directory:
+    python -m tools.stress_submit --backend jsonl --submits 5000
+"""
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+
+from annotation_store import COMPARISONS, JsonFileStore, JsonlAnnotationStore, SqliteAnnotationStore
+from running_stats import MetricsStatistics
+
+flags.DEFINE_enum('backend', 'jsonl', ['json', 'jsonl', 'sqlite'], 'annotation store backend to test')
+flags.DEFINE_integer('submits', 5000, 'total upserts')
+flags.DEFINE_integer('images', 500, 'distinct images; smaller means more resubmits of the same key')
+flags.DEFINE_integer('classes', 20, 'distinct class ids')
+flags.DEFINE_integer('workers', 32, 'submitting threads')
+flags.DEFINE_integer('readers', 4, 'threads scanning records and statistics')
+flags.DEFINE_integer('compact_every', 200, 'jsonl backend: appends between compactions')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+def make_store(backend, directory):
+    if backend == 'json':
+        return JsonFileStore(os.path.join(directory, 'data.json'))
+    if backend == 'jsonl':
+        return JsonlAnnotationStore(os.path.join(directory, 'data.jsonl'),
+                                    os.path.join(directory, 'data.json'),
+                                    compact_every=FLAGS.compact_every)
+    return SqliteAnnotationStore(os.path.join(directory, 'annotations.db'))
+
+
+def make_record(sequence):
+    # the sequence number rides in the predicted box; image_id belongs to the
+    # image, not the record, and is shared between classes in the sqlite store
+    return {
+        'image_id': '0',
+        'submitted_at': time.time(),
+        'predicted_bounding_box': [0, 0, sequence, sequence],
+        'annotated_bounding_box': [0, 0, sequence, sequence],
+        'ground_truth_bounding_box': None,
+        'predicted_polygon': [[0, 0], [sequence, 0], [sequence, sequence]],
+        'annotated_polygon': None,
+        'ground_truth_polygon': None,
+        'metrics': {comparison: {'bb_iou': 1.0, 'bb_number_of_changes': sequence} for comparison in COMPARISONS},
+        'metrics_version': 1
+    }
+
+
+def main(_argv):
+    rng = random.Random(FLAGS.seed)
+    keys = [(str(rng.randrange(FLAGS.classes)), 'image_{}.jpg'.format(rng.randrange(FLAGS.images)))
+            for _ in range(FLAGS.submits)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(FLAGS.backend, directory)
+
+        # last sequence number written per key, checked against the store at the end;
+        # per-key locks keep it in the store's order without serializing other keys
+        expected = {}
+        key_locks = {key: threading.Lock() for key in set(keys)}
+        stop = threading.Event()
+        scans = [0]
+        stale_updates = [0]
+        reader_failures = []
+
+        def submit(sequence):
+            class_id, image_file_name = keys[sequence]
+            with key_locks[(class_id, image_file_name)]:
+                store.upsert(class_id, image_file_name, make_record(sequence))
+                expected[(class_id, image_file_name)] = sequence
+
+        def read():
+            try:
+                scan()
+            except Exception as e:
+                logging.exception('reader failed')
+                reader_failures.append(e)
+
+        def scan():
+            while not stop.is_set():
+                for class_id, image_file_name, record in store.records():
+                    # recalculation: stamp the metrics with the record's own sequence
+                    sequence = record['predicted_bounding_box'][2]
+                    metrics = {comparison: {'bb_iou': 0.5, 'bb_number_of_changes': sequence}
+                               for comparison in COMPARISONS}
+                    if not store.update_metrics(class_id, image_file_name, metrics, 2,
+                                                submitted_at=record.get('submitted_at')):
+                        stale_updates[0] += 1
+                statistics = MetricsStatistics(store)
+                statistics.snapshot()
+                scans[0] += 1
+
+        readers = [threading.Thread(target=read) for _ in range(FLAGS.readers)]
+        for reader in readers:
+            reader.start()
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=FLAGS.workers) as pool:
+            list(pool.map(submit, range(FLAGS.submits)))
+        elapsed = time.time() - start
+
+        stop.set()
+        for reader in readers:
+            reader.join()
+        store.compact()
+
+        # a fresh store reads everything back from disk
+        reloaded = make_store(FLAGS.backend, directory)
+        records = {(class_id, image_file_name): record for class_id, image_file_name, record in reloaded.records()}
+
+        errors = 0
+        for key, sequence in expected.items():
+            record = records.get(key)
+            if record is None:
+                logging.error('lost record {}'.format(key))
+                errors += 1
+                continue
+            if record['predicted_bounding_box'][2] != sequence:
+                logging.error('{}: has submit {}, expected {}'.format(key, record['predicted_bounding_box'][2], sequence))
+                errors += 1
+            for comparison in COMPARISONS:
+                if record['metrics'][comparison]['bb_number_of_changes'] != sequence:
+                    logging.error('{}: metrics from another submit'.format(key))
+                    errors += 1
+                    break
+        if len(records) != len(expected):
+            logging.error('store has {} records, expected {}'.format(len(records), len(expected)))
+            errors += 1
+        errors += len(reader_failures)
+
+        logging.info('{}: {} submits in {:.2f} s ({:.0f}/s), {} scans, {} stale metric updates dropped'.format(
+            FLAGS.backend, FLAGS.submits, elapsed, FLAGS.submits / elapsed, scans[0], stale_updates[0]))
+        if errors:
+            logging.error('{} inconsistencies found'.format(errors))
+            return 1
+        logging.info('{} records consistent'.format(len(records)))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit as e:
+        # keep the failure status; the tools otherwise swallow absl's exit
+        if e.code:
+            raise
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+from absl import logging
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:
+    # python-multipart before 0.0.13
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f'upload exceeds {max_bytes} bytes')
+        self.max_bytes = max_bytes
+
+
+class UploadError(Exception):
+    """The request is not a multipart form with a file part."""
+
+
+class UploadStore:
+    """Saves uploaded images into data_dir, one file per distinct content.
+
+    save() parses the raw request body as it arrives, so nothing is spooled
+    before the handler runs: the file part is written to a temporary file
+    and hashed chunk by chunk, and the request is cut off with
+    UploadTooLarge as soon as the body passes `max_bytes` (plus room for
+    the form framing), with or without a Content-Length. Parsing and writes
+    run in the thread pool so the event loop never blocks on disk. Content
+    already uploaded is not stored twice: the sha256 of every saved upload
+    is appended to `index_path`, and a repeated upload returns the existing
+    filename.
+    """
+    # multipart boundaries and part headers around the file
+    FORM_OVERHEAD = 64 * 1024
+
+    def __init__(self,
+                data_dir='./data',
+                max_bytes=20 * 1024 * 1024,
+                field_name='file',
+                index_path=None):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.field_name = field_name
+        # dot file, so image globs over data_dir skip it
+        self.index_path = index_path or os.path.join(data_dir, '.uploads.jsonl')
+
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+
+    def _load_index(self):
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        index[entry['sha256']] = entry['file']
+
+        return index
+
+    async def save(self, request):
+        """Stores the file part of a starlette Request; returns (filename, duplicate)."""
+        max_body = self.max_bytes + self.FORM_OVERHEAD
+        content_length = request.headers.get('content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body:
+            raise UploadTooLarge(self.max_bytes)
+        content_type, params = parse_options_header(request.headers.get('content-type'))
+        if content_type != b'multipart/form-data' or b'boundary' not in params:
+            raise UploadError('expected a multipart/form-data body')
+
+        upload = _FilePart(self, params[b'boundary'])
+        received = 0
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > max_body:
+                    raise UploadTooLarge(self.max_bytes)
+                await run_in_threadpool(upload.parser.write, chunk)
+            await run_in_threadpool(upload.parser.finalize)
+            if upload.sha256 is None:
+                raise UploadError('no complete {} part in the form'.format(self.field_name))
+        except FormParserError as e:
+            await run_in_threadpool(upload.discard)
+            raise UploadError('malformed multipart body: {}'.format(e)) from e
+        except BaseException:
+            await run_in_threadpool(upload.discard)
+            raise
+
+        return await run_in_threadpool(self._commit, upload.part_path, upload.sha256.hexdigest(), upload.filename)
+
+    def _commit(self, part_path, sha256, original_name):
+        with self._lock:
+            existing = self._index.get(sha256)
+            if existing is not None and os.path.exists(os.path.join(self.data_dir, existing)):
+                os.remove(part_path)
+                logging.info('upload of {} is a duplicate of {}'.format(original_name, existing))
+                return existing, True
+
+            # the digest keeps same-named uploads apart; basename keeps the client
+            # from picking the directory
+            fn = 'upload_{}_{}'.format(sha256[:16], os.path.basename(original_name))
+            os.replace(part_path, os.path.join(self.data_dir, fn))
+            self._index[sha256] = fn
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps({'sha256': sha256, 'file': fn}) + '\n')
+
+        return fn, False
+
+
+class _FilePart:
+    """Multipart callbacks writing the store's file field to a temporary file; runs in the thread pool."""
+    def __init__(self, store, boundary):
+        self.store = store
+        self.part_path = os.path.join(store.data_dir, '.upload_{}.part'.format(uuid.uuid4().hex))
+        self.filename = None
+        self.sha256 = None
+        self.size = 0
+
+        self._file = None
+        self._hash = None
+        self._headers = {}
+        self._field = b''
+        self._value = b''
+        self.parser = MultipartParser(boundary, {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = b''
+        self._value = b''
+
+    def _on_headers_finished(self):
+        _, params = parse_options_header(self._headers.get(b'content-disposition'))
+        name = params.get(b'name', b'').decode('utf-8')
+        if name == self.store.field_name and b'filename' in params and self._file is None \
+                and self.sha256 is None:
+            self.filename = params[b'filename'].decode('utf-8')
+            self._hash = hashlib.sha256()
+            self._file = open(self.part_path, 'wb')
+
+    def _on_part_data(self, data, start, end):
+        if self._file is None:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.store.max_bytes:
+            raise UploadTooLarge(self.store.max_bytes)
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def _on_part_end(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.sha256 = self._hash
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
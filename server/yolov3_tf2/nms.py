@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def inclusive_pixel_iou(boxes):
+    """IoU between every pair of [N, (x1, y1, x2, y2)] pixel boxes, as an [N, N] matrix.
+
+    Box corners are inclusive pixels, so a box covers (x2 - x1 + 1) * (y2 - y1 + 1) pixels.
+    This is the convention of the per-class NMS this module replaced, so the
+    suppression threshold keeps its meaning on small detections. It is not
+    the IoU the annotation metrics report: box_geometry.pairwise_iou treats
+    corners as continuous coordinates (no +1) and adds 0.001 to the union.
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    w = np.maximum(0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]) + 1)
+    h = np.maximum(0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]) + 1)
+    intersection = w * h
+
+    return intersection / (areas[:, None] + areas[None, :] - intersection)
+
+
+def class_aware_nms(boxes, classes, scores=None, iou_threshold=0.4):
+    """Greedy per-class non-maximum suppression in a single pass.
+
+    Boxes of different classes are shifted apart by a per-class offset so one
+    pairwise IoU matrix never lets them suppress each other. Boxes are visited
+    by descending score (input order when scores is None, which is already
+    score order for yolo_nms output).
+
+    Returns the kept boxes as int32 and their classes, grouped by class.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    classes = np.asarray(classes).reshape(-1)
+    if len(boxes) == 0:
+        return np.empty((0, 4), np.int32), np.empty(0, classes.dtype)
+
+    if scores is None:
+        order = np.arange(len(boxes))
+    else:
+        order = np.argsort(-np.asarray(scores).reshape(-1), kind='stable')
+
+    offsets = (classes * (boxes.max() - boxes.min() + 2))[:, None]
+    iou = inclusive_pixel_iou((boxes + offsets)[order])
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= iou[i] > iou_threshold
+
+    kept = order[keep]
+    kept = kept[np.lexsort((kept, classes[kept]))]
+
+    return boxes[kept].astype(np.int32), classes[kept]
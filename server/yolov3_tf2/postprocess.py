@@ -0,0 +1,32 @@
+import numpy as np
+
+
+def scale_boxes(boxes, num_valid, img_shape):
+    """Converts normalized yolo boxes to pixel boxes clipped to the image.
+
+    boxes: [max_boxes, 4] (or [1, max_boxes, 4]) normalized (x1, y1, x2, y2);
+    only the first num_valid rows are detections, the rest is zero padding.
+    img_shape: (height, width, channels)
+
+    Returns [num_valid, 4] int32 pixel boxes.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)[:int(num_valid)]
+    height, width = img_shape[0], img_shape[1]
+    scale = np.array([width, height, width, height], dtype=np.float32)
+    # truncate like int() would, then clip to valid pixel indices
+    pixels = (boxes * scale).astype(np.int32)
+
+    return np.clip(pixels, 0, np.array([width, height, width, height], dtype=np.int32) - 1)
+
+
+def postprocess_detections(boxes, scores, classes, nums, img_shape):
+    """Trims the yolo_nms output of one image to its valid detections.
+
+    Returns (pixel boxes [n, 4] int32, scores [n] float32, classes [n] int32).
+    """
+    num_valid = int(np.asarray(nums).reshape(-1)[0])
+    pixel_boxes = scale_boxes(boxes, num_valid, img_shape)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)[:num_valid]
+    classes = np.asarray(classes).reshape(-1)[:num_valid].astype(np.int32)
+
+    return pixel_boxes, scores, classes
@@ -0,0 +1,91 @@
+"""Benchmarks class_aware_nms against the previous per-class Python NMS.
+
+Run from the server directory:
+    python -m yolov3_tf2.tools.benchmark_nms --num_boxes 100
+"""
+import timeit
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import numpy as np
+
+from yolov3_tf2.nms import class_aware_nms
+
+flags.DEFINE_integer('num_boxes', 100, 'boxes per image, yolo_max_boxes')
+flags.DEFINE_integer('num_classes', 80, 'number of classes in the model')
+flags.DEFINE_integer('distinct_classes', 5, 'classes actually present in the boxes')
+flags.DEFINE_integer('repeat', 200, 'timed runs per implementation')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+def legacy_nms(boxes, overlapThresh=0.4):
+    if len(boxes) == 0:
+        return []
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    indices = np.arange(len(x1))
+    for i, box in enumerate(boxes):
+        temp_indices = indices[indices != i]
+        xx1 = np.maximum(box[0], boxes[temp_indices, 0])
+        yy1 = np.maximum(box[1], boxes[temp_indices, 1])
+        xx2 = np.minimum(box[2], boxes[temp_indices, 2])
+        yy2 = np.minimum(box[3], boxes[temp_indices, 3])
+        w = np.maximum(0, xx2 - xx1 + 1)
+        h = np.maximum(0, yy2 - yy1 + 1)
+        overlap = (w * h) / areas[temp_indices]
+        if np.any(overlap) > overlapThresh:
+            indices = indices[indices != i]
+    return boxes[indices].astype(int)
+
+
+def legacy_non_maximum_suppression(boxes, classes, num_classes):
+    new_boxes = np.empty((0, 4), int)
+    new_classes = np.empty((0, 1), int)
+    for i in range(1, num_classes + 1):
+        indices = np.argwhere(classes == i)
+        if (len(indices) > 0):
+            filtered_boxes = legacy_nms(boxes[indices].reshape((boxes[indices].shape[0], boxes[indices].shape[2])))
+            new_boxes = np.append(new_boxes, filtered_boxes, axis=0)
+            new_classes = np.append(new_classes, np.full(filtered_boxes.shape[0], i))
+
+    return new_boxes, new_classes
+
+
+def random_detections(rng, num_boxes, distinct_classes, num_classes):
+    # clustered boxes in a 640x480 image, like several objects each detected a few times
+    centers = rng.uniform([50, 50], [590, 430], size=(max(1, num_boxes // 4), 2))
+    xy = centers[rng.integers(0, len(centers), num_boxes)] + rng.normal(0, 8, size=(num_boxes, 2))
+    wh = rng.uniform(30, 120, size=(num_boxes, 2))
+    boxes = np.floor(np.concatenate([xy - wh / 2, xy + wh / 2], axis=1)).clip(0)
+    present = rng.choice(np.arange(1, num_classes + 1), size=distinct_classes, replace=False)
+    classes = rng.choice(present, size=num_boxes)
+    scores = np.sort(rng.uniform(0.5, 1.0, num_boxes))[::-1]
+
+    return boxes, classes, scores
+
+
+def main(_argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    boxes, classes, scores = random_detections(rng, FLAGS.num_boxes, FLAGS.distinct_classes, FLAGS.num_classes)
+
+    legacy = timeit.timeit(lambda: legacy_non_maximum_suppression(boxes, classes, FLAGS.num_classes),
+                           number=FLAGS.repeat) / FLAGS.repeat
+    vectorized = timeit.timeit(lambda: class_aware_nms(boxes, classes, scores),
+                               number=FLAGS.repeat) / FLAGS.repeat
+
+    legacy_boxes, _ = legacy_non_maximum_suppression(boxes, classes, FLAGS.num_classes)
+    kept_boxes, _ = class_aware_nms(boxes, classes, scores)
+    logging.info('boxes: {}, kept: legacy {}, class_aware_nms {}'.format(
+        len(boxes), len(legacy_boxes), len(kept_boxes)))
+    logging.info('legacy: {:.3f} ms, class_aware_nms: {:.3f} ms, speedup: {:.1f}x'.format(
+        legacy * 1000, vectorized * 1000, legacy / vectorized))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
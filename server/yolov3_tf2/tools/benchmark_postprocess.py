@@ -0,0 +1,74 @@
+"""Benchmarks box post-processing (scaling + NMS) separately from model time.
+
+Compares the previous per-row scaling loop, which also fed the zero padding
+rows into NMS, with postprocess_detections + class_aware_nms on a synthetic
+yolo_nms output. Run from the server directory:
+    python -m yolov3_tf2.tools.benchmark_postprocess --num_valid 12
+"""
+import timeit
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import numpy as np
+
+from yolov3_tf2.nms import class_aware_nms
+from yolov3_tf2.postprocess import postprocess_detections
+
+flags.DEFINE_integer('max_boxes', 100, 'yolo_max_boxes, rows in the model output')
+flags.DEFINE_integer('num_valid', 12, 'valid detections in the model output')
+flags.DEFINE_integer('repeat', 500, 'timed runs per implementation')
+flags.DEFINE_integer('seed', 0, 'random seed')
+
+
+def legacy_scale_boxes(boxes, img_shape):
+    npboxes = boxes.copy()
+    npboxes = npboxes.reshape((npboxes.shape[1], npboxes.shape[2]))
+    for i in range(npboxes.shape[0]):
+        npboxes[i][0] = max(0, int(npboxes[i][0]*img_shape[1]))
+        npboxes[i][1] = max(0, int(npboxes[i][1]*img_shape[0]))
+        npboxes[i][2] = max(0, int(npboxes[i][2]*img_shape[1]))
+        npboxes[i][3] = max(0, int(npboxes[i][3]*img_shape[0]))
+
+    return npboxes
+
+
+def main(_argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    img_shape = (480, 640, 3)
+
+    # yolo_nms output for one image: valid rows first, zero padding after
+    boxes = np.zeros((1, FLAGS.max_boxes, 4), dtype=np.float32)
+    xy = rng.uniform(0, 0.8, size=(FLAGS.num_valid, 2))
+    boxes[0, :FLAGS.num_valid] = np.concatenate([xy, xy + rng.uniform(0.05, 0.2, size=(FLAGS.num_valid, 2))], axis=1)
+    scores = np.zeros((1, FLAGS.max_boxes), dtype=np.float32)
+    scores[0, :FLAGS.num_valid] = np.sort(rng.uniform(0.5, 1.0, FLAGS.num_valid))[::-1]
+    classes = np.zeros((1, FLAGS.max_boxes), dtype=np.int64)
+    classes[0, :FLAGS.num_valid] = rng.integers(0, 5, FLAGS.num_valid)
+    classes += 1
+    nums = np.array([FLAGS.num_valid], dtype=np.int32)
+
+    def legacy():
+        npboxes = legacy_scale_boxes(boxes, img_shape)
+        return class_aware_nms(npboxes, classes.flatten())
+
+    def vectorized():
+        npboxes, npscores, npclasses = postprocess_detections(boxes, scores, classes, nums, img_shape)
+        return class_aware_nms(npboxes, npclasses, npscores)
+
+    legacy_scaling = timeit.timeit(lambda: legacy_scale_boxes(boxes, img_shape), number=FLAGS.repeat) / FLAGS.repeat
+    scaling = timeit.timeit(lambda: postprocess_detections(boxes, scores, classes, nums, img_shape),
+                            number=FLAGS.repeat) / FLAGS.repeat
+    legacy_total = timeit.timeit(legacy, number=FLAGS.repeat) / FLAGS.repeat
+    total = timeit.timeit(vectorized, number=FLAGS.repeat) / FLAGS.repeat
+
+    logging.info('scaling: legacy {:.3f} ms, postprocess_detections {:.3f} ms'.format(
+        legacy_scaling * 1000, scaling * 1000))
+    logging.info('scaling + nms: legacy {:.3f} ms, vectorized {:.3f} ms, speedup: {:.1f}x'.format(
+        legacy_total * 1000, total * 1000, legacy_total / total))
+
+
+if __name__ == '__main__':
+    try:
+        app.run(main)
+    except SystemExit:
+        pass
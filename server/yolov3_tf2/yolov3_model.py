@@ -10,6 +10,11 @@ import urllib
 from absl import app, flags, logging
 from absl.flags import FLAGS
 
+from batching import MicroBatcher
+from debug_artifacts import DebugArtifacts
+from result_cache import make_key
+from yolov3_tf2.nms import class_aware_nms
+from yolov3_tf2.postprocess import postprocess_detections
 from yolov3_tf2.yolov3_tf2.models2 import (
     YoloV3, YoloV3Tiny
 )
@@ -28,10 +33,21 @@ class YoloV3Model:
                 i_num_classes=80,
                 i_yolo_max_boxes=100,
                 i_yolo_iou_threshold=0.5,
-                i_yolo_score_threshold=0.5):
+                i_yolo_score_threshold=0.5,
+                i_size=416,
+                i_batch_size=1,
+                i_batch_wait_ms=10,
+                i_debug_artifacts=None):
 
         self.download_model(i_weights)
         self.i_num_classes = i_num_classes
+        self.i_tiny = i_tiny
+        self.i_yolo_max_boxes = i_yolo_max_boxes
+        self.i_yolo_iou_threshold = i_yolo_iou_threshold
+        self.i_yolo_score_threshold = i_yolo_score_threshold
+        self.i_size = i_size
+        self.weights_listeners = []
+        self.debug_artifacts = i_debug_artifacts or DebugArtifacts()
 
         physical_devices = tf.config.experimental.list_physical_devices('GPU')
         for physical_device in physical_devices:
@@ -42,12 +58,18 @@ class YoloV3Model:
         else:
             self.yolo = YoloV3(i_yolo_max_boxes, i_yolo_iou_threshold, i_yolo_score_threshold, classes=i_num_classes)
 
-        load_darknet_weights(self.yolo, i_weights, i_tiny)
-        logging.info('weights loaded')
+        self.load_weights(i_weights)
 
         self.class_names = [c.strip() for c in open(i_classes).readlines()]
         logging.info('classes loaded')
 
+        # coalesce concurrent process() calls into one forward pass
+        self.batcher = None
+        if i_batch_size > 1:
+            self.batcher = MicroBatcher(self.process_batch,
+                                        max_batch_size=i_batch_size,
+                                        max_wait_ms=i_batch_wait_ms,
+                                        name='yolo-batcher')
 
     def download_model(self, i_weights):
         # Download COCO trained weights from Releases if needed
@@ -55,25 +77,47 @@ class YoloV3Model:
             with urllib.request.urlopen(YOLOV3_COCO_MODEL_URL) as resp, open(i_weights, 'wb') as out:
                 shutil.copyfileobj(resp, out)
 
+    def load_weights(self, i_weights):
+        load_darknet_weights(self.yolo, i_weights, self.i_tiny)
+        stat = os.stat(i_weights)
+        # identifies the loaded weights, e.g. for keying cached detections
+        self.weights_version = '{}:{}:{}'.format(os.path.abspath(i_weights), stat.st_size, stat.st_mtime_ns)
+        logging.info('weights loaded')
+
+        for listener in self.weights_listeners:
+            listener()
+
+    def add_weights_listener(self, listener):
+        """Registers a no-argument callable run every time weights are (re)loaded."""
+        self.weights_listeners.append(listener)
+
+    def cache_key(self, image_hash):
+        """Key for cached detections of an image under the current weights and thresholds."""
+        return make_key(image_hash,
+                        self.weights_version,
+                        self.i_yolo_iou_threshold,
+                        self.i_yolo_score_threshold,
+                        self.i_yolo_max_boxes)
+
     def get_class_name(self, class_name_id):
         return self.class_names[class_name_id - 1];
 
     def process(self,
                 i_image_id: str,
                 i_image_path: str,
-                i_size=416,
-                i_output='./data/bounding_boxes.jpg'):
-
-        img_raw = tf.image.decode_image(
-            open(i_image_path, 'rb').read(), channels=3)
+                i_image=None):
+        """Detects objects in i_image, an RGB uint8 array, or in the file at i_image_path when not given."""
+        img_raw = i_image
+        if img_raw is None:
+            with open(i_image_path, 'rb') as f:
+                img_raw = tf.image.decode_image(f.read(), channels=3).numpy()
 
-        img = tf.expand_dims(img_raw, 0)
-        img = transform_images(img, i_size)
+        img = transform_images(img_raw, self.i_size)
 
-        t1 = time.time()
-        boxes, scores, classes, nums = self.yolo(img)
-        t2 = time.time()
-        logging.info('time: {}'.format(t2 - t1))
+        if self.batcher is not None:
+            boxes, scores, classes, nums = self.batcher(img)
+        else:
+            boxes, scores, classes, nums = self.process_batch([img])[0]
 
         logging.info('detections:')
         for i in range(nums[0]):
@@ -81,55 +125,47 @@ class YoloV3Model:
                                             np.array(scores[0][i]),
                                             np.array(boxes[0][i])))
 
-        img = cv2.cvtColor(img_raw.numpy(), cv2.COLOR_RGB2BGR)
-        img = draw_outputs(img, (boxes, scores, classes, nums), self.class_names)
+        if self.debug_artifacts.sample():
+            outputs = (boxes.numpy(), scores.numpy(), classes.numpy(), nums.numpy())
+            self.debug_artifacts.submit('bounding_boxes', self.save_bounding_boxes, img_raw, outputs)
+
+        return boxes, scores, classes + 1, nums, img_raw.shape
+
+    def save_bounding_boxes(self, i_output, img_raw, outputs):
+        img = cv2.cvtColor(img_raw, cv2.COLOR_RGB2BGR)
+        img = draw_outputs(img, outputs, self.class_names)
         cv2.imwrite(i_output, img)
-        logging.info('output saved to: {}'.format(i_output))
 
-        return boxes, scores, classes + 1, nums, img.shape
+    def process_batch(self, i_images):
+        """Runs one forward pass over a list of [size, size, 3] transformed images.
+
+        Returns one (boxes, scores, classes, nums) tuple per image, each keeping
+        a leading batch axis of 1 like a single-image call of self.yolo.
+        """
+        img = tf.stack(i_images, axis=0)
+
+        t1 = time.time()
+        boxes, scores, classes, nums = self.yolo(img)
+        t2 = time.time()
+        logging.info('batch size: {}, time: {}'.format(len(i_images), t2 - t1))
+
+        return [(boxes[i:i + 1], scores[i:i + 1], classes[i:i + 1], nums[i:i + 1])
+                for i in range(len(i_images))]
+
+    def postprocess(self, boxes, scores, classes, nums, img_shape):
+        """Turns the process() output into pixel boxes and classes after class-aware NMS."""
+        t1 = time.time()
+        npboxes, npscores, npclasses = postprocess_detections(
+            boxes.numpy(), scores.numpy(), classes.numpy(), nums.numpy(), img_shape)
+        npboxes, npclasses = self.non_maximum_suppression(npboxes, npclasses, npscores)
+        t2 = time.time()
+        logging.info('postprocess time: {}'.format(t2 - t1))
+
+        return npboxes, npclasses
 
     def non_maximum_suppression(self,
                                 boxes,
-                                classes):
-        new_boxes = np.empty((0, 4), int)
-        new_classes = np.empty((0, 1), int)
-        for i in range(1, self.i_num_classes + 1):
-            indices = np.argwhere(classes == i)
-            if (len(indices) > 0):
-                filtered_boxes = self.NMS(boxes[indices].reshape((boxes[indices].shape[0], boxes[indices].shape[2])))
-                new_boxes = np.append(new_boxes, filtered_boxes, axis=0)
-                new_classes = np.append(new_classes, np.full(filtered_boxes.shape[0], i))
-
-        return new_boxes, new_classes
-
-    def NMS(self, boxes, overlapThresh = 0.4):
-        # Return an empty list, if no boxes given
-        if len(boxes) == 0:
-            return []
-        x1 = boxes[:, 0]  # x coordinate of the top-left corner
-        y1 = boxes[:, 1]  # y coordinate of the top-left corner
-        x2 = boxes[:, 2]  # x coordinate of the bottom-right corner
-        y2 = boxes[:, 3]  # y coordinate of the bottom-right corner
-        # Compute the area of the bounding boxes and sort the bounding
-        # Boxes by the bottom-right y-coordinate of the bounding box
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1) # We add 1, because the pixel at the start as well as at the end counts
-        # The indices of all boxes at start. We will redundant indices one by one.
-        indices = np.arange(len(x1))
-        for i,box in enumerate(boxes):
-            # Create temporary indices
-            temp_indices = indices[indices!=i]
-            # Find out the coordinates of the intersection box
-            xx1 = np.maximum(box[0], boxes[temp_indices,0])
-            yy1 = np.maximum(box[1], boxes[temp_indices,1])
-            xx2 = np.minimum(box[2], boxes[temp_indices,2])
-            yy2 = np.minimum(box[3], boxes[temp_indices,3])
-            # Find out the width and the height of the intersection box
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
-            # compute the ratio of overlap
-            overlap = (w * h) / areas[temp_indices]
-            # if the actual boungding box has an overlap bigger than treshold with any other box, remove it's index
-            if np.any(overlap) > overlapThresh:
-                indices = indices[indices != i]
-        #return only the boxes at the remaining indices
-        return boxes[indices].astype(int)
\ No newline at end of file
+                                classes,
+                                scores=None,
+                                overlapThresh=0.4):
+        return class_aware_nms(boxes, classes, scores, iou_threshold=overlapThresh)
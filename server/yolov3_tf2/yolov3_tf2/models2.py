@@ -203,32 +203,41 @@ def yolo_nms(outputs, anchors, masks, classes, yolo_max_boxes, yolo_iou_threshol
     else:
         scores = confidence * class_probs
 
-    dscores = tf.squeeze(scores, axis=0)
-    scores = tf.reduce_max(dscores,[1])
-    bbox = tf.reshape(bbox,(-1,4))
-    classes = tf.argmax(dscores,1)
-    selected_indices, selected_scores = tf.image.non_max_suppression_with_scores(
-        boxes=bbox,
-        scores=scores,
-        max_output_size=yolo_max_boxes,
-        iou_threshold=yolo_iou_threshold,
-        score_threshold=yolo_score_threshold,
-        soft_nms_sigma=0.5
+    def nms_single(inputs):
+        image_bbox, image_scores = inputs
+        scores = tf.reduce_max(image_scores, [1])
+        classes = tf.argmax(image_scores, 1)
+        selected_indices, selected_scores = tf.image.non_max_suppression_with_scores(
+            boxes=image_bbox,
+            scores=scores,
+            max_output_size=yolo_max_boxes,
+            iou_threshold=yolo_iou_threshold,
+            score_threshold=yolo_score_threshold,
+            soft_nms_sigma=0.5
+        )
+
+        num_valid_nms_boxes = tf.shape(selected_indices)[0]
+
+        selected_indices = tf.concat([selected_indices,tf.zeros(yolo_max_boxes-num_valid_nms_boxes, tf.int32)], 0)
+        selected_scores = tf.concat([selected_scores,tf.zeros(yolo_max_boxes-num_valid_nms_boxes,tf.float32)], -1)
+
+        boxes = tf.gather(image_bbox, selected_indices)
+        classes = tf.gather(classes, selected_indices)
+
+        return boxes, selected_scores, classes, num_valid_nms_boxes
+
+    # run nms per image so that a [N, size, size, 3] batch yields
+    # [N, max_boxes, 4] boxes, [N, max_boxes] scores/classes and [N] counts
+    boxes, scores, classes, valid_detections = tf.map_fn(
+        nms_single,
+        (bbox, scores),
+        fn_output_signature=(
+            tf.TensorSpec([yolo_max_boxes, 4], tf.float32),
+            tf.TensorSpec([yolo_max_boxes], tf.float32),
+            tf.TensorSpec([yolo_max_boxes], tf.int64),
+            tf.TensorSpec([], tf.int32),
+        )
     )
-    
-    num_valid_nms_boxes = tf.shape(selected_indices)[0]
-
-    selected_indices = tf.concat([selected_indices,tf.zeros(yolo_max_boxes-num_valid_nms_boxes, tf.int32)], 0)
-    selected_scores = tf.concat([selected_scores,tf.zeros(yolo_max_boxes-num_valid_nms_boxes,tf.float32)], -1)
-
-    boxes=tf.gather(bbox, selected_indices)
-    boxes = tf.expand_dims(boxes, axis=0)
-    scores=selected_scores
-    scores = tf.expand_dims(scores, axis=0)
-    classes = tf.gather(classes,selected_indices)
-    classes = tf.expand_dims(classes, axis=0)
-    valid_detections=num_valid_nms_boxes
-    valid_detections = tf.expand_dims(valid_detections, axis=0)
 
     return boxes, scores, classes, valid_detections
 